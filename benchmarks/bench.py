@@ -0,0 +1,214 @@
+""" Benchmarks for snr and usnr against a synthetic cache.
+
+python -m benchmarks.bench generate <cache_directory> --packages 500
+python -m benchmarks.bench server <cache_directory> --concurrency 16 --workers 4
+python -m benchmarks.bench resolver <cache_directory> --jobs 8 --fixture_args "--latency 0.05"
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from logging import basicConfig, getLogger, DEBUG, WARNING
+from multiprocessing.pool import ThreadPool
+from os.path import abspath, dirname, join
+from random import Random
+from requests import Session, get, post
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from subprocess import Popen
+from tempfile import mkdtemp
+from time import sleep, time
+import sys
+
+from scripts import downloader
+from synthetic import generate_cache, load_packages
+
+
+logger = getLogger(__name__)
+
+ROOT_DIRECTORY = dirname(dirname(abspath(__file__)))
+SERVER_SCRIPT = join(ROOT_DIRECTORY, 'scripts', 'server.py')
+DEFAULT_PORT = 16100
+STARTUP_TIMEOUT = 30.0
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def report(name, latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    print('{0:<24} requests: {1:>7}  errors: {2:>5}  req/s: {3:>9.1f}  p50: {4:>8.2f}ms  p99: {5:>8.2f}ms'.format(
+        name, len(latencies), errors, len(latencies) / elapsed if elapsed else 0.0,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+
+class ServerProcess(object):
+    """ snr running in a subprocess against a cache directory. """
+    ready_path = 'metrics'
+
+    def __init__(self, cache_directory, port=DEFAULT_PORT, workers=1, extra_args=()):
+        self.base_url = 'http://127.0.0.1:{0}/'.format(port)
+        self.args = [sys.executable, SERVER_SCRIPT, cache_directory, '--host', '127.0.0.1', '--port', str(port),
+                     '--workers', str(workers)] + list(extra_args)
+        self.process = None
+
+    def __enter__(self):
+        self.process = Popen(self.args, cwd=ROOT_DIRECTORY)
+        deadline = time() + STARTUP_TIMEOUT
+        while time() < deadline:
+            try:
+                get(self.base_url + self.ready_path, timeout=1)
+                return self
+            except RequestException:
+                sleep(0.1)
+        self.process.kill()
+        raise RuntimeError('snr did not start within {0} seconds'.format(STARTUP_TIMEOUT))
+
+    def __exit__(self, *exc_info):
+        try:
+            post(self.base_url + 'shutdown', timeout=5)
+        except RequestException:
+            pass
+        for _ in range(50):
+            if self.process.poll() is not None:
+                return
+            sleep(0.1)
+        self.process.kill()
+
+
+class FixtureProcess(ServerProcess):
+    """ The stand-in registry (benchmarks.fixture) running in a subprocess over a cache directory. """
+    ready_path = 'chromedriver/'
+
+    def __init__(self, cache_directory, port=DEFAULT_PORT, extra_args=()):
+        super(FixtureProcess, self).__init__(cache_directory, port)
+        self.args = [sys.executable, '-m', 'benchmarks.fixture', cache_directory, '--port', str(port)] + list(extra_args)
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait()
+
+
+def install_pattern(packages, rounds, random):
+    """ (packument path, tarball path) pairs in the order an npm install would request them. """
+    pattern = []
+    for _ in range(rounds):
+        for package in random.sample(packages, len(packages)):
+            version = random.choice(package.versions)
+            tarball = '{0}/-/{1}-{2}.tgz'.format(package.name, package.base_name, version)
+            pattern.append(('node/' + package.name.replace('/', '%2f'), 'node/' + tarball))
+    return pattern
+
+
+def benchmark_server(cache_directory, concurrency=8, workers=1, rounds=1, port=DEFAULT_PORT, seed=0, extra_args=()):
+    packages = load_packages(cache_directory)
+    pattern = install_pattern(packages, rounds, Random(seed))
+
+    with ServerProcess(cache_directory, port, workers, extra_args) as server:
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        session.mount('http://', adapter)
+
+        def fetch(path):
+            start = time()
+            try:
+                response = session.get(server.base_url + path, headers={'Accept-Encoding': 'gzip'})
+                response.content
+                return 'packument' if '/-/' not in path else 'tarball', time() - start, response.status_code != 200
+            except RequestException:
+                return 'packument' if '/-/' not in path else 'tarball', time() - start, True
+
+        def install(pair):
+            return [fetch(pair[0]), fetch(pair[1])]
+
+        pool = ThreadPool(concurrency)
+        start = time()
+        try:
+            results = [result for pair_results in pool.map(install, pattern, chunksize=1) for result in pair_results]
+        finally:
+            pool.terminate()
+            pool.join()
+        elapsed = time() - start
+
+    print('snr: {0} packages, concurrency {1}, workers {2}'.format(len(packages), concurrency, workers))
+    for kind in ('packument', 'tarball'):
+        kind_results = [result for result in results if result[0] == kind]
+        report(kind, [latency for _, latency, _ in kind_results], elapsed, sum(1 for _, _, error in kind_results if error))
+    report('all', [latency for _, latency, _ in results], elapsed, sum(1 for _, _, error in results if error))
+
+
+def benchmark_resolver(cache_directory, jobs=8, roots=10, repeat=3, port=DEFAULT_PORT, seed=0, fixture_args=()):
+    """ Resolve random root packages with usnr's resolver against the stand-in registry over the synthetic cache. """
+    packages = load_packages(cache_directory)
+    random = Random(seed)
+
+    with FixtureProcess(cache_directory, port, fixture_args) as fixture:
+        durations = []
+        resolved = 0
+        for _ in range(repeat):
+            specs = [package.name for package in random.sample(packages, min(roots, len(packages)))]
+            # a fresh store per run, nothing is cached between runs.
+            store = downloader.PackumentStore(mkdtemp(), registry_url=fixture.base_url)
+            start = time()
+            required = downloader.resolve_packages({}, specs, jobs, store)
+            durations.append(time() - start)
+            resolved += len(required)
+
+    elapsed = sum(durations)
+    print('usnr resolver: {0} runs, jobs {1}, {2:.1f} packages/s'.format(repeat, jobs, resolved / elapsed if elapsed else 0.0))
+    report('resolve run', durations, elapsed)
+
+
+def get_args():
+    parser = ArgumentParser(description='snr/usnr benchmarks')
+    sub_parsers = parser.add_subparsers(dest='command')
+
+    generate = sub_parsers.add_parser('generate', help='Generate a synthetic cache directory')
+    generate.add_argument('cache_directory', help='Cache directory')
+    generate.add_argument('--packages', help='Number of packages', default=200, type=int)
+    generate.add_argument('--versions', help='Versions per package', default=10, type=int)
+    generate.add_argument('--scoped_ratio', help='Fraction of scoped packages', default=0.2, type=float)
+    generate.add_argument('--packument_bytes', help='Approximate packument size', default=16 * 1024, type=int)
+    generate.add_argument('--tarball_bytes', help='Tarball size', default=8 * 1024, type=int)
+    generate.add_argument('--max_dependencies', help='Maximum dependencies per version', default=4, type=int)
+
+    server = sub_parsers.add_parser('server', help='Replay an npm install request pattern against snr')
+    server.add_argument('cache_directory', help='Cache directory')
+    server.add_argument('--concurrency', help='Concurrent clients', default=8, type=int)
+    server.add_argument('--workers', help='snr worker processes', default=1, type=int)
+    server.add_argument('--rounds', help='Times every package is installed', default=1, type=int)
+    server.add_argument('--port', help='Port', default=DEFAULT_PORT, type=int)
+    server.add_argument('--snr_args', help='Extra snr arguments', default='', type=str)
+
+    resolver = sub_parsers.add_parser('resolver', help='Measure usnr resolver throughput')
+    resolver.add_argument('cache_directory', help='Cache directory')
+    resolver.add_argument('--jobs', help='Resolver jobs', default=8, type=int)
+    resolver.add_argument('--roots', help='Root packages per run', default=10, type=int)
+    resolver.add_argument('--repeat', help='Runs', default=3, type=int)
+    resolver.add_argument('--port', help='Port', default=DEFAULT_PORT, type=int)
+    resolver.add_argument('--fixture_args', help='Extra stand-in registry arguments (e.g. "--latency 0.05 --error_rate 0.01")', default='', type=str)
+
+    for sub_parser in (generate, server, resolver):
+        sub_parser.add_argument('--seed', help='Random seed', default=0, type=int)
+        sub_parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    basicConfig(level=DEBUG if args.verbose else WARNING, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    if args.command == 'generate':
+        packages = generate_cache(args.cache_directory, args.packages, args.versions, args.scoped_ratio,
+                                  args.packument_bytes, args.tarball_bytes, args.max_dependencies, args.seed)
+        print('Generated {0} packages in {1}'.format(len(packages), args.cache_directory))
+    elif args.command == 'server':
+        benchmark_server(args.cache_directory, args.concurrency, args.workers, args.rounds, args.port, args.seed, args.snr_args.split())
+    elif args.command == 'resolver':
+        benchmark_resolver(args.cache_directory, args.jobs, args.roots, args.repeat, args.port, args.seed, args.fixture_args.split())
+
+
+if __name__ == '__main__':
+    main()
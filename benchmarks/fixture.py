@@ -0,0 +1,187 @@
+""" Stand-in upstream npm registry for offline testing and benchmarking of usnr.
+
+Serves packuments and tarballs from a fixture directory laid out like a usnr cache (node/<name>.json,
+node/[@scope/]tgz/<file>) and chromedriver files from chromedriver/ under /chromedriver/. In record mode npm
+misses are fetched from a real upstream and saved first. Latency and failures can be injected deterministically
+(seeded).
+
+python -m benchmarks.fixture <fixture_directory> --port 16200 --latency 0.05 --error_rate 0.01
+python -m benchmarks.fixture <fixture_directory> --record https://registry.npmjs.org/
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from flask import Flask, abort, request, send_from_directory
+from hashlib import sha1
+from json import dumps, load
+from logging import basicConfig, getLogger, DEBUG, INFO
+from os import makedirs, rename
+from os.path import dirname, exists, join
+from random import Random
+from requests import get
+from threading import Lock
+from time import sleep
+from xml.etree.ElementTree import parse, register_namespace, tostring
+
+from scripts.compiler import rewrite_tarball_urls
+
+
+logger = getLogger(__name__)
+
+app = Flask(__name__)
+
+S3_NAMESPACE = 'http://doc.s3.amazonaws.com/2006-03-01'
+S3_NAMESPACES = {'s3': S3_NAMESPACE}
+
+
+class FaultInjector(object):
+    """ Seeded latency and error injection, each request draws from the same random sequence. """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, throttle_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = Random(seed)
+        self._lock = Lock()
+
+    def draw(self):
+        with self._lock:
+            return self.random.random(), self.random.random()
+
+    def apply(self):
+        """ Sleep for the injected latency and return an error response, or None to serve normally. """
+        delay_draw, fault_draw = self.draw()
+        delay = self.latency + self.jitter * delay_draw
+        if delay:
+            sleep(delay)
+
+        if fault_draw < self.throttle_rate:
+            response = app.response_class('throttled', status=429)
+            response.headers['Retry-After'] = str(self.retry_after)
+            return response
+        if fault_draw < self.throttle_rate + self.error_rate:
+            return app.response_class('injected failure', status=self.error_status)
+        return None
+
+
+def packument_path(name):
+    return join(app.config['NODE_DIRECTORY'], name) + '.json'
+
+
+def tarball_directory(name):
+    scope = name.split('/', 1)[0] if name.startswith('@') else None
+    return join(app.config['NODE_DIRECTORY'], scope, 'tgz') if scope else join(app.config['NODE_DIRECTORY'], 'tgz')
+
+
+def record(url, path):
+    logger.info('Recording %s to %s', url, path)
+    response = get(url, stream=True)
+    if response.status_code != 200:
+        return False
+
+    directory = dirname(path)
+    if not exists(directory):
+        makedirs(directory)
+
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f:
+        for chunk in response.iter_content(65536):
+            f.write(chunk)
+    rename(tmp_path, path)
+    return True
+
+
+@app.before_request
+def inject_faults():
+    return app.config['FAULTS'].apply()
+
+
+@app.route('/chromedriver/')
+def get_chromedriver_listing():
+    """ The saved listing, paged like S3 does (marker, max-keys). """
+    path = join(app.config['CHROMEDRIVER_DIRECTORY'], 'chromedriver.xml')
+    if not exists(path):
+        abort(404)
+
+    register_namespace('', S3_NAMESPACE)
+    listing = parse(path).getroot()
+    marker = request.args.get('marker', '')
+    max_keys = min(request.args.get('max-keys', app.config['MAX_KEYS'], type=int), app.config['MAX_KEYS'])
+
+    contents = listing.findall('s3:Contents', S3_NAMESPACES)
+    remaining = [element for element in contents if element.findtext('s3:Key', '', S3_NAMESPACES) > marker]
+    for element in contents:
+        listing.remove(element)
+    listing.extend(remaining[:max_keys])
+
+    truncated = listing.find('s3:IsTruncated', S3_NAMESPACES)
+    if truncated is not None:
+        truncated.text = 'true' if len(remaining) > max_keys else 'false'
+    return app.response_class(tostring(listing, encoding='UTF-8'), mimetype='application/xml')
+
+
+@app.route('/chromedriver/<path:path>')
+def get_chromedriver_file(path):
+    return send_from_directory(app.config['CHROMEDRIVER_DIRECTORY'], path)
+
+
+@app.route('/<path:name>/-/<string:tarball>')
+def get_tarball(name, tarball):
+    directory = tarball_directory(name)
+    if not exists(join(directory, tarball)):
+        if not app.config['RECORD_URL'] or not record('{0}{1}/-/{2}'.format(app.config['RECORD_URL'], name, tarball), join(directory, tarball)):
+            abort(404)
+    return send_from_directory(directory, tarball)
+
+
+@app.route('/<path:name>')
+def get_packument(name):
+    path = packument_path(name)
+    if not exists(path):
+        if not app.config['RECORD_URL'] or not record(app.config['RECORD_URL'] + name.replace('/', '%2f'), path):
+            abort(404)
+
+    with open(path, 'r') as f:
+        body = dumps(rewrite_tarball_urls(load(f), request.host_url), separators=(',', ':'))
+
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(sha1(body.encode('utf-8')).hexdigest())
+    return response.make_conditional(request)
+
+
+def get_args():
+    parser = ArgumentParser(description='Record/replay stand-in npm registry')
+    parser.add_argument('fixture_directory', help='Fixture directory (usnr cache layout)')
+    parser.add_argument('--host', help='Host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', help='Port', default=16200, type=int)
+    parser.add_argument('--record', help='Upstream registry url to record misses from', default=None, type=str)
+    parser.add_argument('--max_keys', help='Chromedriver listing page size', default=1000, type=int)
+    parser.add_argument('--latency', help='Seconds added to every response', default=0.0, type=float)
+    parser.add_argument('--jitter', help='Up to this many extra seconds, randomly', default=0.0, type=float)
+    parser.add_argument('--error_rate', help='Fraction of requests failing with --error_status', default=0.0, type=float)
+    parser.add_argument('--error_status', help='Status of injected failures', default=503, type=int)
+    parser.add_argument('--throttle_rate', help='Fraction of requests answered 429 with Retry-After', default=0.0, type=float)
+    parser.add_argument('--retry_after', help='Retry-After seconds sent with 429s', default=1, type=int)
+    parser.add_argument('--seed', help='Random seed', default=0, type=int)
+    parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    basicConfig(level=DEBUG if args.verbose else INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    app.config['NODE_DIRECTORY'] = join(args.fixture_directory, 'node')
+    app.config['CHROMEDRIVER_DIRECTORY'] = join(args.fixture_directory, 'chromedriver')
+    app.config['MAX_KEYS'] = args.max_keys
+    app.config['RECORD_URL'] = args.record.rstrip('/') + '/' if args.record else None
+    app.config['FAULTS'] = FaultInjector(args.latency, args.jitter, args.error_rate, args.error_status,
+                                         args.throttle_rate, args.retry_after, args.seed)
+
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
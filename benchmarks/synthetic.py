@@ -0,0 +1,122 @@
+from base64 import b64encode
+from hashlib import sha1, sha512
+from json import dump, load
+from os import makedirs
+from os.path import exists, join
+from random import Random
+
+from scripts.compiler import iter_packument_paths
+
+
+REGISTRY_URL = 'https://registry.npmjs.org/'
+
+
+class SyntheticPackage(object):
+    __slots__ = ['name', 'versions', 'latest']
+
+    def __init__(self, name, versions):
+        self.name = name
+        self.versions = versions
+        self.latest = versions[-1]
+
+    @property
+    def is_scoped(self):
+        return self.name.startswith('@')
+
+    @property
+    def base_name(self):
+        return self.name.rsplit('/', 1)[-1]
+
+
+def package_names(count, scoped_ratio, random):
+    names = []
+    for i in range(count):
+        if random.random() < scoped_ratio:
+            names.append('@scope-{0}/pkg-{1:05d}'.format(i % 10, i))
+        else:
+            names.append('pkg-{0:05d}'.format(i))
+    return names
+
+
+def version_list(count):
+    # spread versions over a few majors so that caret ranges select subsets.
+    return ['{0}.{1}.{2}'.format(i // 20, (i // 5) % 4, i % 5) for i in range(count)]
+
+
+def make_packument(package, names, random, packument_bytes, max_dependencies, tarball_digests):
+    versions = {}
+    for version in package.versions:
+        dependencies = {}
+        for name in random.sample(names, min(len(names), random.randint(0, max_dependencies))):
+            if name != package.name:
+                # every package shares the same version list, so these ranges always resolve.
+                operator = random.choice(['', '~', '>=', '^'])
+                dependencies[name] = operator + random.choice(package.versions) if random.random() < 0.9 else '*'
+
+        sha1_digest, sha512_digest = tarball_digests[version]
+        versions[version] = {
+            'name': package.name,
+            'version': version,
+            'dependencies': dependencies,
+            'dist': {
+                'tarball': '{0}{1}/-/{2}-{3}.tgz'.format(REGISTRY_URL, package.name, package.base_name, version),
+                'shasum': sha1_digest,
+                'integrity': sha512_digest,
+            },
+        }
+
+    packument = {
+        'name': package.name,
+        'dist-tags': {'latest': package.latest},
+        'versions': versions,
+        'time': dict((version, '2018-01-01T00:00:00.000Z') for version in package.versions),
+    }
+
+    # pad with a readme the way real packuments are inflated by descriptive fields.
+    padding = max(0, packument_bytes - 400 * len(versions))
+    packument['readme'] = 'x' * padding
+    return packument
+
+
+def generate_cache(cache_directory, package_count=200, versions_per_package=10, scoped_ratio=0.2,
+                   packument_bytes=16 * 1024, tarball_bytes=8 * 1024, max_dependencies=4, seed=0):
+    """ Write a synthetic cache (usnr layout) under cache_directory, returning its SyntheticPackages. """
+    random = Random(seed)
+    node_directory = join(cache_directory, 'node')
+    names = package_names(package_count, scoped_ratio, random)
+    packages = []
+
+    for name in names:
+        package = SyntheticPackage(name, version_list(versions_per_package))
+        packages.append(package)
+
+        if package.is_scoped:
+            directory = join(node_directory, name.split('/', 1)[0])
+        else:
+            directory = node_directory
+        tgz_directory = join(directory, 'tgz')
+        if not exists(tgz_directory):
+            makedirs(tgz_directory)
+
+        tarball_digests = {}
+        for version in package.versions:
+            data = bytearray(random.getrandbits(8) for _ in range(tarball_bytes))
+            with open(join(tgz_directory, '{0}-{1}.tgz'.format(package.base_name, version)), 'wb') as f:
+                f.write(data)
+            tarball_digests[version] = (sha1(data).hexdigest(), 'sha512-' + b64encode(sha512(data).digest()).decode('ascii'))
+
+        with open(join(directory, package.base_name) + '.json', 'w') as f:
+            dump(make_packument(package, names, random, packument_bytes, max_dependencies, tarball_digests), f)
+
+    return packages
+
+
+def load_packages(cache_directory):
+    """ SyntheticPackages for every packument in a cache directory. """
+    packages = []
+    for path_to_json in iter_packument_paths(join(cache_directory, 'node')):
+        with open(path_to_json, 'r') as f:
+            packument = load(f)
+        versions = sorted(packument['versions'], key=lambda version: tuple(int(part) for part in version.split('.')))
+        packages.append(SyntheticPackage(packument['name'], versions))
+    return sorted(packages, key=lambda package: package.name)
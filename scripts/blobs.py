@@ -0,0 +1,105 @@
+from errno import EEXIST
+from logging import getLogger
+from os import link, makedirs, rename, unlink
+from os.path import dirname, exists, join, samefile
+from shutil import copyfile
+from threading import Lock
+from uuid import uuid4
+
+
+logger = getLogger(__name__)
+
+BLOBS_NAME = '.blobs'
+
+
+def blob_directory(node_directory):
+    return join(node_directory, BLOBS_NAME)
+
+
+def make_directory(path):
+    """ Create path and its parents unless they exist (a relative file's empty dirname is the current directory). """
+    if not path:
+        return
+    try:
+        makedirs(path)
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
+
+
+def _link_or_copy(source, destination):
+    """ Hardlink source to destination, copying when the two are on different filesystems (or links fail). """
+    try:
+        link(source, destination)
+    except OSError:
+        logger.debug('Could not link %s to %s, copying it.', source, destination)
+        copyfile(source, destination)
+
+
+class BlobStore(object):
+    """ Content addressed tarball storage: <directory>/<algorithm>/<ab>/<cd>/<hex digest>.
+
+    Digests are the "<algorithm>-<hex>" strings of Integrity.digest. Files are only added once verified, so a
+    blob's name vouches for its content. Cache directories reference blobs through hardlinks (tgz/<file>) and the
+    index (name, version -> digest), any number of caches can share one store.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._locks = {}
+        self._lock = Lock()
+
+    def path(self, digest):
+        algorithm, hex_digest = digest.split('-', 1)
+        return join(self.directory, algorithm, hex_digest[:2], hex_digest[2:4], hex_digest)
+
+    def has(self, digest):
+        return exists(self.path(digest))
+
+    def temporary_path(self, digest=None):
+        """ Somewhere to download to on the store's filesystem, so that adding the file is a rename.
+
+        The path for a digest is always the same, an interrupted download of it can be resumed.
+        """
+        directory = join(self.directory, 'tmp')
+        make_directory(directory)
+        return join(directory, digest if digest is not None else uuid4().hex)
+
+    def lock(self, digest):
+        with self._lock:
+            if digest not in self._locks:
+                self._locks[digest] = Lock()
+            return self._locks[digest]
+
+    def add(self, path, digest):
+        """ Move the (verified) file at path into the store. """
+        blob_path = self.path(digest)
+        if exists(blob_path):
+            unlink(path)
+            return blob_path
+
+        make_directory(dirname(blob_path))
+        rename(path, blob_path)
+        return blob_path
+
+    def adopt(self, path, digest):
+        """ Add a copy of the (verified) file at path to the store, leaving it in place. """
+        blob_path = self.path(digest)
+        if not exists(blob_path):
+            make_directory(dirname(blob_path))
+            tmp_path = self.temporary_path()
+            _link_or_copy(path, tmp_path)
+            rename(tmp_path, blob_path)
+        return blob_path
+
+    def link(self, digest, path):
+        """ Make path a hardlink to (or copy of) the blob, replacing whatever is there. """
+        blob_path = self.path(digest)
+        if exists(path) and samefile(path, blob_path):
+            return
+
+        tmp_path = path + '.part'
+        if exists(tmp_path):
+            unlink(tmp_path)
+        _link_or_copy(blob_path, tmp_path)
+        rename(tmp_path, path)
@@ -0,0 +1,413 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from hashlib import new as new_hash, sha1
+from json import dump, dumps, load, loads
+from logging import basicConfig, getLogger, DEBUG, INFO
+from mmap import mmap, ACCESS_READ
+from os import SEEK_CUR, SEEK_END, SEEK_SET, rename, stat, walk
+from os.path import abspath, dirname, exists, isabs, join, normpath, relpath, sep, splitdrive
+from struct import unpack
+from uuid import uuid4
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+import re
+
+from blobs import BlobStore, blob_directory as default_blob_directory, make_directory
+from index import CacheIndex, index_path, rebuild_index
+from integrity import hash_file
+
+
+logger = getLogger(__name__)
+
+BUNDLE_FORMAT = 1
+BUNDLE_MANIFEST_NAME = 'snr-bundle.json'
+# the id of the last bundle imported into a cache, a delta has to follow it.
+IMPORTED_NAME = '.imported.json'
+BUF_SIZE = 65536
+# fixed part of a zip local file header, the name and extra field follow it.
+LOCAL_HEADER_FORMAT = '<4s5H3I2H'
+LOCAL_HEADER_SIZE = 30
+DIGEST = re.compile(r'^[a-z0-9]+-[0-9a-f]+$')
+
+
+class BundleSequenceError(RuntimeError):
+    pass
+
+
+def _sha1_file(path):
+    return hash_file(path, {'sha1': sha1()})['sha1'].hexdigest()
+
+
+def _iter_chromedriver_files(chromedriver_directory):
+    for directory, sub_directories, files in walk(chromedriver_directory):
+        for name in sorted(files):
+            if not name.endswith('.tmp') and not name.endswith('.part'):
+                path = join(directory, name)
+                yield relpath(path, chromedriver_directory).replace('\\', '/'), path
+
+
+def read_bundle_manifest(bundle_path):
+    with ZipFile(bundle_path, 'r') as bundle:
+        return loads(bundle.read(BUNDLE_MANIFEST_NAME).decode('utf-8'))
+
+
+def export_bundle(cache_directory, bundle_path, since=None):
+    """ Write a cache (the packages in its index and its chromedriver files) to a single zip archive.
+
+    With since, a previous bundle, only what changed after it is written: packuments by sha1, tarballs by path and
+    digest, chromedriver files by sha1. The embedded manifest always describes the whole cache, a delta is served or
+    imported on top of the bundles before it. Tarballs are stored uncompressed so snr can serve them from the archive.
+    """
+    node_directory = join(cache_directory, 'node')
+    if not exists(index_path(node_directory)):
+        rebuild_index(node_directory)
+
+    previous = read_bundle_manifest(since) if since is not None else {}
+    previous_packages = previous.get('packages', {})
+    previous_chromedriver = previous.get('chromedriver', {})
+
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'id': uuid4().hex,
+        'base': previous.get('id'),
+        'created': datetime.utcnow().isoformat() + 'Z',
+        'packages': {},
+        'chromedriver': {},
+    }
+    written = 0
+
+    index = CacheIndex(node_directory)
+    tmp_path = bundle_path + '.part'
+    try:
+        with ZipFile(tmp_path, 'w', ZIP_DEFLATED, allowZip64=True) as bundle:
+            for name in index.packages():
+                info_path = join(node_directory, name) + '.json'
+                if not exists(info_path):
+                    continue
+
+                info_sha1 = _sha1_file(info_path)
+                versions = dict((version, entry) for version, entry in index.versions(name).items()
+                                if exists(join(node_directory, entry['path'])))
+                manifest['packages'][name] = {'sha1': info_sha1, 'versions': versions}
+
+                previous_package = previous_packages.get(name, {})
+                if previous_package.get('sha1') != info_sha1:
+                    bundle.write(info_path, 'node/{0}.json'.format(name), ZIP_DEFLATED)
+                    written += 1
+
+                previous_versions = previous_package.get('versions', {})
+                for version, entry in sorted(versions.items()):
+                    previous_entry = previous_versions.get(version, {})
+                    if previous_entry.get('path') != entry['path'] or previous_entry.get('digest') != entry['digest']:
+                        bundle.write(join(node_directory, entry['path']), 'node/' + entry['path'].replace('\\', '/'), ZIP_STORED)
+                        written += 1
+
+            for key, path in _iter_chromedriver_files(join(cache_directory, 'chromedriver')):
+                file_sha1 = _sha1_file(path)
+                manifest['chromedriver'][key] = {'sha1': file_sha1}
+                if previous_chromedriver.get(key, {}).get('sha1') != file_sha1:
+                    bundle.write(path, 'chromedriver/' + key, ZIP_STORED)
+                    written += 1
+
+            # last, so everything it lists has been written when it is.
+            bundle.writestr(BUNDLE_MANIFEST_NAME, dumps(manifest, sort_keys=True))
+    finally:
+        index.close()
+
+    rename(tmp_path, bundle_path)
+    logger.info('Exported %d packages to %s (%d files%s).', len(manifest['packages']), bundle_path, written,
+                ', delta of ' + since if since is not None else '')
+    return manifest
+
+
+def read_imported_id(node_directory):
+    path = join(node_directory, IMPORTED_NAME)
+    if not exists(path):
+        return None
+    with open(path, 'r') as f:
+        return load(f).get('id')
+
+
+def write_imported_id(node_directory, bundle_id):
+    path = join(node_directory, IMPORTED_NAME)
+    with open(path + '.tmp', 'w') as f:
+        dump({'id': bundle_id}, f)
+    rename(path + '.tmp', path)
+
+
+def _cache_path(cache_directory, relative_path):
+    """ Where a path in a bundle goes in cache_directory, a ValueError for paths that would end up outside it. """
+    parts = relative_path.replace('\\', '/').split('/')
+    if isabs(relative_path) or relative_path.startswith(('/', '\\')) or splitdrive(relative_path)[0] or '..' in parts:
+        raise ValueError('Not a path inside the cache: {0!r}'.format(relative_path))
+    path = normpath(join(cache_directory, *parts))
+    root = normpath(abspath(cache_directory))
+    if not abspath(path).startswith(root + sep):
+        raise ValueError('Not a path inside the cache: {0!r}'.format(relative_path))
+    return path
+
+
+def _extract(bundle, member, path, hasher=None):
+    """ Extract member to path (atomically), returning the hex digest of hasher over its content. """
+    make_directory(dirname(path))
+    tmp_path = path + '.part'
+    with bundle.open(member) as source, open(tmp_path, 'wb') as destination:
+        while True:
+            data = source.read(BUF_SIZE)
+            if not data:
+                break
+            if hasher is not None:
+                hasher.update(data)
+            destination.write(data)
+    rename(tmp_path, path)
+    return hasher.hexdigest() if hasher is not None else None
+
+
+def import_bundle(cache_directory, bundle_path, blob_directory=None, force=False):
+    """ Extract a bundle into a cache directory and add what it holds to the cache's index.
+
+    Tarballs are verified against the digests in the manifest and go through the blob store. A delta is only
+    imported on top of the bundle it was exported against, unless forced.
+    """
+    node_directory = join(cache_directory, 'node')
+    make_directory(node_directory)
+    blobs = BlobStore(blob_directory if blob_directory is not None else default_blob_directory(node_directory))
+
+    with ZipFile(bundle_path, 'r') as bundle:
+        manifest = loads(bundle.read(BUNDLE_MANIFEST_NAME).decode('utf-8'))
+        imported_id = read_imported_id(node_directory)
+        if manifest.get('base') is not None and manifest['base'] != imported_id and not force:
+            raise BundleSequenceError('{0} is a delta of bundle {1}, but the last bundle imported into {2} is {3}.'.format(
+                bundle_path, manifest['base'], cache_directory, imported_id))
+
+        # a crafted or corrupt bundle never writes (or links) outside the cache.
+        digests = {}
+        for name, package in manifest['packages'].items():
+            _cache_path(node_directory, name + '.json')
+            for version, entry in package['versions'].items():
+                _cache_path(node_directory, entry['path'])
+                if entry['digest'] is not None and DIGEST.match(entry['digest']) is None:
+                    raise ValueError('Not a digest: {0!r}'.format(entry['digest']))
+                digests['node/' + entry['path'].replace('\\', '/')] = entry['digest']
+
+        for member in bundle.namelist():
+            if member.startswith('chromedriver/'):
+                _extract(bundle, member, _cache_path(cache_directory, member))
+            elif member.startswith('node/') and member in digests and digests[member] is not None:
+                digest = digests[member]
+                path = _cache_path(cache_directory, member)
+                if not blobs.has(digest):
+                    algorithm, expected = digest.split('-', 1)
+                    tmp_path = blobs.temporary_path()
+                    actual = _extract(bundle, member, tmp_path, new_hash(algorithm))
+                    if actual != expected:
+                        raise ValueError('{0} in {1} does not match its digest {2}.'.format(member, bundle_path, digest))
+                    blobs.add(tmp_path, digest)
+                make_directory(dirname(path))
+                blobs.link(digest, path)
+            elif member.startswith('node/'):
+                _extract(bundle, member, _cache_path(cache_directory, member))
+
+    index = CacheIndex(node_directory)
+    try:
+        for name, package in manifest['packages'].items():
+            info_path = _cache_path(node_directory, name + '.json')
+            if not exists(info_path):
+                continue
+            index.add_package(name, info_path)
+            for version, entry in package['versions'].items():
+                tgz_path = _cache_path(node_directory, entry['path'])
+                if exists(tgz_path):
+                    index.add_tarball(name, version, tgz_path, entry['digest'], entry['size'])
+    finally:
+        index.close()
+
+    write_imported_id(node_directory, manifest['id'])
+    logger.info('Imported %d packages from %s into %s.', len(manifest['packages']), bundle_path, cache_directory)
+    return manifest
+
+
+class MappedMember(object):
+    """ Read only file over an uncompressed member of a memory mapped bundle. """
+
+    def __init__(self, mapped, offset, size):
+        self.mapped = mapped
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if end <= self.position:
+            return b''
+        data = self.mapped[self.offset + self.position:self.offset + end]
+        self.position = end
+        return data
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.position
+        elif whence == SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BundleReader(object):
+    """ Random access to the members of one bundle, stored members are read straight from a memory map. """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = stat(path).st_mtime
+        self._file = open(path, 'rb')
+        self.mapped = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        # opened by path, zipfile then reads every (compressed) member through its own file handle.
+        self.zip = ZipFile(path, 'r')
+        self.members = dict((info.filename, info) for info in self.zip.infolist())
+        self.manifest = loads(self.zip.read(BUNDLE_MANIFEST_NAME).decode('utf-8'))
+        self._offsets = {}
+
+    def _data_offset(self, info):
+        if info.filename not in self._offsets:
+            header = unpack(LOCAL_HEADER_FORMAT, self.mapped[info.header_offset:info.header_offset + LOCAL_HEADER_SIZE])
+            name_length, extra_length = header[-2:]
+            self._offsets[info.filename] = info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+        return self._offsets[info.filename]
+
+    def open(self, member):
+        info = self.members[member]
+        if info.compress_type == ZIP_STORED:
+            return MappedMember(self.mapped, self._data_offset(info), info.file_size)
+        return self.zip.open(info)
+
+    def close(self):
+        self.zip.close()
+        self.mapped.close()
+        self._file.close()
+
+
+class MemberStat(object):
+    __slots__ = ['st_mtime', 'st_size']
+
+    def __init__(self, st_mtime, st_size):
+        self.st_mtime = st_mtime
+        self.st_size = st_size
+
+
+class BundleSet(object):
+    """ A full bundle and the deltas on top of it, oldest first, served as one cache.
+
+    Members are looked up newest bundle first. The newest manifest describes the whole cache, so the set doubles as
+    the server's index (the IndexSnapshot interface).
+    """
+
+    def __init__(self, paths):
+        self.readers = [BundleReader(path) for path in paths]
+        for base, delta in zip(self.readers, self.readers[1:]):
+            if delta.manifest.get('base') != base.manifest['id']:
+                raise BundleSequenceError('{0} is not a delta of {1}.'.format(delta.path, base.path))
+        self.readers.reverse()
+
+        self.mtime = max(reader.mtime for reader in self.readers)
+        self.packages = {}
+        self.tarballs = {}
+        for name, package in self.readers[0].manifest['packages'].items():
+            self.packages[name] = package['versions']
+            for version, entry in package['versions'].items():
+                self.tarballs[entry['path']] = (name, version)
+
+    available = True
+
+    def refresh(self):
+        pass
+
+    def has_package(self, name):
+        return name in self.packages
+
+    def has_tarball(self, path):
+        return path in self.tarballs
+
+    def tarball_digest(self, path):
+        if path not in self.tarballs:
+            return None
+        name, version = self.tarballs[path]
+        return self.packages[name][version]['digest']
+
+    def _locate(self, member):
+        for reader in self.readers:
+            if member in reader.members:
+                return reader
+        return None
+
+    def exists(self, member):
+        return self._locate(member) is not None
+
+    def stat(self, member):
+        reader = self._locate(member)
+        if reader is None:
+            raise OSError('{0} is not in any bundle.'.format(member))
+        return MemberStat(reader.mtime, reader.members[member].file_size)
+
+    def open(self, member):
+        reader = self._locate(member)
+        if reader is None:
+            raise IOError('{0} is not in any bundle.'.format(member))
+        return reader.open(member)
+
+
+def is_bundle(path):
+    return path.endswith('.zip')
+
+
+def get_export_args(argv=None):
+    parser = ArgumentParser(description='Export a cache directory to a bundle, a single archive to carry to an offline site')
+    parser.add_argument('cache_directory', help='Cache directory')
+    parser.add_argument('bundle', help='Bundle (.zip) to write')
+    parser.add_argument('--since', help='Only export what changed since this earlier bundle (a delta).', default=None, type=str)
+    parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+    return parser.parse_args(argv)
+
+
+def export_main(argv=None):
+    basicConfig(level=INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    args = get_export_args(argv)
+    if args.verbose:
+        getLogger('').setLevel(DEBUG)
+
+    export_bundle(args.cache_directory, args.bundle, args.since)
+
+
+def get_import_args(argv=None):
+    parser = ArgumentParser(description='Import bundles (a full one, then its deltas) into a cache directory')
+    parser.add_argument('cache_directory', help='Cache directory')
+    parser.add_argument('bundles', nargs='+', help='Bundles to import, in the order they were exported')
+    parser.add_argument('--blob_store', help='Content addressed tarball store (default: <cache>/node/.blobs).', default=None, type=str)
+    parser.add_argument('--force', help='Import a delta even if the bundle it follows was not the last one imported.', default=False, action='store_true')
+    parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+    return parser.parse_args(argv)
+
+
+def import_main(argv=None):
+    basicConfig(level=INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    args = get_import_args(argv)
+    if args.verbose:
+        getLogger('').setLevel(DEBUG)
+
+    for bundle_path in args.bundles:
+        import_bundle(args.cache_directory, bundle_path, args.blob_store, args.force)
@@ -0,0 +1,322 @@
+from collections import OrderedDict
+from errno import EEXIST
+from gzip import GzipFile
+from hashlib import sha1
+from io import BytesIO
+from logging import getLogger
+from mmap import mmap, ACCESS_READ
+from os import fstat, listdir, makedirs, rename, stat, unlink, utime
+from os.path import abspath, isdir, join
+from struct import calcsize, pack, unpack
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+
+logger = getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+SHARED_MEMORY_DIRECTORY = '/dev/shm'
+SHARED_SUFFIX = '.body'
+# body size, gzipped size (0 when there is none), etag.
+SHARED_HEADER = '<QQ40s'
+SHARED_HEADER_SIZE = calcsize(SHARED_HEADER)
+# entries are evicted least recently used first by file mtime, hits only refresh it this often.
+TOUCH_INTERVAL = 60.0
+# how often the shared directory is scanned for its size (and mappings of evicted files) when under budget.
+SCAN_INTERVAL = 30.0
+
+
+def gzip_bytes(data, compresslevel=6):
+    buf = BytesIO()
+    with GzipFile(fileobj=buf, mode='wb', compresslevel=compresslevel) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class CachedBody(object):
+    __slots__ = ['mtime', 'token', 'body', 'gzipped', 'etag']
+
+    def __init__(self, mtime, body, gzipped=None, token=None):
+        self.mtime = mtime
+        self.token = token
+        self.body = body
+        self.gzipped = gzipped
+        self.etag = sha1(body).hexdigest()
+
+    @property
+    def size(self):
+        return len(self.body) + (len(self.gzipped) if self.gzipped is not None else 0)
+
+
+class PackumentCache(object):
+    """ LRU cache of serialized response bodies keyed by path and file mtime, bounded by total bytes held. """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, use_gzip=False):
+        self.max_bytes = max_bytes
+        self.use_gzip = use_gzip
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, path, builder, token=None, mtime=None):
+        """ Return the CachedBody for path, calling builder(path) -> bytes when missing or stale.
+
+        token is any extra value the body depends on, the entry is stale when it changes along with the mtime.
+        mtime defaults to the file's, pass it for paths that aren't files (bundle members).
+        """
+        mtime = stat(path).st_mtime if mtime is None else mtime
+
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry.mtime == mtime and entry.token == token:
+                self._entries[path] = entry
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.current_bytes -= entry.size
+            self.misses += 1
+
+        body = builder(path)
+        entry = CachedBody(mtime, body, gzip_bytes(body) if self.use_gzip else None, token)
+
+        if entry.size > self.max_bytes:
+            logger.debug('Not caching %s, %d bytes exceeds cache budget.', path, entry.size)
+            return entry
+
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self.current_bytes -= previous.size
+            self._entries[path] = entry
+            self.current_bytes += entry.size
+            self._evict()
+
+        return entry
+
+    def invalidate(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.current_bytes -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            path, entry = self._entries.popitem(last=False)
+            self.current_bytes -= entry.size
+            logger.debug('Evicted %s from packument cache.', path)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def default_shared_directory(cache_directory):
+    """ Where the workers serving a cache directory share packument bodies, in shared memory when there is some. """
+    base = SHARED_MEMORY_DIRECTORY if isdir(SHARED_MEMORY_DIRECTORY) else gettempdir()
+    return join(base, 'snr-' + sha1(abspath(cache_directory).encode('utf-8')).hexdigest()[:12])
+
+
+class SharedBody(object):
+    """ A CachedBody held in a memory mapped file, every process mapping it shares the one copy. """
+    __slots__ = ['key', 'path', 'mtime', 'token', 'etag', 'mapped', 'inode', 'body_size', 'gzipped_size']
+
+    def __init__(self, key, path, mtime, token, mapped, inode):
+        self.key = key
+        self.path = path
+        self.mtime = mtime
+        self.token = token
+        self.mapped = mapped
+        self.inode = inode
+        self.body_size, self.gzipped_size, etag = unpack(SHARED_HEADER, mapped[:SHARED_HEADER_SIZE])
+        self.etag = etag.decode('ascii')
+
+    @property
+    def body(self):
+        return self.mapped[SHARED_HEADER_SIZE:SHARED_HEADER_SIZE + self.body_size]
+
+    @property
+    def gzipped(self):
+        if not self.gzipped_size:
+            return None
+        start = SHARED_HEADER_SIZE + self.body_size
+        return self.mapped[start:start + self.gzipped_size]
+
+    @property
+    def size(self):
+        return self.body_size + self.gzipped_size
+
+
+class SharedPackumentCache(object):
+    """ PackumentCache for worker processes, bodies are kept in files under a shared (memory) directory and mapped.
+
+    Workers share one copy of every body and new ones start warm. Entries are named after the path, mtime and token
+    they were built from, a packument or index rewritten by usnr is a miss and its stale entries age out. Least
+    recently used files are removed once the directory holds more than max_bytes.
+
+    A mapping keeps the pages of its file allocated even once the file is removed, so a process drops its mapping
+    of a file that is gone (another worker evicted it) and maps at most max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES, use_gzip=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_gzip = use_gzip
+        self.hits = 0
+        self.misses = 0
+        self.current_bytes = 0
+        self.mapped_bytes = 0
+        self.scanned = 0.0
+        self._mapped = OrderedDict()
+        self._lock = Lock()
+
+        try:
+            makedirs(directory)
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+        # entries left by other workers (or an earlier run) count towards the budget.
+        self._evict()
+
+    def _entry_path(self, key):
+        return join(self.directory, key + SHARED_SUFFIX)
+
+    def _open(self, key, path, mtime, token):
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+                inode = fstat(f.fileno()).st_ino
+        except (IOError, OSError):
+            return None
+        return SharedBody(key, path, mtime, token, mapped, inode)
+
+    def _write(self, key, body, gzipped):
+        tmp_path = join(self.directory, '{0}.{1}.tmp'.format(key, uuid4().hex))
+        with open(tmp_path, 'wb') as f:
+            f.write(pack(SHARED_HEADER, len(body), len(gzipped or b''), sha1(body).hexdigest().encode('ascii')))
+            f.write(body)
+            f.write(gzipped or b'')
+        rename(tmp_path, self._entry_path(key))
+
+    def _is_mapped_file(self, entry):
+        """ Whether the entry's file is still the one mapped, refreshing its mtime (for eviction) now and then. """
+        entry_path = self._entry_path(entry.key)
+        try:
+            st = stat(entry_path)
+            if st.st_ino != entry.inode:
+                return False
+            if time() - st.st_mtime >= TOUCH_INTERVAL:
+                utime(entry_path, None)
+        except OSError:
+            return False
+        return True
+
+    def _unmap(self, path):
+        # the mapping itself goes once the responses still using it are done with it.
+        entry = self._mapped.pop(path, None)
+        if entry is not None:
+            self.mapped_bytes -= len(entry.mapped)
+
+    def _map(self, path, entry):
+        self._unmap(path)
+        self._mapped[path] = entry
+        self.mapped_bytes += len(entry.mapped)
+        while self.mapped_bytes > self.max_bytes and self._mapped:
+            self._unmap(next(iter(self._mapped)))
+
+    def get(self, path, builder, token=None, mtime=None):
+        """ Return the entry (see CachedBody) for path, calling builder(path) -> bytes when no worker has it. """
+        mtime = stat(path).st_mtime if mtime is None else mtime
+        key = sha1(repr((path, mtime, token)).encode('utf-8')).hexdigest()
+
+        with self._lock:
+            entry = self._mapped.get(path)
+        if entry is not None and entry.key == key and self._is_mapped_file(entry):
+            with self._lock:
+                if self._mapped.get(path) is entry:
+                    # most recently used last.
+                    self._mapped[path] = self._mapped.pop(path)
+                self.hits += 1
+            self._evict()
+            return entry
+        if entry is not None:
+            with self._lock:
+                if self._mapped.get(path) is entry:
+                    self._unmap(path)
+
+        entry = self._open(key, path, mtime, token)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+
+            body = builder(path)
+            gzipped = gzip_bytes(body) if self.use_gzip else None
+            if len(body) + len(gzipped or b'') > self.max_bytes:
+                logger.debug('Not caching %s, %d bytes exceeds cache budget.', path, len(body))
+                return CachedBody(mtime, body, gzipped, token)
+
+            self._write(key, body, gzipped)
+            with self._lock:
+                self.current_bytes += len(body) + len(gzipped or b'')
+            shared = self._open(key, path, mtime, token)
+            if shared is None:
+                # evicted before it could be mapped.
+                return CachedBody(mtime, body, gzipped, token)
+            entry = shared
+        else:
+            with self._lock:
+                self.hits += 1
+
+        with self._lock:
+            self._map(path, entry)
+        self._evict()
+        return entry
+
+    def _evict(self):
+        """ Remove the least recently used files once the directory holds more than the budget. """
+        if self.current_bytes <= self.max_bytes and time() - self.scanned < SCAN_INTERVAL:
+            return
+
+        entries = []
+        for name in listdir(self.directory):
+            # not an entry (the workers' metrics).
+            if not name.endswith((SHARED_SUFFIX, '.tmp')):
+                continue
+            try:
+                st = stat(join(self.directory, name))
+            except OSError:
+                continue
+            # a body another worker is still writing.
+            if name.endswith('.tmp') and time() - st.st_mtime < SCAN_INTERVAL:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+        present = set(name for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                unlink(join(self.directory, name))
+                total -= size
+                present.discard(name)
+                logger.debug('Evicted %s from the shared packument cache.', name)
+            except OSError:
+                pass
+
+        with self._lock:
+            for path, entry in list(self._mapped.items()):
+                if entry.key + SHARED_SUFFIX not in present:
+                    self._unmap(path)
+            self.current_bytes = total
+            self.scanned = time()
+
+    def __len__(self):
+        return len(self._mapped)
@@ -0,0 +1,190 @@
+from __future__ import print_function
+from argparse import ArgumentParser
+from json import dump, dumps, load
+from logging import basicConfig, getLogger, DEBUG, INFO
+from errno import EEXIST
+from os import makedirs, rename, walk
+from os.path import basename, dirname, exists, getmtime, join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from cache import gzip_bytes
+from versions import VersionIndex
+
+
+logger = getLogger(__name__)
+
+UPSTREAM_URLS = ('https://registry.npmjs.org/', 'http://registry.npmjs.org/')
+DEFAULT_NODE_URL = 'http://0.0.0.0:16000/node/'
+# npm package names can't start with a dot, so neither name can be a packument.
+COMPILED_DIRECTORY = '.compiled'
+MANIFEST_NAME = '.compiled.json'
+
+
+def rewrite_tarball_urls(content, node_url):
+    # whatever registry the packument came from, its tarball urls end in <name>/-/<file>.
+    tarball_path = u'/{0}/-/'.format(content.get(u'name', u''))
+
+    if u'versions' in content:
+        for version in content['versions'].values():
+            if u'dist' in version and u'tarball' in version['dist']:
+                tarball = version['dist']['tarball']
+                position = tarball.find(tarball_path) if u'name' in content else -1
+                if position >= 0:
+                    version['dist']['tarball'] = node_url + tarball[position + 1:]
+                    continue
+                for upstream_url in UPSTREAM_URLS:
+                    version['dist']['tarball'] = version['dist']['tarball'].replace(upstream_url, node_url)
+    return content
+
+
+def tgz_directory_for(path_to_json):
+    return join(dirname(path_to_json), 'tgz')
+
+
+def filter_cached_versions(content, is_cached):
+    """ Drop versions whose tarball isn't cached (is_cached(version, tarball_name) is False) and the tags pointing at them. """
+    versions = content.get('versions', {})
+    for version, version_info in list(versions.items()):
+        tarball = version_info.get('dist', {}).get('tarball')
+        if tarball is None or not is_cached(version, basename(tarball)):
+            del versions[version]
+
+    dist_tags = content.get('dist-tags', {})
+    latest = dist_tags.get('latest')
+    for tag, version in list(dist_tags.items()):
+        if version not in versions:
+            del dist_tags[tag]
+
+    if latest is not None and 'latest' not in dist_tags and versions:
+        # npm needs a latest, use the newest cached version that isn't newer than the real one.
+        index = VersionIndex(versions.keys(), latest)
+        if len(index):
+            dist_tags['latest'] = index.versions[index.latest_end - 1 if index.latest_end else -1].raw
+
+    if 'time' in content:
+        for version in list(content['time'].keys()):
+            if version not in ('created', 'modified') and version not in versions:
+                del content['time'][version]
+
+    return content
+
+
+def cached_tarballs(path_to_json):
+    tgz_directory = tgz_directory_for(path_to_json)
+    return lambda version, tarball_name: exists(join(tgz_directory, tarball_name))
+
+
+def compiled_path(path_to_json):
+    return join(dirname(path_to_json), COMPILED_DIRECTORY, basename(path_to_json))
+
+
+def is_compiled_current(path_to_json):
+    path = compiled_path(path_to_json)
+    if not exists(path):
+        return False
+
+    # tarballs being added or removed changes which versions the compiled document lists.
+    mtime = getmtime(path)
+    tgz_directory = tgz_directory_for(path_to_json)
+    return mtime >= getmtime(path_to_json) and (not exists(tgz_directory) or mtime >= getmtime(tgz_directory))
+
+
+def _write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    rename(tmp_path, path)
+
+
+def compile_packument(path_to_json, node_url):
+    """ Write a server ready copy of the packument with .gz and .br (when brotli is available) siblings.
+
+    Only versions whose tarballs are cached are kept.
+    """
+    with open(path_to_json, 'r') as f:
+        content = rewrite_tarball_urls(load(f), node_url)
+
+    filter_cached_versions(content, cached_tarballs(path_to_json))
+
+    body = dumps(content, separators=(',', ':')).encode('utf-8')
+    path = compiled_path(path_to_json)
+    try:
+        makedirs(dirname(path))
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
+
+    _write_atomic(path + '.gz', gzip_bytes(body, compresslevel=9))
+
+    if brotli is not None:
+        _write_atomic(path + '.br', brotli.compress(body))
+
+    # written last so that its mtime marks the whole set as current.
+    _write_atomic(path, body)
+    logger.debug('Compiled %s to %s', path_to_json, path)
+
+
+def iter_packument_paths(node_cache_directory):
+    for directory, sub_directories, files in walk(node_cache_directory):
+        # tarballs and dot directories (e.g. the blob store, compiled packuments) hold no packuments.
+        sub_directories[:] = [name for name in sub_directories if name != 'tgz' and not name.startswith('.')]
+        for name in files:
+            # dot files hold bookkeeping (e.g. the verification manifest), not packuments.
+            if name.startswith('.') or not name.endswith('.json'):
+                continue
+            yield join(directory, name)
+
+
+def read_manifest(node_cache_directory):
+    path = join(node_cache_directory, MANIFEST_NAME)
+    if not exists(path):
+        return None
+    with open(path, 'r') as f:
+        return load(f)
+
+
+def write_manifest(node_cache_directory, node_url):
+    with open(join(node_cache_directory, MANIFEST_NAME), 'w') as f:
+        dump({'url': node_url}, f)
+
+
+def compile_cache(node_cache_directory, node_url, force=False):
+    manifest = read_manifest(node_cache_directory)
+    # compiled documents embed the url, recompile everything when it changes.
+    force = force or manifest is None or manifest.get('url') != node_url
+
+    count = 0
+    for path_to_json in iter_packument_paths(node_cache_directory):
+        if force or not is_compiled_current(path_to_json):
+            compile_packument(path_to_json, node_url)
+            count += 1
+
+    write_manifest(node_cache_directory, node_url)
+    logger.info('Compiled %d packuments in %s for %s', count, node_cache_directory, node_url)
+
+
+def get_args(argv=None):
+    parser = ArgumentParser(description='Compile cached packuments for serving')
+    parser.add_argument('cache_directory', help='Cache directory')
+    parser.add_argument('--url', help='Node url the server is reachable at', default=DEFAULT_NODE_URL, type=str)
+    parser.add_argument('-f', '--force', help='Recompile all packuments', default=False, action='store_true')
+    parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    basicConfig(level=INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    args = get_args(argv)
+    if args.verbose:
+        getLogger('').setLevel(DEBUG)
+
+    compile_cache(join(args.cache_directory, 'node'), args.url, args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,55 @@
 from __future__ import print_function
 from argparse import ArgumentParser
-from hashlib import sha1 as sha
+from collections import deque
+from fnmatch import fnmatch
+from hashlib import md5, sha1 as sha
 from json import load, dump
 from logging import basicConfig, getLogger, DEBUG, INFO
-from os import error as oserror, makedirs
-from os.path import basename, dirname, exists, join
+from multiprocessing.pool import ThreadPool
+from os import error as oserror, getcwd, makedirs, rename, unlink
+from os.path import basename, dirname, exists, getsize, join
+from Queue import Queue
 from requests import get
-from semver import max_satisfying, lte
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, RequestException
+from sys import argv as sys_argv
+from threading import Lock
 from time import sleep
 from urllib import quote
 from urllib2 import urlopen
+from xml.etree.ElementTree import ElementTree, register_namespace
 import xml.etree.ElementTree as ET
 
+from blobs import BlobStore, blob_directory as default_blob_directory, make_directory
+from bundle import export_main, import_main
+from compiler import compile_packument, compiled_path, is_compiled_current, main as compile_main
+from index import CacheIndex, index_path, main as index_main, rebuild_index
+from integrity import Integrity, VerificationManifest, hash_file
+from journal import RunJournal
+from lockfiles import read_lockfile
+from packuments import load_slim_packument
+from ratelimit import RateControlledSession, RateController
+from versions import VersionIndex
+
 
 logger = getLogger(__name__)
 
 REPOSITORY_URL = 'https://registry.npmjs.org/'
+PUBLIC_REGISTRY_URLS = (REPOSITORY_URL, 'http://registry.npmjs.org/', 'https://registry.yarnpkg.com/')
+CHROMEDRIVER_URL = 'https://chromedriver.storage.googleapis.com/'
+ABBREVIATED_MEDIA_TYPE = 'application/vnd.npm.install-v1+json; q=1.0, application/json; q=0.8, */*'
 BUF_SIZE = 65536
-NICENESS = 0.001
+DEFAULT_RESOLVER_JOBS = 8
+DEFAULT_DOWNLOAD_JOBS = 4
+# every request to the upstream registry goes through it, see "--rate".
+UPSTREAM = RateController()
+# the chromedriver bucket is another upstream, with its own limits.
+CHROMEDRIVER_UPSTREAM = RateController()
+S3_NAMESPACE = 'http://doc.s3.amazonaws.com/2006-03-01'
+S3_NAMESPACES = {'s3': S3_NAMESPACE}
+CHROMEDRIVER_LISTING_NAME = 'chromedriver.xml'
+CHROMEDRIVER_MANIFEST_NAME = '.chromedriver.json'
+RESOLVE_TIMEOUT = 24 * 60 * 60
 
 
 PACKAGES_NPM_REQUIRES=[
@@ -75,17 +107,136 @@ class PackageSpec(object):
         return '{0}(package_spec={1.package_spec}, is_scoped={1.is_scoped}, scope={1.scope}, scoped_package_name={1.scoped_package_name}, package_name={1.package_name}, package_version={1.package_version}, registry_package_name={1.registry_package_name})'.format(self.__class__.__name__, self)
 
 
-def get_package_info(package):
-    url = join(REPOSITORY_URL, package.replace('/', '%2f'))
-    content = get(url)
+def request_package_info(package, headers=None, registry_url=REPOSITORY_URL, stream=False):
+    """ Request the package info, returning the response when it is a 200 or a 304. """
+    url = join(registry_url, package.replace('/', '%2f'))
+    content = UPSTREAM.send(get, url, headers=headers, stream=stream)
     logger.info("Getting info for %s from %s, status: %d", package, url, content.status_code)
 
+    if content.status_code not in (200, 304):
+        raise FailedToDownloadPackageInfoError()
+
+    return content
+
+
+def get_package_info(package, registry_url=REPOSITORY_URL):
+    content = request_package_info(package, registry_url=registry_url)
+
     if content.status_code != 200:
         raise FailedToDownloadPackageInfoError()
 
     return content.json()
 
 
+class PackumentStore(object):
+    """ Cached packuments under a node cache directory, along with the upstream validators they were fetched with.
+
+    Packuments are requested conditionally so that unchanged ones are read from disk instead of downloaded. With
+    prefer_stored upstream isn't asked at all about packuments already stored, unless they need revalidating.
+    """
+    VALIDATORS_NAME = '.validators.json'
+
+    def __init__(self, node_directory, abbreviated=False, registry_url=REPOSITORY_URL, prefer_stored=False):
+        self.node_directory = node_directory
+        self.abbreviated = abbreviated
+        self.registry_url = registry_url
+        self.prefer_stored = prefer_stored
+        self.validators_path = join(node_directory, self.VALIDATORS_NAME)
+        self.validators = {}
+        # packages checked with upstream during this run.
+        self.revalidated = set()
+        self._lock = Lock()
+
+        if exists(self.validators_path):
+            try:
+                with open(self.validators_path, 'r') as f:
+                    self.validators = load(f)
+            except ValueError:
+                logger.warning('Ignoring corrupt validators file: %s', self.validators_path)
+
+    def package_directory(self, pkg_name):
+        if pkg_name.startswith('@'):
+            return join(self.node_directory, pkg_name.split('/', 1)[0])
+        return self.node_directory
+
+    def info_path(self, pkg_name):
+        return join(self.package_directory(pkg_name), pkg_name.rsplit('/', 1)[-1]) + '.json'
+
+    def tgz_directory(self, pkg_name):
+        return join(self.package_directory(pkg_name), 'tgz')
+
+    def load(self, pkg_name):
+        """ Return (info, modified) from the stored copy, without asking upstream. """
+        return load_slim_packument(self.info_path(pkg_name)), False
+
+    def fetch(self, pkg_name, revalidate=False):
+        """ Return (info, modified), info only holds what the resolver needs (see load_slim_packument).
+
+        Upstream bytes are streamed to disk as they are, unchanged packuments are read from disk instead.
+        """
+        info_path = self.info_path(pkg_name)
+        if self.prefer_stored and not revalidate and exists(info_path):
+            logger.debug('Using stored package info for %s', pkg_name)
+            return self.load(pkg_name)
+
+        headers = {'Accept': ABBREVIATED_MEDIA_TYPE} if self.abbreviated else {}
+
+        validators = self.validators.get(pkg_name)
+        if validators is not None and validators.get('abbreviated', False) == self.abbreviated and exists(info_path):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        content = request_package_info(pkg_name, headers, self.registry_url, stream=True)
+
+        with self._lock:
+            self.revalidated.add(pkg_name)
+
+        if content.status_code == 304:
+            content.close()
+            logger.debug('Package info for %s is unchanged, using %s', pkg_name, info_path)
+            return load_slim_packument(info_path), False
+
+        make_directory(self.package_directory(pkg_name))
+        tmp_path = info_path + '.part'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in content.iter_content(BUF_SIZE):
+                    f.write(chunk)
+        finally:
+            content.close()
+
+        # parsed before it replaces the cached copy, a truncated document never does.
+        info = load_slim_packument(tmp_path)
+        rename(tmp_path, info_path)
+
+        with self._lock:
+            self.validators[pkg_name] = {
+                'etag': content.headers.get('ETag'),
+                'last_modified': content.headers.get('Last-Modified'),
+                'abbreviated': self.abbreviated,
+            }
+
+        return info, True
+
+    def remove(self, pkg_name):
+        """ Remove the stored packument (and its compiled copies) of a package no longer cached. """
+        info_path = self.info_path(pkg_name)
+        for path in (info_path, compiled_path(info_path), compiled_path(info_path) + '.gz', compiled_path(info_path) + '.br'):
+            if exists(path):
+                unlink(path)
+        with self._lock:
+            self.validators.pop(pkg_name, None)
+
+    def save(self):
+        tmp_path = self.validators_path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                dump(self.validators, f)
+        rename(tmp_path, self.validators_path)
+
+
 def get_file_hash(path):
     tmphash = sha()
 
@@ -109,12 +260,19 @@ class FailedToDownloadPackageInfoError(RuntimeError):
 
 
 class Package(object):
-    def __init__(self, pkg_name):
+    def __init__(self, pkg_name, store=None, stored=False):
         self.pkg_name = pkg_name
         self.is_scoped = pkg_name.startswith('@')
+        self.store = store
 
-        self.info = get_package_info(self.pkg_name)
+        if store is not None and stored:
+            self.info, self.modified = store.load(self.pkg_name)
+        elif store is not None:
+            self.info, self.modified = store.fetch(self.pkg_name)
+        else:
+            self.info, self.modified = get_package_info(self.pkg_name), True
         self.required_versions = set()
+        self._version_index = None
 
     @property
     def latest(self):
@@ -124,6 +282,11 @@ class Package(object):
     def next_version(self):
         return str(self.info['dist-tags']['next']) if 'next' in self.info['dist-tags'] else None
 
+    @property
+    def version_index(self):
+        if self._version_index is None:
+            self._version_index = VersionIndex(self.info['versions'].keys(), self.latest)
+        return self._version_index
 
     def add_required_version(self, pkg_version):
         version_spec = pkg_version
@@ -133,18 +296,17 @@ class Package(object):
             logger.debug("Version not specified, using latest (%s)", self.latest)
             version_spec =  self.latest
 
-        # the python node-semver package doesn't work well with unicode, convert arguments to strings.
-        pkg_versions = [str(v) for v in  self.info['versions'].keys()]
-        filtered_pkg_versions = [v for v in pkg_versions if lte(v, self.latest, False)]
-
         logger.debug('Finding version (%s) up to latest(%s)', version_spec, self.latest)
 
-        download_version = max_satisfying(filtered_pkg_versions, str(version_spec))
+        download_version = self.version_index.max_satisfying(version_spec)
+
+        if download_version is None and self.store is not None and self.pkg_name not in self.store.revalidated:
+            # a stored copy can predate the version wanted.
+            logger.info('No stored version of %s satisfies %s, revalidating its package info.', self.pkg_name, version_spec)
+            self.info, self.modified = self.store.fetch(self.pkg_name, revalidate=True)
+            self._version_index = None
+            download_version = self.version_index.max_satisfying(pkg_version if pkg_version is not None else self.latest)
 
-        if download_version is None:
-            logger.debug('Version (%s) not found up to latest < latest(%s) trying all.', version_spec, self.latest)
-            download_version = max_satisfying(pkg_versions, str(version_spec))
-        
         if download_version in self.required_versions:
             raise PackageVersionAlreadyRequiredError()
         
@@ -160,19 +322,9 @@ def determine_download_version(pkg_spec, package):
         logger.info("Version not specified, using latest (%s)", package.latest)
         version_spec =  package.latest
 
-    # the python node-semver package doesn't work well with unicode, convert arguments to strings.
-    pkg_versions = [str(v) for v in  package.info['versions'].keys()]
-    filtered_pkg_versions = [v for v in pkg_versions if lte(v, package.latest, False)]
-
     logger.info('Finding version (%s) up to latest(%s)', version_spec, package.latest)
 
-    download_version = max_satisfying(filtered_pkg_versions, str(version_spec))
-
-    if download_version is None:
-        logger.info('Version (%s) not found up to latest < latest(%s) trying all.', version_spec, package.latest)
-        download_version = max_satisfying(pkg_versions, str(version_spec))
-    
-    return download_version
+    return package.version_index.max_satisfying(version_spec)
 
 
 def split_package_spec(spec):
@@ -182,138 +334,697 @@ def split_package_spec(spec):
         return spec.rsplit('@', 1) if '@' in spec else (spec, None)
     
 
-def crawl_package_info(packages, spec):
-    """ Download the package specified into the output directory specified. """
-
-    logger.debug('Processing %s', spec)
+def fetch_package(pkg_name, store=None):
+    """ Worker side of the resolver, fetch the package info for pkg_name. """
+    try:
+        package = Package(pkg_name, store)
+    except FailedToDownloadPackageInfoError:
+        logger.exception('Failed to download packge info for: %s', pkg_name)
+        package = None
+    except Exception:
+        logger.exception('Unexpected error getting package info for: %s', pkg_name)
+        package = None
 
-    pkg_name, pkg_version = split_package_spec(spec)
+    return pkg_name, package
 
-    if pkg_name not in packages:
-        try:
-            packages[pkg_name] = Package(pkg_name)
-        except FailedToDownloadPackageInfoError:
-            logger.exception('Failed to download packge info for: %s', pkg_name)
-            return
 
-    package = packages[pkg_name]
-    
+def resolve_package_version(package, pkg_version):
+    """ Require pkg_version of package, returning the dependency specs it introduces. """
     try:
         version_info = package.add_required_version(pkg_version)
-        
-        # cache all package dependencies and optoinal dependencies.
-        logger.debug('Processing dependencies: %s', pkg_name)
-        for dependency, version in version_info.get('dependencies', {}).items():
-            crawl_package_info(packages, dependency + '@' + version)
-    
-        logger.debug('Processing optional dependencies: %s', pkg_name)
-        for dependency, version in version_info.get('dependencies', {}).items():
-            crawl_package_info(packages, dependency + '@' + version)
-        
     except PackageVersionAlreadyRequiredError:
-        logger.debug('Package version already required - package: %s, version %s', pkg_name, pkg_version)
-        pass
+        logger.debug('Package version already required - package: %s, version %s', package.pkg_name, pkg_version)
+        return []
 
-    logger.debug('Done with: %s', spec)
-    sleep(NICENESS)
+    # cache all package dependencies and optional dependencies.
+    dependencies = dict(version_info.get('dependencies', {}))
+    dependencies.update(version_info.get('optionalDependencies', {}))
+    return [dependency + '@' + version for dependency, version in dependencies.items()]
 
 
-def download_chromedriver(output_directory):
-    logger.info('Downloading chromedriver resources.')
-    ns = {'ChromeDriver': 'http://doc.s3.amazonaws.com/2006-03-01'}
+def spec_for(pkg_name, pkg_version):
+    return pkg_name if pkg_version is None else pkg_name + '@' + pkg_version
 
-    r = get('http://chromedriver.storage.googleapis.com/')
 
-    root = ET.fromstring(r.content)
+def resume_packages(journal, store):
+    """ The packages ({name: Package}) and pending specs an interrupted resolution had reached, or None. """
+    if journal is None or not journal.resumed or journal.pending is None:
+        return None
 
-    info_output_file = join(output_directory, 'chromedriver.xml')
-    resource_base = output_directory
+    packages = {}
+    try:
+        for pkg_name, versions in journal.resolved.items():
+            package = Package(pkg_name, store, stored=True)
+            package.required_versions.update(versions)
+            packages[pkg_name] = package
+    except (IOError, ValueError):
+        logger.warning('Stored package infos of the interrupted run are missing, resolving from scratch.')
+        return None
+
+    return packages, journal.pending
+
+
+def resolve_packages(packages, specs, jobs=DEFAULT_RESOLVER_JOBS, store=None, journal=None):
+    """ Resolve specs and their dependency graph into packages ({name: Package}).
+
+    Package info is fetched by a pool of jobs workers (through store when given), each name is only fetched once
+    no matter how many specs are waiting on it. Version resolution happens on the calling thread from a work queue.
+    With a journal progress is checkpointed, and an interrupted resolution is resumed from it.
+    """
+    resumed = resume_packages(journal, store)
+    if resumed is not None:
+        resumed_packages, specs = resumed
+        packages.update(resumed_packages)
+
+    queue = deque(specs)
+    waiting = {}
+    failed = {}
+    completed = Queue()
+    pool = ThreadPool(jobs)
 
     try:
-        makedirs(resource_base)
-    except oserror:
-        pass
-        # logger.exception("Error creating output directory for chrome driver.")
+        while queue or waiting:
+            while queue:
+                spec = queue.popleft()
+                logger.debug('Processing %s', spec)
+                pkg_name, pkg_version = split_package_spec(spec)
+
+                if pkg_name in packages:
+                    queue.extend(resolve_package_version(packages[pkg_name], pkg_version))
+                elif pkg_name in failed:
+                    failed[pkg_name].append(pkg_version)
+                else:
+                    if pkg_name not in waiting:
+                        waiting[pkg_name] = []
+                        pool.apply_async(fetch_package, (pkg_name, store), callback=completed.put)
+                    waiting[pkg_name].append(pkg_version)
+
+            if waiting:
+                # the queue is empty, every resolved version's dependencies are resolved, waiting or failed.
+                if journal is not None:
+                    pending = [spec_for(pkg_name, pkg_version) for pkg_names in (waiting, failed)
+                               for pkg_name, pkg_versions in pkg_names.items() for pkg_version in pkg_versions]
+                    if journal.checkpoint_resolution(packages, pending) and store is not None:
+                        store.save()
+
+                # a timeout keeps the wait interruptible (Ctrl-C).
+                pkg_name, package = completed.get(True, RESOLVE_TIMEOUT)
+                pkg_versions = waiting.pop(pkg_name)
+
+                if package is None:
+                    failed[pkg_name] = pkg_versions
+                    continue
+
+                packages[pkg_name] = package
+                for pkg_version in pkg_versions:
+                    queue.extend(resolve_package_version(package, pkg_version))
+                logger.debug('Done with: %s', pkg_name)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if journal is not None:
+        # failed packages are retried when the run is resumed.
+        journal.checkpoint_resolution(packages, [spec_for(pkg_name, pkg_version) for pkg_name, pkg_versions in failed.items() for pkg_version in pkg_versions], force=True)
+
+    return packages
+
+
+def crawl_package_info(packages, spec, jobs=DEFAULT_RESOLVER_JOBS, store=None):
+    """ Resolve the package specified and its dependencies into packages. """
+    return resolve_packages(packages, [spec], jobs, store)
+
+
+class ChromedriverFile(object):
+    __slots__ = ['key', 'size', 'etag']
+
+    def __init__(self, key, size, etag):
+        self.key = key
+        self.size = size
+        self.etag = etag
+
+    @property
+    def md5(self):
+        """ The md5 of the file when the etag is one (it isn't for multipart uploads). """
+        return self.etag if len(self.etag) == 32 and '-' not in self.etag else None
+
+
+def list_bucket(session, base_url):
+    """ Page through an S3 style bucket listing, returning one listing document holding every page's entries. """
+    listing = None
+    marker = None
+    while True:
+        response = session.get(base_url, params={'marker': marker} if marker is not None else None)
+        response.raise_for_status()
+        page = ET.fromstring(response.content)
+        contents = page.findall('s3:Contents', S3_NAMESPACES)
+
+        if listing is None:
+            listing = page
+        else:
+            listing.extend(contents)
+
+        if page.findtext('s3:IsTruncated', 'false', S3_NAMESPACES) != 'true' or not contents:
+            break
+        marker = page.findtext('s3:NextMarker', None, S3_NAMESPACES) or contents[-1].findtext('s3:Key', None, S3_NAMESPACES)
+        logger.debug('Listing %s after %s', base_url, marker)
+
+    return listing
+
+
+def is_chromedriver_selected(key, versions=None, platforms=None):
+    """ Whether a bucket key matches the version (e.g. 2.4*) and platform (e.g. linux64) patterns.
+
+    Top level files (LATEST_RELEASE...) are always selected, platforms only apply to the chromedriver archives.
+    """
+    if key.endswith('/'):
+        return False
+    if '/' not in key:
+        return True
+
+    version, name = key.split('/', 1)
+    if versions and not any(fnmatch(version, pattern) for pattern in versions):
+        return False
+    if platforms and name.startswith('chromedriver_'):
+        return any(fnmatch(name, 'chromedriver_{0}.*'.format(platform)) for platform in platforms)
+    return True
+
+
+def select_chromedriver_files(listing, versions=None, platforms=None):
+    """ Drop the entries that aren't selected from listing, returning the ChromedriverFiles of those left. """
+    files = []
+    for contents in listing.findall('s3:Contents', S3_NAMESPACES):
+        key = contents.findtext('s3:Key', '', S3_NAMESPACES)
+        if is_chromedriver_selected(key, versions, platforms):
+            size = int(contents.findtext('s3:Size', '0', S3_NAMESPACES))
+            files.append(ChromedriverFile(key, size, contents.findtext('s3:ETag', '', S3_NAMESPACES).strip('"')))
+        else:
+            listing.remove(contents)
 
-    chromedriver_info = get('https://chromedriver.storage.googleapis.com/')
+    # the saved listing is a single, complete page.
+    for name in ('s3:IsTruncated', 's3:NextMarker', 's3:Marker'):
+        element = listing.find(name, S3_NAMESPACES)
+        if element is not None:
+            element.text = 'false' if name == 's3:IsTruncated' else ''
+    return files
 
-    with open(info_output_file, 'w') as f:
-        print(chromedriver_info.content, file=f)
-        
-    for installable in root.findall('ChromeDriver:Contents', ns):
-        element = installable.find('ChromeDriver:Key', ns)
-        resource_url = join('https://chromedriver.storage.googleapis.com/', element.text)
-        
-        save_path = join(resource_base, element.text)
+
+def is_chromedriver_current(path, chromedriver_file, recorded_etag):
+    if not exists(path) or getsize(path) != chromedriver_file.size:
+        return False
+    if recorded_etag == chromedriver_file.etag:
+        return True
+    # files from before etags were recorded.
+    return chromedriver_file.md5 is not None and hash_file(path, {'md5': md5()})['md5'].hexdigest() == chromedriver_file.md5
+
+
+def download_chromedriver_file(session, base_url, output_directory, chromedriver_file, manifest):
+    resource_url = base_url + quote(chromedriver_file.key)
+    save_path = join(output_directory, chromedriver_file.key)
+
+    if is_chromedriver_current(save_path, chromedriver_file, manifest.get(chromedriver_file.key)):
+        logger.info("Using cached %s at %s", resource_url, save_path)
+        return chromedriver_file.key, chromedriver_file.etag
+
+    logger.info("Downloading %s to %s", resource_url, save_path)
+    make_directory(dirname(save_path))
+
+    hashers = {'md5': md5()}
+    try:
+        download_file(session, resource_url, save_path, hashers)
+    except (RequestException, IOError, OSError):
+        logger.exception('Failed to download %s', resource_url)
+        return chromedriver_file.key, None
+
+    if chromedriver_file.md5 is not None and hashers['md5'].hexdigest() != chromedriver_file.md5:
+        logger.warning('%s downloaded with md5: %s, expected: %s', resource_url, hashers['md5'].hexdigest(), chromedriver_file.md5)
+        unlink(save_path)
+        return chromedriver_file.key, None
+
+    return chromedriver_file.key, chromedriver_file.etag
+
+
+def download_chromedriver(output_directory, base_url=CHROMEDRIVER_URL, versions=None, platforms=None, jobs=DEFAULT_DOWNLOAD_JOBS):
+    """ Mirror the chromedriver bucket (the files matching versions and platforms) into output_directory.
+
+    The listing is paged through once and saved as chromedriver.xml, files whose size and etag are unchanged
+    aren't downloaded again. Files are streamed to disk by a pool of jobs workers.
+    """
+    logger.info('Downloading chromedriver resources.')
+    make_directory(output_directory)
+
+    manifest_path = join(output_directory, CHROMEDRIVER_MANIFEST_NAME)
+    manifest = {}
+    if exists(manifest_path):
         try:
-            makedirs(dirname(save_path))
-        except oserror:
-            pass
-            # logger.exception("Error creating output directory for chrome driver version.")
+            with open(manifest_path, 'r') as f:
+                manifest = load(f)
+        except ValueError:
+            logger.warning('Ignoring corrupt chromedriver manifest: %s', manifest_path)
 
-        if exists(save_path):
-            logger.info("Using cached %s at %s", resource_url, save_path)
-            continue
+    session = create_session(jobs, CHROMEDRIVER_UPSTREAM)
+    pool = ThreadPool(jobs)
+    try:
+        listing = list_bucket(session, base_url)
+        chromedriver_files = select_chromedriver_files(listing, versions, platforms)
+        logger.info('Mirroring %d chromedriver files.', len(chromedriver_files))
+
+        register_namespace('', S3_NAMESPACE)
+        tmp_path = join(output_directory, CHROMEDRIVER_LISTING_NAME + '.tmp')
+        ElementTree(listing).write(tmp_path, encoding='UTF-8', xml_declaration=True)
+        rename(tmp_path, join(output_directory, CHROMEDRIVER_LISTING_NAME))
+
+        results = pool.map(lambda chromedriver_file: download_chromedriver_file(session, base_url, output_directory, chromedriver_file, manifest),
+                           chromedriver_files, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+        session.close()
+
+    for key, etag in results:
+        if etag is not None:
+            manifest[key] = etag
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        dump(manifest, f)
+    rename(tmp_path, manifest_path)
+
+
+class TarballDownload(object):
+    __slots__ = ['pkg_name', 'version', 'tarball_url', 'integrity', 'tgz_path']
+
+    def __init__(self, pkg_name, version, tarball_url, integrity, tgz_path):
+        self.pkg_name = pkg_name
+        self.version = version
+        self.tarball_url = tarball_url
+        self.integrity = integrity
+        self.tgz_path = tgz_path
+
+
+def create_session(pool_size=DEFAULT_DOWNLOAD_JOBS, rate=None):
+    """ Session whose per host connection pools can keep a connection alive for every worker.
+
+    Its requests are paced (and retried) by rate, the upstream registry's RateController by default.
+    """
+    session = RateControlledSession(rate if rate is not None else UPSTREAM)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-        logger.info("Downloading %s to %s", resource_url, save_path)
-        
-        downloaded = get(resource_url)
 
-        with open(save_path, 'wb') as f:
-            f.write(downloaded.content)
+def download_file(session, url, path, hashers=None):
+    """ Stream url to a temporary file next to path, renaming it into place once complete.
 
+    Every chunk is also fed to hashers ({algorithm: hash}) as it is written. A temporary file left by an
+    interrupted download is resumed with a Range request, when the server supports them.
+    """
+    tmp_path = path + '.part'
+    hashers = hashers or {}
+    offset = getsize(tmp_path) if exists(tmp_path) else 0
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+    response = session.get(url, stream=True, headers=headers)
 
-def download_node_dependencies(output_directory_base, specified_packages):
+    try:
+        if offset and (response.status_code == 416 or (response.status_code == 206 and
+                       not response.headers.get('Content-Range', '').startswith('bytes {0}-'.format(offset)))):
+            # the partial file doesn't fit what the server has, start over.
+            logger.info('Discarding partial download of %s', url)
+            response.close()
+            unlink(tmp_path)
+            return download_file(session, url, path, hashers)
+
+        response.raise_for_status()
+        if offset and response.status_code == 206:
+            logger.info('Resuming download of %s at byte %d', url, offset)
+            hash_file(tmp_path, hashers)
+            mode = 'ab'
+        else:
+            mode = 'wb'
+
+        with open(tmp_path, mode) as f:
+            for chunk in response.iter_content(BUF_SIZE):
+                f.write(chunk)
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+    finally:
+        response.close()
+
+    rename(tmp_path, path)
+
+
+def download_tarball(session, download, manifest, blobs=None):
+    integrity = download.integrity
+    digest = integrity.digest
+    # without an expected digest there is nothing to address the tarball by, it's only kept in tgz/.
+    blobs = blobs if digest is not None else None
+
+    if blobs is None:
+        return _download_tarball(session, download, manifest, None)
+    # identical tarballs of different packages are only downloaded once.
+    with blobs.lock(digest):
+        return _download_tarball(session, download, manifest, blobs)
+
+
+def _download_tarball(session, download, manifest, blobs):
+    integrity = download.integrity
+    digest = integrity.digest
+
+    if blobs is not None and blobs.has(digest):
+        logger.info('Stored package: %s version: %s at: %s', download.pkg_name, download.version, download.tarball_url)
+        blobs.link(digest, download.tgz_path)
+        return True
+
+    if exists(download.tgz_path):
+        if manifest.is_verified(download.tgz_path, digest) or not integrity.mismatches(hash_file(download.tgz_path, integrity.hashers())):
+            logger.info('Locally cached package: %s version: %s at: %s', download.pkg_name, download.version, download.tarball_url)
+            manifest.record(download.tgz_path, digest)
+            if blobs is not None:
+                blobs.adopt(download.tgz_path, digest)
+            return True
+
+    logger.info('Getting package: %s version: %s at: %s', download.pkg_name, download.version, download.tarball_url)
+
+    path = blobs.temporary_path(digest) if blobs is not None else download.tgz_path
+    attempt = 0
+    while True:
+        hashers = integrity.hashers()
+        try:
+            download_file(session, download.tarball_url, path, hashers)
+            break
+        except ChunkedEncodingError:
+            # the connection broke off mid body (failed requests are already retried), continue where it stopped.
+            if attempt >= UPSTREAM.retries:
+                logger.exception('Failed to download package: %s version: %s from: %s', download.pkg_name, download.version, download.tarball_url)
+                return False
+            sleep(UPSTREAM.backoff(attempt))
+            attempt += 1
+        except (RequestException, IOError, OSError):
+            logger.exception('Failed to download package: %s version: %s from: %s', download.pkg_name, download.version, download.tarball_url)
+            return False
+
+    mismatches = integrity.mismatches(hashers)
+    for algorithm, expected, actual in mismatches:
+        logger.warning('''Package %s from %s downloaded by %s hash: %s doesn't match expected hash: %s''', download.pkg_name, download.tarball_url, algorithm, actual, expected)
+
+    if mismatches:
+        manifest.discard(download.tgz_path)
+        if blobs is not None:
+            unlink(path)
+        return False
+
+    if blobs is not None:
+        blobs.add(path, digest)
+        blobs.link(digest, download.tgz_path)
+
+    manifest.record(download.tgz_path, digest)
+    return True
+
+
+def download_tarballs(downloads, jobs=DEFAULT_DOWNLOAD_JOBS, manifest_directory=None, blob_directory=None, journal=None):
+    """ Download tarballs with a pool of jobs workers sharing one session, returning the ones now available.
+
+    Verified files are recorded in a VerificationManifest kept in manifest_directory. With a blob_directory
+    tarballs are kept in a BlobStore there and linked into place, tarballs it already holds aren't downloaded.
+    Downloads completed by an interrupted run (journal) are skipped.
+    """
+    manifest = VerificationManifest(manifest_directory if manifest_directory is not None else getcwd())
+    blobs = BlobStore(blob_directory) if blob_directory is not None else None
+    session = create_session(jobs)
+    pool = ThreadPool(jobs)
+
+    def download_one(download):
+        if journal is not None and journal.is_downloaded(download.tgz_path) and exists(download.tgz_path):
+            return True
+        available = download_tarball(session, download, manifest, blobs)
+        if available and journal is not None:
+            journal.record_download(download.tgz_path)
+        return available
+
+    try:
+        results = pool.map(download_one, downloads, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+        session.close()
+        manifest.save()
+
+    return [download for download, available in zip(downloads, results) if available]
+
+
+def update_index(output_directory_base, store, packages, downloads):
+    index = CacheIndex(output_directory_base)
+    try:
+        for package in packages:
+            index.add_package(package.pkg_name, store.info_path(package.pkg_name))
+        for download in downloads:
+            index.add_tarball(download.pkg_name, download.version, download.tgz_path, download.integrity.digest)
+    finally:
+        index.close()
+
+
+def save_package_info(store, package, compile_url=None):
+    """ Prepare the package's tarball directory, compiling its (already stored) info when compile_url is given. """
+    info_path = store.info_path(package.pkg_name)
+    make_directory(store.tgz_directory(package.pkg_name))
+
+    if compile_url is not None and (package.modified or not is_compiled_current(info_path)):
+        compile_packument(info_path, compile_url)
+
+
+def fetch_packages(pkg_names, jobs=DEFAULT_RESOLVER_JOBS, store=None):
+    """ Fetch the package info of every name (no dependency resolution) into {name: Package}. """
+    pool = ThreadPool(jobs)
+    try:
+        fetched = pool.map(lambda pkg_name: fetch_package(pkg_name, store), pkg_names, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return dict((pkg_name, package) for pkg_name, package in fetched if package is not None)
+
+
+def download_node_dependencies(output_directory_base, specified_packages, compile_url=None, resolver_jobs=DEFAULT_RESOLVER_JOBS, download_jobs=DEFAULT_DOWNLOAD_JOBS, abbreviated=False, registry_url=REPOSITORY_URL, blob_directory=None):
     logger.info('Downloading node dependencies.')
 
-    required_packages = {}
-    for spec in packages:
-        crawl_package_info(required_packages, spec)
+    make_directory(output_directory_base)
+
+    store = PackumentStore(output_directory_base, abbreviated, registry_url)
+    journal = RunJournal(output_directory_base, {'specs': sorted(specified_packages), 'registry': registry_url, 'abbreviated': abbreviated})
+    required_packages = resolve_packages({}, specified_packages, resolver_jobs, store, journal)
 
     for package in required_packages.values():
-        if package.is_scoped:
-            scope, file_base = package.pkg_name.split('/', 1)
-            output_directory = join(output_directory_base, scope)
-        else:
-            file_base = package.pkg_name
-            output_directory = output_directory_base
-                    
-        info_path = join(output_directory, file_base) + '.json'
-        tgz_directory = join(output_directory, 'tgz')
+        save_package_info(store, package, compile_url)
+    downloads = resolved_downloads(store, required_packages.values())
 
-        try:
-            if not exists(tgz_directory):
-                makedirs(tgz_directory)
-        except oserror:
-            logger.exception("Error creating output directory.")
+    # validators are only saved once the packuments they describe are on disk.
+    store.save()
+    downloaded = download_tarballs(downloads, download_jobs, output_directory_base, blob_directory, journal)
+    update_index(output_directory_base, store, required_packages.values(), downloaded)
+    journal.finish()
 
-        with open(info_path, 'w') as f:
-            dump(package.info, f, indent=4)
+
+def resolved_downloads(store, packages):
+    """ The TarballDownloads of the required versions of resolved packages. """
+    downloads = []
+    for package in packages:
+        tgz_directory = store.tgz_directory(package.pkg_name)
 
         for version in package.required_versions:
             tarball_url = package.info['versions'][version]['dist']['tarball']
-            expected_shasum = package.info['versions'][version]['dist']['shasum']
+            integrity = Integrity.from_dist(package.info['versions'][version]['dist'])
             tgz_path = join(tgz_directory, basename(tarball_url))
+            downloads.append(TarballDownload(package.pkg_name, version, tarball_url, integrity, tgz_path))
+    return downloads
 
-            # print(package.pkg_name, version, tarball_url, expected_shasum)
 
-            if exists(tgz_path) and get_file_hash(tgz_path) == expected_shasum:
-                logger.info('Locally cached package: %s version: %s (latest: %s) at: %s', package.pkg_name, version, package.latest, tarball_url)
-            else:
-                logger.info('Getting package: %s version: %s (latest: %s) at: %s', package.pkg_name, version, package.latest, tarball_url)
+def registry_tarball_url(tarball_url, registry_url):
+    """ Point a tarball url from a public registry at registry_url instead (like npm's replace-registry-host). """
+    for public_url in PUBLIC_REGISTRY_URLS:
+        if tarball_url.startswith(public_url):
+            return registry_url + tarball_url[len(public_url):]
+    return tarball_url
 
-                tarball = get(tarball_url)
-                with open(tgz_path, 'wb') as f:
-                    f.write(tarball.content)
-
-                file_shasum = get_file_hash(tgz_path) if exists(tgz_path) else None
 
-                if not file_shasum == expected_shasum:
-                    logger.warning('''Package %s from %s downloaded by hash: %s doesn't match expected hash: %s''', package.pkg_name, tarball_url, file_shasum, expected_shasum)
+def download_locked_dependencies(output_directory_base, lockfile_paths, compile_url=None, resolver_jobs=DEFAULT_RESOLVER_JOBS, download_jobs=DEFAULT_DOWNLOAD_JOBS, abbreviated=False, registry_url=REPOSITORY_URL, blob_directory=None):
+    """ Download the tarballs pinned by lockfiles, no version resolution is needed.
+
+    Package infos are still fetched (conditionally) so that the server can answer metadata requests.
+    """
+    logger.info('Downloading locked node dependencies.')
+
+    make_directory(output_directory_base)
+
+    locked_packages = read_lockfiles(lockfile_paths)
+
+    store = PackumentStore(output_directory_base, abbreviated, registry_url)
+    journal = RunJournal(output_directory_base, {'lockfiles': sorted(lockfile_paths), 'registry': registry_url, 'abbreviated': abbreviated})
+    packages = fetch_packages(sorted(set(locked.name for locked in locked_packages)), resolver_jobs, store)
+
+    for package in packages.values():
+        save_package_info(store, package, compile_url)
+    store.save()
+
+    downloads = locked_downloads(store, locked_packages, registry_url)
+    for download in downloads:
+        make_directory(dirname(download.tgz_path))
+
+    downloaded = download_tarballs(downloads, download_jobs, output_directory_base, blob_directory, journal)
+    update_index(output_directory_base, store, packages.values(), downloaded)
+    journal.finish()
+
+
+def read_lockfiles(lockfile_paths):
+    locked_packages = []
+    for path in lockfile_paths:
+        locked = read_lockfile(path)
+        logger.info('Read %d locked packages from %s', len(locked), path)
+        locked_packages += locked
+    return locked_packages
+
+
+def locked_downloads(store, locked_packages, registry_url=REPOSITORY_URL):
+    """ The TarballDownloads of locked packages, once per tarball. """
+    downloads = {}
+    for locked in locked_packages:
+        tgz_path = join(store.tgz_directory(locked.name), basename(locked.resolved))
+        if tgz_path not in downloads:
+            tarball_url = registry_tarball_url(locked.resolved, registry_url)
+            downloads[tgz_path] = TarballDownload(locked.name, locked.version, tarball_url, Integrity.from_dist(locked.dist), tgz_path)
+    return list(downloads.values())
+
+
+class SyncReport(object):
+    """ What a sync changed in a cache, as sorted (name, version) pairs. """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.failed = []
+        self.unchanged = 0
+        self.removed_packages = []
+
+    def to_dict(self):
+        return {
+            'added': ['{0}@{1}'.format(name, version) for name, version in self.added],
+            'removed': ['{0}@{1}'.format(name, version) for name, version in self.removed],
+            'failed': ['{0}@{1}'.format(name, version) for name, version in self.failed],
+            'removed_packages': self.removed_packages,
+            'unchanged': self.unchanged,
+        }
+
+    def print_changes(self):
+        for sign, changes in (('+', self.added), ('-', self.removed), ('!', self.failed)):
+            for name, version in changes:
+                print('{0} {1}@{2}'.format(sign, name, version))
+        for name in self.removed_packages:
+            print('- {0}'.format(name))
+        logger.info('%d versions added, %d removed, %d failed, %d unchanged, %d packages removed.',
+                    len(self.added), len(self.removed), len(self.failed), self.unchanged, len(self.removed_packages))
+
+
+def indexed_tarballs(index):
+    """ {(name, version): index entry} of every tarball in a CacheIndex. """
+    return dict(((name, version), entry) for name in index.packages() for version, entry in index.versions(name).items())
+
+
+def sync_node_dependencies(output_directory_base, specified_packages=None, lockfile_paths=None, compile_url=None, resolver_jobs=DEFAULT_RESOLVER_JOBS, download_jobs=DEFAULT_DOWNLOAD_JOBS, abbreviated=False, registry_url=REPOSITORY_URL, blob_directory=None, prune=False, refresh=False, dry_run=False):
+    """ Bring a cache in line with a (new) package set, returning a SyncReport of what changed.
+
+    The graph is resolved from the stored packuments, upstream is only asked about packages the cache doesn't
+    hold (or whose stored versions can't satisfy a spec), every packument is revalidated with refresh. The resolved
+    versions are diffed against the cache's index and only the missing tarballs are downloaded. With prune the
+    versions (and packages) no longer required are removed from the cache, blobs are left to the store.
+    """
+    logger.info('Syncing node dependencies.')
+
+    make_directory(output_directory_base)
+    if not exists(index_path(output_directory_base)):
+        rebuild_index(output_directory_base)
+
+    store = PackumentStore(output_directory_base, abbreviated, registry_url, prefer_stored=not refresh)
+    if lockfile_paths:
+        locked_packages = read_lockfiles(lockfile_paths)
+        packages = fetch_packages(sorted(set(locked.name for locked in locked_packages)), resolver_jobs, store)
+        downloads = locked_downloads(store, locked_packages, registry_url)
+    else:
+        packages = resolve_packages({}, specified_packages, resolver_jobs, store)
+        downloads = resolved_downloads(store, packages.values())
+
+    index = CacheIndex(output_directory_base)
+    try:
+        cached = indexed_tarballs(index)
+        cached_packages = set(index.packages())
+    finally:
+        index.close()
+
+    report = SyncReport()
+    missing = []
+    for download in downloads:
+        entry = cached.get((download.pkg_name, download.version))
+        if entry is not None and entry['digest'] == download.integrity.digest and exists(join(output_directory_base, entry['path'])):
+            report.unchanged += 1
+        else:
+            missing.append(download)
+
+    required = set((download.pkg_name, download.version) for download in downloads)
+    required_packages = set(packages) | set(download.pkg_name for download in downloads)
+    stale = sorted(key for key in cached if key not in required) if prune else []
+    stale_packages = sorted(cached_packages - required_packages) if prune else []
+
+    if dry_run:
+        report.added = sorted((download.pkg_name, download.version) for download in missing)
+        report.removed = stale
+        report.removed_packages = stale_packages
+        return report
+
+    for package in packages.values():
+        save_package_info(store, package, compile_url)
+    for download in missing:
+        make_directory(dirname(download.tgz_path))
+
+    downloaded = download_tarballs(missing, download_jobs, output_directory_base, blob_directory)
+    report.added = sorted((download.pkg_name, download.version) for download in downloaded)
+    report.failed = sorted(set((download.pkg_name, download.version) for download in missing) - set(report.added))
+
+    index = CacheIndex(output_directory_base)
+    manifest = VerificationManifest(output_directory_base)
+    try:
+        for package in packages.values():
+            index.add_package(package.pkg_name, store.info_path(package.pkg_name))
+        for download in downloaded:
+            index.add_tarball(download.pkg_name, download.version, download.tgz_path, download.integrity.digest)
+
+        required_paths = set(download.tgz_path for download in downloads)
+        for name, version in stale:
+            tgz_path = join(output_directory_base, cached[(name, version)]['path'])
+            # a required version can share the file.
+            if tgz_path not in required_paths and exists(tgz_path):
+                unlink(tgz_path)
+                manifest.discard(tgz_path)
+            index.remove_tarball(name, version)
+        for name in stale_packages:
+            store.remove(name)
+            index.remove_package(name)
+    finally:
+        index.close()
+        manifest.save()
+
+    report.removed = stale
+    report.removed_packages = stale_packages
+    store.save()
+    return report
 
 
 def download_package(output_directory, spec, duplicate_download_preventer, force=False):
-    """ Download the package specified into the output directory specified. """
+    """ Download the package specified and its dependencies into the output directory specified. """
+    queue = deque([spec])
+    while queue:
+        queue.extend(_download_single_package(output_directory, queue.popleft(), duplicate_download_preventer, force))
+
+
+def _download_single_package(output_directory, spec, duplicate_download_preventer, force=False):
+    """ Download the package specified, returning the specs of its dependencies. """
 
     logger.info('Processing %s', spec)
 
@@ -332,21 +1043,13 @@ def download_package(output_directory, spec, duplicate_download_preventer, force
         logger.info("Version not specified, using latest (%s)", latest)
         version_spec = latest
 
-    # the python node-semver package doesn't work well with unicode, convert arguments to strings.
-    pkg_versions = [str(v) for v in info['versions'].keys()]
-    filtered_pkg_versions = [v for v in pkg_versions if lte(v, latest, False)]
-
     logger.info('Finding version (%s) up to latest(%s)', version_spec, latest)
 
-    download_version = max_satisfying(filtered_pkg_versions, str(version_spec))
-
-    if download_version is None:
-        logger.info('Version (%s) not found up to latest < latest(%s) trying all.', version_spec, latest)
-        download_version = max_satisfying(pkg_versions, str(version_spec))
+    download_version = VersionIndex(info['versions'].keys(), latest).max_satisfying(version_spec)
 
     if pkg_spec.registry_package_name in duplicate_download_preventer and download_version in duplicate_download_preventer[pkg_spec.registry_package_name]:
         logger.info('Previously downloaded package: %s, version %s', pkg_spec.registry_package_name, download_version)
-        return
+        return []
     
     # get information about the version the user wanted.
     version_info = info['versions'][download_version]
@@ -357,8 +1060,8 @@ def download_package(output_directory, spec, duplicate_download_preventer, force
 
     # derive paths for storing the cached json info document and the tarball. Scoped packages are special.
     if pkg_spec.is_scoped:
-        info_path = join(output_directory, 'scoped', pkg_spec.scope, pkg_spec.package_name) + '.json'
-        tgz_directory = join(output_directory, 'scoped', pkg_spec.scope, 'tgz')
+        info_path = join(output_directory, '@' + pkg_spec.scope, pkg_spec.package_name) + '.json'
+        tgz_directory = join(output_directory, '@' + pkg_spec.scope, 'tgz')
     else:
         info_path = join(output_directory, pkg_spec.package_name) + '.json'
         tgz_directory = join(output_directory, 'tgz')
@@ -384,7 +1087,7 @@ def download_package(output_directory, spec, duplicate_download_preventer, force
     else:
         logger.info('Getting package: %s version: %s (latest: %s) at: %s', pkg_spec.registry_package_name, download_version, latest, tarball_url)
 
-        tarball = get(tarball_url)
+        tarball = UPSTREAM.send(get, tarball_url)
         with open(tgz_path, 'wb') as f:
             f.write(tarball.content)
 
@@ -398,58 +1101,146 @@ def download_package(output_directory, spec, duplicate_download_preventer, force
         duplicate_download_preventer[pkg_spec.registry_package_name] = set()
     duplicate_download_preventer[pkg_spec.registry_package_name].add(download_version)    
 
-    # cache all package dependencies and optoinal dependencies.
-    logger.info('Processing dependencies: %s', pkg_spec.registry_package_name)
-    for dependency, version in version_info.get('dependencies', {}).items():
-        download_package(output_directory, dependency + '@' + version, duplicate_download_preventer, force)
-    
-    logger.info('Processing optional dependencies: %s', pkg_spec.registry_package_name)
-    for dependency, version in version_info.get('dependencies', {}).items():
-        download_package(output_directory, dependency + '@' + version, duplicate_download_preventer, force)
-    
+    # cache all package dependencies and optional dependencies.
+    dependencies = dict(version_info.get('dependencies', {}))
+    dependencies.update(version_info.get('optionalDependencies', {}))
+
     logger.info('Done with package: %s', pkg_spec.registry_package_name)
-    sleep(NICENESS)
+    return [dependency + '@' + version for dependency, version in dependencies.items()]
+
+
+def package_json_specs(path):
+    """ Specs of every (dev, optional) dependency in a package.json. """
+    with open(path, 'r') as f:
+        info = load(f)
+
+    packages = []
+    packages += [dependency + '@' + version for dependency, version in info.get('devDependencies', {}).items()]
+    packages += [dependency + '@' + version for dependency, version in info.get('dependencies', {}).items()]
+    packages += [dependency + '@' + version for dependency, version in info.get('optionalDependencies', {}).items()]
+    return packages
+
+
+def get_sync_args(argv=None):
+    parser = ArgumentParser(description='Sync the node packages of a cache directory with a new package set, fetching only what it is missing')
+    parser.add_argument('output_directory', help='Cache directory')
+    parser.add_argument('packages', type=str, nargs='+', help='packages to cache (space seperated)')
+    parser.add_argument('-p', '--package', help='packages argument is package.json formatted file.', default=False, action='store_true' )
+    parser.add_argument('-l', '--lockfile', help='packages arguments are package-lock.json, npm-shrinkwrap.json or yarn.lock files, cache exactly what they pin.', default=False, action='store_true' )
+    parser.add_argument('-n', '--noextras', help='don\'t include node extras (dependencies automatically gotten by node.', default=False, action='store_true' )
+    parser.add_argument('--prune', help='Remove cached versions (and packages) the package set no longer requires.', default=False, action='store_true')
+    parser.add_argument('--refresh', help='Revalidate every package info with upstream instead of resolving from the stored ones.', default=False, action='store_true')
+    parser.add_argument('--dry_run', help='Only report what would change.', default=False, action='store_true')
+    parser.add_argument('--report', help='Also write the changes to this JSON file.', default=None, type=str)
+    parser.add_argument('--resolver_jobs', help='Number of package infos to fetch concurrently.', default=DEFAULT_RESOLVER_JOBS, type=int)
+    parser.add_argument('-j', '--jobs', help='Number of tarballs to download concurrently.', default=DEFAULT_DOWNLOAD_JOBS, type=int)
+    parser.add_argument('--abbreviated', help='Cache abbreviated (install only) package metadata.', default=False, action='store_true')
+    parser.add_argument('--registry', help='Upstream npm registry url.', default=REPOSITORY_URL, type=str)
+    parser.add_argument('--rate', help='Initial upstream requests per second, adapted to how the upstream copes.', default=UPSTREAM.rate, type=float)
+    parser.add_argument('--max_rate', help='Upstream requests per second never exceeded.', default=UPSTREAM.max_rate, type=float)
+    parser.add_argument('--retries', help='Retries of failed (connection errors, timeouts, 429s and 5xxs) upstream requests.', default=UPSTREAM.retries, type=int)
+    parser.add_argument('--timeout', help='Upstream request timeout in seconds.', default=UPSTREAM.timeout, type=float)
+    parser.add_argument('--blob_store', help='Content addressed tarball store, share one between cache directories (default: <cache>/node/.blobs).', default=None, type=str)
+    parser.add_argument('--compile_url', help='Also compile packuments for a server at this node url (see "usnr --compile").', default=None, type=str)
+    parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+    return parser.parse_args(argv)
+
 
+def sync_main(argv=None):
+    basicConfig(level=INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    args = get_sync_args(argv)
+    if args.verbose:
+        getLogger('').setLevel(DEBUG)
+
+    args.registry = args.registry.rstrip('/') + '/'
+    UPSTREAM.configure(args.rate, args.max_rate, args.retries, args.timeout)
+    node_directory = join(args.output_directory, 'node')
+    blob_directory = args.blob_store if args.blob_store is not None else default_blob_directory(node_directory)
+
+    specs, lockfile_paths = None, None
+    if args.lockfile:
+        lockfile_paths = args.packages
+    else:
+        specs = package_json_specs(args.packages[0]) if args.package else args.packages
+        specs = specs if args.noextras else PACKAGES_NPM_REQUIRES + specs
+
+    report = sync_node_dependencies(node_directory, specs, lockfile_paths, args.compile_url, args.resolver_jobs, args.jobs, args.abbreviated, args.registry, blob_directory, args.prune, args.refresh, args.dry_run)
+    report.print_changes()
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            dump(report.to_dict(), f, indent=2, sort_keys=True)
 
-def get_args():
-    parser = ArgumentParser(description='Image Scraper')
+
+# picked with an option in front of the arguments, a cache directory can have any name.
+COMMANDS = {
+    '--compile': compile_main,
+    '--export': export_main,
+    '--import': import_main,
+    '--index': index_main,
+    '--sync': sync_main,
+}
+
+
+def get_args(argv=None):
+    parser = ArgumentParser(description='Image Scraper',
+                            epilog='Other commands, given first: {0} (e.g. usnr --sync -h).'.format(', '.join(sorted(COMMANDS))))
     parser.add_argument('output_directory', help='Output file')
     parser.add_argument('packages', type=str, nargs='+', help='packages to cache (space seperated)')
     parser.add_argument('--skip_chromedriver', help='Don\'t download chromedriver files.', default=False, action='store_true' )
     parser.add_argument('--skip_node', help='Don\'t download node dependencies.', default=False, action='store_true' )
     parser.add_argument('-p', '--package', help='packages argument is package.json formatted file.', default=False, action='store_true' )
+    parser.add_argument('-l', '--lockfile', help='packages arguments are package-lock.json, npm-shrinkwrap.json or yarn.lock files, cache exactly what they pin.', default=False, action='store_true' )
     parser.add_argument('-n', '--noextras', help='don\'t include node extras (dependencies automatically gotten by node.', default=False, action='store_true' )
+    parser.add_argument('--resolver_jobs', help='Number of package infos to fetch concurrently.', default=DEFAULT_RESOLVER_JOBS, type=int)
+    parser.add_argument('-j', '--jobs', help='Number of tarballs to download concurrently.', default=DEFAULT_DOWNLOAD_JOBS, type=int)
+    parser.add_argument('--abbreviated', help='Cache abbreviated (install only) package metadata.', default=False, action='store_true')
+    parser.add_argument('--registry', help='Upstream npm registry url.', default=REPOSITORY_URL, type=str)
+    parser.add_argument('--chromedriver_url', help='Upstream chromedriver bucket url.', default=CHROMEDRIVER_URL, type=str)
+    parser.add_argument('--rate', help='Initial upstream requests per second, adapted to how the upstream copes.', default=UPSTREAM.rate, type=float)
+    parser.add_argument('--max_rate', help='Upstream requests per second never exceeded.', default=UPSTREAM.max_rate, type=float)
+    parser.add_argument('--retries', help='Retries of failed (connection errors, timeouts, 429s and 5xxs) upstream requests.', default=UPSTREAM.retries, type=int)
+    parser.add_argument('--timeout', help='Upstream request timeout in seconds.', default=UPSTREAM.timeout, type=float)
+    parser.add_argument('--blob_store', help='Content addressed tarball store, share one between cache directories (default: <cache>/node/.blobs).', default=None, type=str)
+    parser.add_argument('--chromedriver_versions', help='Only mirror chromedriver versions matching these patterns (e.g. "2.4*").', nargs='*', default=None)
+    parser.add_argument('--chromedriver_platforms', help='Only mirror chromedriver archives for these platforms (e.g. linux64 win32).', nargs='*', default=None)
+    parser.add_argument('--compile_url', help='Also compile packuments for a server at this node url (see "usnr --compile").', default=None, type=str)
     parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
 
+def main(argv=None):
+    argv = sys_argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
 
-def main():
     basicConfig(level=INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 
-    args = get_args()
+    args = get_args(argv)
     if args.verbose:
         getLogger('').setLevel(DEBUG)
 
+    args.registry = args.registry.rstrip('/') + '/'
+    args.chromedriver_url = args.chromedriver_url.rstrip('/') + '/'
+    UPSTREAM.configure(args.rate, args.max_rate, args.retries, args.timeout)
+    CHROMEDRIVER_UPSTREAM.configure(args.rate, args.max_rate, args.retries, args.timeout)
+    blob_directory = args.blob_store if args.blob_store is not None else default_blob_directory(join(args.output_directory, 'node'))
+
     if not args.skip_chromedriver:
-        download_chromedriver(join(args.output_directory, 'chromedriver'))
+        download_chromedriver(join(args.output_directory, 'chromedriver'), args.chromedriver_url, args.chromedriver_versions, args.chromedriver_platforms, args.jobs)
     
-    if not args.skip_node:
+    if not args.skip_node and args.lockfile:
+        download_locked_dependencies(join(args.output_directory, 'node'), args.packages, args.compile_url, args.resolver_jobs, args.jobs, args.abbreviated, args.registry, blob_directory)
+
+    elif not args.skip_node:
         # if -p is specified, that means that instead of a list of packages via the command line,
         # a package.json format file has been specified.  We want to cache everything about it.
-        packages = []
-        if args.package:
-            with open(args.packages[0], 'r') as f:
-                info = load(f)
-                packages += [dependency + '@' + version for dependency, version in info.get('devDependencies', {}).items()]
-                packages += [dependency + '@' + version for dependency, version in info.get('dependencies', {}).items()]
-                packages += [dependency + '@' + version for dependency, version in info.get('optionalDependencies', {}).items()]
-        else:
-            packages = args.packages
+        packages = package_json_specs(args.packages[0]) if args.package else args.packages
 
         packages = packages if args.noextras else PACKAGES_NPM_REQUIRES + packages
 
-        download_node_dependencies(join(args.output_directory, 'node'), packages)
+        download_node_dependencies(join(args.output_directory, 'node'), packages, args.compile_url, args.resolver_jobs, args.jobs, args.abbreviated, args.registry, blob_directory)
 
 
 if __name__ == '__main__':
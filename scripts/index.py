@@ -0,0 +1,265 @@
+from argparse import ArgumentParser
+from json import load
+from logging import basicConfig, getLogger, DEBUG, INFO
+from os import getpid, stat
+from os.path import basename, dirname, exists, join, relpath
+from threading import Lock
+import sqlite3
+
+from compiler import iter_packument_paths
+from integrity import Integrity
+
+
+logger = getLogger(__name__)
+
+INDEX_NAME = '.index.sqlite'
+# SharedIndex reads the database through a memory map of up to this many bytes.
+MMAP_BYTES = 1024 * 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    info_path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tarballs (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    PRIMARY KEY (name, version)
+);
+CREATE INDEX IF NOT EXISTS tarballs_path ON tarballs (path);
+'''
+
+
+def index_path(node_directory):
+    return join(node_directory, INDEX_NAME)
+
+
+class CacheIndex(object):
+    """ SQLite index of a node cache directory: package -> versions -> tarball path, size and digest.
+
+    Paths are stored relative to the node directory. Maintained by usnr, read by the server through IndexSnapshot.
+    """
+
+    def __init__(self, node_directory):
+        self.node_directory = node_directory
+        self.connection = sqlite3.connect(index_path(node_directory))
+        self.connection.executescript(SCHEMA)
+
+    def _relative(self, path):
+        return relpath(path, self.node_directory)
+
+    def add_package(self, name, info_path):
+        self.connection.execute('INSERT OR REPLACE INTO packages (name, info_path) VALUES (?, ?)',
+                                (name, self._relative(info_path)))
+
+    def add_tarball(self, name, version, path, digest=None, size=None):
+        size = stat(path).st_size if size is None else size
+        self.connection.execute('INSERT OR REPLACE INTO tarballs (name, version, path, size, digest) VALUES (?, ?, ?, ?, ?)',
+                                (name, version, self._relative(path), size, digest))
+
+    def remove_tarball(self, name, version):
+        self.connection.execute('DELETE FROM tarballs WHERE name = ? AND version = ?', (name, version))
+
+    def remove_package(self, name):
+        self.connection.execute('DELETE FROM tarballs WHERE name = ?', (name,))
+        self.connection.execute('DELETE FROM packages WHERE name = ?', (name,))
+
+    def packages(self):
+        return [name for name, in self.connection.execute('SELECT name FROM packages ORDER BY name')]
+
+    def versions(self, name):
+        return dict((version, {'path': path, 'size': size, 'digest': digest}) for version, path, size, digest in
+                    self.connection.execute('SELECT version, path, size, digest FROM tarballs WHERE name = ?', (name,)))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM tarballs')
+        self.connection.execute('DELETE FROM packages')
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def rebuild_index(node_directory):
+    """ Recreate the index from the packuments and tarballs already on disk. """
+    index = CacheIndex(node_directory)
+    index.clear()
+
+    for info_path in iter_packument_paths(node_directory):
+        with open(info_path, 'r') as f:
+            info = load(f)
+
+        name = info.get('name')
+        if name is None:
+            logger.warning('Skipping %s, it has no package name.', info_path)
+            continue
+
+        index.add_package(name, info_path)
+        tgz_directory = join(dirname(info_path), 'tgz')
+
+        for version, version_info in info.get('versions', {}).items():
+            dist = version_info.get('dist', {})
+            if 'tarball' not in dist:
+                continue
+            tgz_path = join(tgz_directory, basename(dist['tarball']))
+            if exists(tgz_path):
+                index.add_tarball(name, version, tgz_path, Integrity.from_dist(dist).digest)
+
+    index.close()
+    logger.info('Rebuilt index at %s', index_path(node_directory))
+
+
+class IndexSnapshot(object):
+    """ In memory copy of a CacheIndex for the server, reloaded when the index file changes. """
+
+    def __init__(self, node_directory):
+        self.node_directory = node_directory
+        self.path = index_path(node_directory)
+        self.mtime = None
+        self.packages = {}
+        self.tarballs = {}
+
+    @property
+    def available(self):
+        return self.mtime is not None
+
+    def refresh(self):
+        try:
+            mtime = stat(self.path).st_mtime
+        except OSError:
+            self.mtime, self.packages, self.tarballs = None, {}, {}
+            return
+
+        if mtime == self.mtime:
+            return
+
+        packages = {}
+        tarballs = {}
+        connection = sqlite3.connect(self.path)
+        try:
+            for name, in connection.execute('SELECT name FROM packages'):
+                packages[name] = {}
+            for name, version, path, size, digest in connection.execute('SELECT name, version, path, size, digest FROM tarballs'):
+                packages.setdefault(name, {})[version] = {'path': path, 'size': size, 'digest': digest}
+                tarballs[path] = (name, version)
+        finally:
+            connection.close()
+
+        self.mtime, self.packages, self.tarballs = mtime, packages, tarballs
+        logger.info('Loaded index of %d packages and %d tarballs from %s', len(packages), len(tarballs), self.path)
+
+    def has_package(self, name):
+        return not self.available or name in self.packages
+
+    def has_tarball(self, path):
+        return not self.available or path in self.tarballs
+
+    def tarball_digest(self, path):
+        if path not in self.tarballs:
+            return None
+        name, version = self.tarballs[path]
+        return self.packages[name][version]['digest']
+
+
+class IndexPackages(object):
+    """ Read only {name: {version: {path, size, digest}}} view of an index database. """
+
+    def __init__(self, query):
+        self._query = query
+
+    def get(self, name, default=None):
+        if not self._query('SELECT 1 FROM packages WHERE name = ?', (name,)):
+            return default
+        return dict((version, {'path': path, 'size': size, 'digest': digest}) for version, path, size, digest in
+                    self._query('SELECT version, path, size, digest FROM tarballs WHERE name = ?', (name,)))
+
+    def __getitem__(self, name):
+        versions = self.get(name)
+        if versions is None:
+            raise KeyError(name)
+        return versions
+
+    def __contains__(self, name):
+        return bool(self._query('SELECT 1 FROM packages WHERE name = ?', (name,)))
+
+    def items(self):
+        packages = dict((name, {}) for name, in self._query('SELECT name FROM packages'))
+        for name, version, path, size, digest in self._query('SELECT name, version, path, size, digest FROM tarballs'):
+            packages.setdefault(name, {})[version] = {'path': path, 'size': size, 'digest': digest}
+        return packages.items()
+
+
+class SharedIndex(object):
+    """ IndexSnapshot for worker processes, answered by queries instead of a copy of the index in every worker.
+
+    The database is read through a memory map, so workers share the one copy in the page cache. usnr writes are
+    seen by the next query. Each process opens one connection, its request threads take turns on it.
+    """
+
+    def __init__(self, node_directory):
+        self.node_directory = node_directory
+        self.path = index_path(node_directory)
+        self.mtime = None
+        self.packages = IndexPackages(self._query)
+        self._connection = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            # a connection doesn't survive a fork, the server creates this before forking its workers.
+            if self._connection is None or self._pid != getpid():
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.execute('PRAGMA mmap_size = {0:d}'.format(MMAP_BYTES))
+                self._connection.execute('PRAGMA query_only = ON')
+                self._pid = getpid()
+            return self._connection.execute(sql, parameters).fetchall()
+
+    @property
+    def available(self):
+        return self.mtime is not None
+
+    def refresh(self):
+        try:
+            self.mtime = stat(self.path).st_mtime
+        except OSError:
+            self.mtime = None
+
+    def has_package(self, name):
+        return not self.available or name in self.packages
+
+    def has_tarball(self, path):
+        return not self.available or bool(self._query('SELECT 1 FROM tarballs WHERE path = ?', (path,)))
+
+    def tarball_digest(self, path):
+        if not self.available:
+            return None
+        rows = self._query('SELECT digest FROM tarballs WHERE path = ?', (path,))
+        return rows[0][0] if rows else None
+
+
+def get_args(argv=None):
+    parser = ArgumentParser(description='Rebuild the index of a cache directory')
+    parser.add_argument('cache_directory', help='Cache directory')
+    parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    basicConfig(level=INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    args = get_args(argv)
+    if args.verbose:
+        getLogger('').setLevel(DEBUG)
+
+    rebuild_index(join(args.cache_directory, 'node'))
+
+
+if __name__ == '__main__':
+    main()
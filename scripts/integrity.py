@@ -0,0 +1,128 @@
+from base64 import b64decode
+from binascii import hexlify
+from hashlib import new as new_hash
+from json import dump, load
+from logging import getLogger
+from os import rename, stat
+from os.path import exists, join, relpath
+from threading import Lock
+
+
+logger = getLogger(__name__)
+
+BUF_SIZE = 65536
+# strongest first, used to pick the digest recorded for a file.
+ALGORITHMS = ('sha512', 'sha384', 'sha256', 'sha1')
+MANIFEST_NAME = '.verified.json'
+
+
+class Integrity(object):
+    """ Expected digests of a tarball from its dist.shasum and dist.integrity (SRI) fields, as hex. """
+    __slots__ = ['digests']
+
+    def __init__(self, digests):
+        self.digests = digests
+
+    @classmethod
+    def from_dist(cls, dist):
+        digests = {}
+        if dist.get('shasum'):
+            digests['sha1'] = str(dist['shasum']).lower()
+
+        for entry in dist.get('integrity', '').split():
+            algorithm, _, value = entry.partition('-')
+            if algorithm in ALGORITHMS and value:
+                # options (?opt) are allowed after the digest, they carry no meaning for verification.
+                value = value.split('?', 1)[0]
+                try:
+                    # python 2 decodes what it can and drops the rest, a garbled value can decode to nothing.
+                    digest = hexlify(b64decode(value)).decode('ascii')
+                except (TypeError, ValueError):
+                    digest = None
+                if digest:
+                    digests[algorithm] = digest
+                else:
+                    logger.warning('Ignoring malformed integrity entry: %s', entry)
+
+        return cls(digests)
+
+    @property
+    def algorithm(self):
+        for algorithm in ALGORITHMS:
+            if algorithm in self.digests:
+                return algorithm
+        return None
+
+    @property
+    def digest(self):
+        """ Strongest expected digest, prefixed with its algorithm. """
+        algorithm = self.algorithm
+        return '{0}-{1}'.format(algorithm, self.digests[algorithm]) if algorithm is not None else None
+
+    def hashers(self):
+        return dict((algorithm, new_hash(algorithm)) for algorithm in self.digests)
+
+    def mismatches(self, hashers):
+        """ Return the (algorithm, expected, actual) triples that don't match. """
+        return [(algorithm, expected, hashers[algorithm].hexdigest()) for algorithm, expected in self.digests.items()
+                if hashers[algorithm].hexdigest() != expected]
+
+    def __str__(self):
+        return str(self.digest)
+
+
+def hash_file(path, hashers):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BUF_SIZE)
+            if not data:
+                break
+            for hasher in hashers.values():
+                hasher.update(data)
+    return hashers
+
+
+class VerificationManifest(object):
+    """ Size, mtime and digest of files already verified, so unchanged files aren't hashed again. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = join(directory, MANIFEST_NAME)
+        self.entries = {}
+        self._lock = Lock()
+
+        if exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = load(f)
+            except ValueError:
+                logger.warning('Ignoring corrupt verification manifest: %s', self.path)
+
+    def _key(self, path):
+        return relpath(path, self.directory)
+
+    def is_verified(self, path, digest):
+        entry = self.entries.get(self._key(path))
+        if entry is None or digest is None or entry['digest'] != digest:
+            return False
+        try:
+            st = stat(path)
+        except OSError:
+            return False
+        return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+    def record(self, path, digest):
+        st = stat(path)
+        with self._lock:
+            self.entries[self._key(path)] = {'size': st.st_size, 'mtime': st.st_mtime, 'digest': digest}
+
+    def discard(self, path):
+        with self._lock:
+            self.entries.pop(self._key(path), None)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                dump(self.entries, f)
+        rename(tmp_path, self.path)
@@ -0,0 +1,85 @@
+from json import dump, load
+from logging import getLogger
+from os import rename, unlink
+from os.path import exists, join, relpath
+from threading import Lock
+from time import time
+
+
+logger = getLogger(__name__)
+
+JOURNAL_NAME = '.journal.json'
+CHECKPOINT_INTERVAL = 5.0
+
+
+class RunJournal(object):
+    """ Checkpoints of a usnr run (resolved graph, pending specs, completed downloads) in the node directory.
+
+    A run started with the same arguments as an interrupted one resumes from its last checkpoint, the journal is
+    removed once the run finishes. Checkpoints are written at most every CHECKPOINT_INTERVAL seconds.
+    """
+
+    def __init__(self, node_directory, run):
+        self.node_directory = node_directory
+        self.path = join(node_directory, JOURNAL_NAME)
+        self.run = run
+        # {name: [versions]} and the specs still to resolve, pending is None until resolution has started.
+        self.resolved = {}
+        self.pending = None
+        self.completed = set()
+        self.resumed = False
+        self.last_saved = 0.0
+        self._lock = Lock()
+
+        if exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    journal = load(f)
+            except ValueError:
+                logger.warning('Ignoring corrupt journal: %s', self.path)
+                return
+
+            if journal.get('run') != run:
+                logger.info('Ignoring the journal of a different run: %s', self.path)
+                return
+
+            self.resolved = journal.get('resolved', {})
+            self.pending = journal.get('pending')
+            self.completed = set(journal.get('completed', []))
+            self.resumed = True
+            logger.info('Resuming run from %s: %d packages resolved, %d specs pending, %d downloads completed.',
+                        self.path, len(self.resolved), len(self.pending or []), len(self.completed))
+
+    def _key(self, path):
+        return relpath(path, self.node_directory)
+
+    def checkpoint_resolution(self, packages, pending, force=False):
+        """ Record resolved packages ({name: Package}) and the specs still pending, returning whether it was saved. """
+        if not force and time() - self.last_saved < CHECKPOINT_INTERVAL:
+            return False
+        with self._lock:
+            self.resolved = dict((name, sorted(package.required_versions)) for name, package in packages.items())
+            self.pending = list(pending)
+        self.save()
+        return True
+
+    def is_downloaded(self, path):
+        return self._key(path) in self.completed
+
+    def record_download(self, path):
+        with self._lock:
+            self.completed.add(self._key(path))
+        if time() - self.last_saved >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                dump({'run': self.run, 'resolved': self.resolved, 'pending': self.pending, 'completed': sorted(self.completed)}, f)
+            rename(tmp_path, self.path)
+            self.last_saved = time()
+
+    def finish(self):
+        if exists(self.path):
+            unlink(self.path)
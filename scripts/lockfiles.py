@@ -0,0 +1,115 @@
+from json import load
+from logging import getLogger
+from os.path import basename
+
+
+logger = getLogger(__name__)
+
+
+class LockedPackage(object):
+    __slots__ = ['name', 'version', 'resolved', 'dist']
+
+    def __init__(self, name, version, resolved, dist):
+        self.name = name
+        self.version = version
+        self.resolved = resolved
+        # shasum/integrity in the same shape as a packument's dist.
+        self.dist = dist
+
+    def __str__(self):
+        return '{0}(name={1.name}, version={1.version}, resolved={1.resolved})'.format(self.__class__.__name__, self)
+
+
+class UnsupportedLockfileError(RuntimeError):
+    pass
+
+
+def _is_fetchable(resolved):
+    return resolved is not None and (resolved.startswith('https://') or resolved.startswith('http://'))
+
+
+def _locked_package(name, version, resolved, integrity=None, shasum=None):
+    if not _is_fetchable(resolved):
+        logger.debug('Skipping %s@%s, not resolved to a registry tarball: %s', name, version, resolved)
+        return None
+
+    dist = {}
+    if integrity:
+        dist['integrity'] = integrity
+    if shasum:
+        dist['shasum'] = shasum
+    return LockedPackage(name, version, resolved, dist)
+
+
+def read_npm_lockfile(content):
+    """ Locked packages from a package-lock.json or npm-shrinkwrap.json (lockfileVersion 1, 2 or 3). """
+    locked = []
+
+    if 'packages' in content:
+        for path, entry in content['packages'].items():
+            if not path or entry.get('link') or entry.get('inBundle'):
+                continue
+            name = entry.get('name') or path.rsplit('node_modules/', 1)[-1]
+            package = _locked_package(name, entry.get('version'), entry.get('resolved'), entry.get('integrity'))
+            if package is not None:
+                locked.append(package)
+        return locked
+
+    pending = list(content.get('dependencies', {}).items())
+    while pending:
+        name, entry = pending.pop()
+        pending.extend(entry.get('dependencies', {}).items())
+        if entry.get('bundled'):
+            continue
+        package = _locked_package(name, entry.get('version'), entry.get('resolved'), entry.get('integrity'))
+        if package is not None:
+            locked.append(package)
+
+    return locked
+
+
+def _unquote(value):
+    value = value.strip()
+    return value[1:-1] if len(value) > 1 and value[0] == value[-1] == '"' else value
+
+
+def read_yarn_lockfile(lines):
+    """ Locked packages from a yarn (v1) yarn.lock. """
+    locked = []
+    entry = None
+
+    def finish(entry):
+        if entry is not None and 'resolved' in entry:
+            resolved, _, shasum = entry['resolved'].partition('#')
+            package = _locked_package(entry['name'], entry.get('version'), resolved, entry.get('integrity'), shasum)
+            if package is not None:
+                locked.append(package)
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+
+        if line.startswith('__metadata'):
+            raise UnsupportedLockfileError('Only yarn v1 lockfiles are supported.')
+
+        if not line[0].isspace():
+            finish(entry)
+            spec = _unquote(line.rstrip(':').split(',')[0])
+            entry = {'name': spec.rsplit('@', 1)[0] if spec.rfind('@') > 0 else spec}
+        elif entry is not None and line.startswith('  ') and not line.startswith('   '):
+            key, _, value = line.strip().partition(' ')
+            if value and not value.endswith(':'):
+                entry[_unquote(key)] = _unquote(value)
+
+    finish(entry)
+    return locked
+
+
+def read_lockfile(path):
+    if basename(path) == 'yarn.lock':
+        with open(path, 'r') as f:
+            return read_yarn_lockfile(f)
+
+    with open(path, 'r') as f:
+        return read_npm_lockfile(load(f))
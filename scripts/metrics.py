@@ -0,0 +1,222 @@
+from contextlib import contextmanager
+from json import dump, load
+from os import getpid, listdir, makedirs, rename, unlink
+from os.path import exists, join
+from threading import Lock, Thread
+from time import sleep, time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# how often a worker process writes its values for the others to sum.
+PUBLISH_INTERVAL = 1.0
+VALUES_PREFIX = 'metrics-'
+VALUES_SUFFIX = '.json'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    metric_type = None
+    # summed across worker processes.
+    shared = True
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = Lock()
+
+    def header(self):
+        return ['# HELP {0} {1}'.format(self.name, self.documentation), '# TYPE {0} {1}'.format(self.name, self.metric_type)]
+
+    def values(self):
+        """ [[label_values, value]] as JSON, for the other worker processes. """
+        with self._lock:
+            return [[list(label_values), value] for label_values, value in self._values.items()]
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    @staticmethod
+    def add(value, other):
+        return value + other
+
+    def render(self, values=None):
+        lines = self.header()
+        with self._lock:
+            values = dict(self._values) if values is None else values
+        for label_values, value in sorted(values.items()):
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Gauge(Metric):
+    """ A value read when rendered, from callback() -> {label_values: value}. """
+    metric_type = 'gauge'
+    shared = False
+
+    def __init__(self, name, documentation, callback, label_names=()):
+        super(Gauge, self).__init__(name, documentation, label_names)
+        self.callback = callback
+
+    def render(self):
+        lines = self.header()
+        for label_values, value in sorted(self.callback().items()):
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, label_values, value):
+        with self._lock:
+            counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def values(self):
+        with self._lock:
+            return [[list(label_values), [list(counts), total]] for label_values, (counts, total) in self._values.items()]
+
+    @staticmethod
+    def add(value, other):
+        return [count + other_count for count, other_count in zip(value[0], other[0])], value[1] + other[1]
+
+    @contextmanager
+    def time(self, label_values=()):
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(label_values, time() - start)
+
+    def render(self, values=None):
+        lines = self.header()
+        with self._lock:
+            values = dict((label_values, (list(counts), total)) for label_values, (counts, total) in self._values.items()) if values is None else values
+        for label_values, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(self.label_names, label_values, [('le', _format_value(bound))]), count))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), repr(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), counts[-1]))
+        return lines
+
+
+class Registry(object):
+    """ The metrics of a server.
+
+    Worker processes each count their own requests. Once shared (share(directory) before forking them) every
+    worker writes its values to a file in directory every PUBLISH_INTERVAL, and any of them sums the files when
+    scraped. Files of workers that exited are kept so that counters never go back. Gauges are read by the worker
+    answering the scrape.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self._publisher_pid = None
+        self._lock = Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory):
+        """ Sum the values of every worker process in directory, dropping those of an earlier run. """
+        self.directory = directory
+        if not exists(directory):
+            makedirs(directory)
+        for name in listdir(directory):
+            if name.startswith(VALUES_PREFIX):
+                unlink(join(directory, name))
+
+    def _values_path(self, pid):
+        return join(self.directory, '{0}{1:d}{2}'.format(VALUES_PREFIX, pid, VALUES_SUFFIX))
+
+    def publish(self):
+        """ Write this process's values for the others. """
+        path = self._values_path(getpid())
+        tmp_path = path + '.tmp'
+        # the background thread and a scrape both publish.
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                dump(dict((metric.name, metric.values()) for metric in self.metrics if metric.shared), f)
+            rename(tmp_path, path)
+
+    def _publish_forever(self):
+        while True:
+            sleep(PUBLISH_INTERVAL)
+            try:
+                self.publish()
+            except (IOError, OSError):
+                # the directory was removed, the next scrape of this worker reports the error.
+                pass
+
+    def start_publishing(self):
+        """ Publish in the background from this (worker) process, once shared. Cheap to call on every request. """
+        if self.directory is None or self._publisher_pid == getpid():
+            return
+        with self._lock:
+            # threads don't survive a fork, each worker starts its own.
+            if self._publisher_pid != getpid():
+                self._publisher_pid = getpid()
+                thread = Thread(target=self._publish_forever)
+                thread.daemon = True
+                thread.start()
+
+    def _summed_values(self):
+        self.publish()
+        adders = dict((metric.name, metric.add) for metric in self.metrics if metric.shared)
+        summed = dict((name, {}) for name in adders)
+        for name in listdir(self.directory):
+            if not (name.startswith(VALUES_PREFIX) and name.endswith(VALUES_SUFFIX)):
+                continue
+            try:
+                with open(join(self.directory, name)) as f:
+                    worker_values = load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            for metric_name, values in worker_values.items():
+                if metric_name not in adders:
+                    continue
+                metric_values = summed[metric_name]
+                for label_values, value in values:
+                    label_values = tuple(label_values)
+                    metric_values[label_values] = adders[metric_name](metric_values[label_values], value) if label_values in metric_values else value
+        return summed
+
+    def render(self):
+        summed = self._summed_values() if self.directory is not None else {}
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(summed[metric.name]) if metric.name in summed else metric.render())
+        return '\n'.join(lines) + '\n'
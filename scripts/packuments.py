@@ -0,0 +1,78 @@
+from json import load
+import re
+
+
+BUF_SIZE = 65536
+# all the resolver (and download) needs from a version.
+VERSION_FIELDS = ('name', 'version', 'dependencies', 'optionalDependencies', 'dist')
+PACKUMENT_FIELDS = ('name', 'dist-tags', 'versions')
+
+TARBALL_KEY = b'"tarball"'
+# "tarball": "<anything>/[@scope/]name/-/file" -> group 1 is the key, group 2 what follows the registry url.
+TARBALL_URL = re.compile(br'("tarball"\s*:\s*")[^"]*?/((?:@[^/"]+/)?[^/"]+/-/[^/"]+")')
+# a tarball field longer than this is malformed, don't hold the stream back for it.
+MAX_TARBALL_FIELD = 4096
+
+
+def _slim_object(pairs):
+    obj = dict(pairs)
+    if 'dist' in obj and 'version' in obj:
+        return dict((key, obj[key]) for key in VERSION_FIELDS if key in obj)
+    return obj
+
+
+def load_slim_packument(path):
+    """ Load only the fields of a packument the resolver needs (dist-tags and versions' dependencies and dist).
+
+    Versions are slimmed as soon as they are parsed, so readmes, per version package.json fields and the like
+    are never held all at once.
+    """
+    with open(path, 'rb') as f:
+        return read_slim_packument(f)
+
+
+def read_slim_packument(f):
+    """ load_slim_packument from an open file. """
+    content = load(f, object_pairs_hook=_slim_object)
+    return dict((key, content[key]) for key in PACKUMENT_FIELDS if key in content)
+
+
+def _split_point(buffer):
+    """ How much of buffer can be rewritten and sent, without cutting a tarball field in two. """
+    keep = len(buffer) - (len(TARBALL_KEY) - 1)
+    start = buffer.rfind(TARBALL_KEY)
+    if start != -1:
+        match = TARBALL_URL.match(buffer, start)
+        if match is not None:
+            return max(match.end(), keep)
+        if len(buffer) - start < MAX_TARBALL_FIELD:
+            return start
+    return max(0, keep)
+
+
+def rewrite_tarball_url_stream(chunks, node_url):
+    """ Rewrite the tarball urls of a serialized packument to node_url as it streams through, chunk by chunk. """
+    replacement = br'\g<1>' + node_url.encode('utf-8').replace(b'\\', b'\\\\') + br'\g<2>'
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        split = _split_point(buffer)
+        if split > 0:
+            yield TARBALL_URL.sub(replacement, buffer[:split])
+            buffer = buffer[split:]
+    if buffer:
+        yield TARBALL_URL.sub(replacement, buffer)
+
+
+def read_chunks(path, size=BUF_SIZE):
+    with open(path, 'rb') as f:
+        for data in iter_chunks(f, size):
+            yield data
+
+
+def iter_chunks(f, size=BUF_SIZE):
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        yield data
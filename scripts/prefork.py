@@ -0,0 +1,116 @@
+from errno import ECHILD, EINTR
+from logging import getLogger
+from os import _exit, fork, getpid, kill, waitpid
+from signal import signal, SIGINT, SIGTERM, SIG_DFL, SIG_IGN
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from threading import Thread, current_thread, enumerate as enumerate_threads
+from time import sleep
+from werkzeug.serving import make_server
+
+
+logger = getLogger(__name__)
+
+BACKLOG = 1024
+RESPAWN_DELAY = 1.0
+SHUTDOWN_GRACE = 30.0
+
+
+def _serve_worker(app, host, port, fd):
+    """ Run a threaded WSGI server on the inherited listening socket until SIGTERM. """
+    server = make_server(host, port, app, threaded=True, fd=fd)
+    # request threads are joined on shutdown so that in flight requests complete.
+    server.daemon_threads = False
+
+    def stop(signum, frame):
+        # shutdown blocks until serve_forever returns, which it can't do while this handler runs on its thread.
+        Thread(target=server.shutdown).start()
+
+    signal(SIGTERM, stop)
+    # Ctrl-C reaches the whole process group, the master stops the workers (gracefully) instead.
+    signal(SIGINT, SIG_IGN)
+
+    logger.info('Worker %d serving.', getpid())
+    server.serve_forever()
+    server.server_close()
+
+    for thread in enumerate_threads():
+        if thread is not current_thread() and not thread.daemon:
+            thread.join(SHUTDOWN_GRACE)
+    logger.info('Worker %d stopped.', getpid())
+
+
+class PreforkServer(object):
+    """ Serve app from a pool of forked worker processes sharing one listening socket.
+
+    The master only supervises: workers that die are replaced, SIGTERM/SIGINT stop every worker gracefully
+    (in flight requests complete) before the master exits.
+    """
+
+    def __init__(self, app, host, port, workers):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.children = set()
+        self.stopping = False
+        self.listener = None
+
+    def spawn(self):
+        pid = fork()
+        if pid == 0:
+            try:
+                signal(SIGTERM, SIG_DFL)
+                signal(SIGINT, SIG_IGN)
+                _serve_worker(self.app, self.host, self.port, self.listener.fileno())
+            except Exception:
+                logger.exception('Worker %d failed.', getpid())
+                _exit(1)
+            _exit(0)
+
+        self.children.add(pid)
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info('Stopping %d workers.', len(self.children))
+        for pid in list(self.children):
+            try:
+                kill(pid, SIGTERM)
+            except OSError:
+                self.children.discard(pid)
+
+    def serve_forever(self):
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(BACKLOG)
+
+        signal(SIGTERM, self.stop)
+        signal(SIGINT, self.stop)
+
+        logger.info('Serving on %s:%d with %d workers (master %d).', self.host, self.port, self.workers, getpid())
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == EINTR:
+                    continue
+                if e.errno == ECHILD:
+                    break
+                raise
+
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning('Worker %d exited with status %d, replacing it.', pid, status)
+                sleep(RESPAWN_DELAY)
+                if not self.stopping:
+                    self.spawn()
+
+        self.listener.close()
+        logger.info('Server stopped.')
@@ -0,0 +1,256 @@
+from logging import getLogger
+from os import rename, unlink
+from os.path import basename, dirname, exists, join
+from threading import Condition, Lock, Thread
+from uuid import uuid4
+
+from blobs import make_directory
+from downloader import create_session, registry_tarball_url
+from index import CacheIndex
+from integrity import Integrity
+from packuments import load_slim_packument
+from ratelimit import RateController
+
+
+logger = getLogger(__name__)
+
+BUF_SIZE = 65536
+DEFAULT_POOL_SIZE = 16
+# how long a waiting response sleeps without news from its fetch before checking it again.
+WAIT_TIMEOUT = 1.0
+
+
+class NotUpstreamError(RuntimeError):
+    pass
+
+
+class Fetch(object):
+    """ One upstream fetch into the cache. Any number of responses stream the file while it is being written. """
+
+    def __init__(self, path, tmp_path):
+        self.path = path
+        self.tmp_path = tmp_path
+        self.status = None
+        self.headers = {}
+        self.written = 0
+        self.done = False
+        self.failed = False
+        self._condition = Condition()
+
+    def started(self, status, headers):
+        with self._condition:
+            self.status = status
+            self.headers = headers
+            self._condition.notify_all()
+
+    def advance(self, size):
+        with self._condition:
+            self.written += size
+            self._condition.notify_all()
+
+    def finish(self, complete=None):
+        """ Mark the fetch done, complete() moves the file into place while no response can be opening it. """
+        with self._condition:
+            try:
+                if complete is not None:
+                    complete()
+            except Exception:
+                self.failed = True
+                raise
+            finally:
+                self.done = True
+                self._condition.notify_all()
+
+    def fail(self):
+        with self._condition:
+            self.failed = True
+            self.done = True
+            self._condition.notify_all()
+
+    def wait_started(self):
+        """ The upstream status (None when the request itself failed). """
+        with self._condition:
+            while self.status is None and not self.done:
+                self._condition.wait(WAIT_TIMEOUT)
+            return self.status
+
+    def wait(self):
+        """ Whether the fetch completed and the file is in the cache. """
+        with self._condition:
+            while not self.done:
+                self._condition.wait(WAIT_TIMEOUT)
+            return not self.failed
+
+    def chunks(self):
+        """ The file's content as it is written, ending once the fetch is done. """
+        with self._condition:
+            if self.failed:
+                raise IOError('Fetching {0} from upstream failed.'.format(self.path))
+            f = open(self.path if self.done else self.tmp_path, 'rb')
+        try:
+            position = 0
+            while True:
+                with self._condition:
+                    while position >= self.written and not self.done:
+                        self._condition.wait(WAIT_TIMEOUT)
+                    available, done, failed = self.written - position, self.done, self.failed
+
+                if failed:
+                    raise IOError('Fetching {0} from upstream failed.'.format(self.path))
+                if available <= 0 and done:
+                    break
+
+                while available > 0:
+                    data = f.read(min(available, BUF_SIZE))
+                    if not data:
+                        break
+                    position += len(data)
+                    available -= len(data)
+                    yield data
+        finally:
+            f.close()
+
+
+class PullThrough(object):
+    """ Fetch cache misses from an upstream registry into a node cache directory, as snr serves them.
+
+    Concurrent requests for the same file share one upstream fetch. Packuments are checked to parse and tarballs
+    verified against the integrity their packument lists before they take their place in the cache (tarballs
+    through the blob store) and the index.
+    """
+
+    def __init__(self, node_directory, upstream_url, blobs=None, rate=None, pool_size=DEFAULT_POOL_SIZE):
+        self.node_directory = node_directory
+        self.upstream_url = upstream_url
+        self.blobs = blobs
+        self.rate = rate if rate is not None else RateController()
+        self.pool_size = pool_size
+        self.fetches = {}
+        self._session = None
+        self._lock = Lock()
+        self._index_lock = Lock()
+
+    @property
+    def session(self):
+        # created on first use, in the (forked) process that uses it.
+        with self._lock:
+            if self._session is None:
+                self._session = create_session(self.pool_size, self.rate)
+            return self._session
+
+    def info_path(self, name):
+        return join(self.node_directory, name) + '.json'
+
+    def tgz_path(self, name, tarball):
+        scope = name.split('/', 1)[0] if name.startswith('@') else ''
+        return join(self.node_directory, scope, 'tgz', tarball)
+
+    def _fetch(self, path, url, tmp_path, hashers, complete):
+        """ The Fetch of path, started unless one is running. None when the file is in the cache already. """
+        with self._lock:
+            fetch = self.fetches.get(path)
+            if fetch is not None:
+                return fetch
+            if exists(path):
+                return None
+            fetch = self.fetches[path] = Fetch(path, tmp_path)
+
+        thread = Thread(target=self._run, args=(fetch, url, hashers, complete))
+        thread.daemon = True
+        thread.start()
+        return fetch
+
+    def _run(self, fetch, url, hashers, complete):
+        try:
+            make_directory(dirname(fetch.tmp_path))
+            with open(fetch.tmp_path, 'wb') as f:
+                response = self.session.get(url, stream=True)
+                try:
+                    logger.info('Pulling %s from %s, status: %d', fetch.path, url, response.status_code)
+                    fetch.started(response.status_code, response.headers)
+                    if response.status_code != 200:
+                        raise NotUpstreamError(url)
+
+                    for chunk in response.iter_content(BUF_SIZE):
+                        f.write(chunk)
+                        # visible to the responses reading the file before it is counted.
+                        f.flush()
+                        for hasher in hashers.values():
+                            hasher.update(chunk)
+                        fetch.advance(len(chunk))
+                finally:
+                    response.close()
+
+            fetch.finish(lambda: complete(fetch.tmp_path, hashers))
+        except NotUpstreamError:
+            fetch.fail()
+        except Exception:
+            logger.exception('Failed to pull %s from %s', fetch.path, url)
+            fetch.fail()
+        finally:
+            if exists(fetch.tmp_path):
+                unlink(fetch.tmp_path)
+            with self._lock:
+                self.fetches.pop(fetch.path, None)
+
+    def packument(self, name):
+        """ The Fetch of the packument of name, None when it is in the cache already. """
+        info_path = self.info_path(name)
+
+        def complete(tmp_path, hashers):
+            # a truncated or garbled document never replaces the cached one.
+            load_slim_packument(tmp_path)
+            rename(tmp_path, info_path)
+            with self._index_lock:
+                index = CacheIndex(self.node_directory)
+                try:
+                    index.add_package(name, info_path)
+                finally:
+                    index.close()
+
+        url = self.upstream_url + name.replace('/', '%2f')
+        return self._fetch(info_path, url, '{0}.{1}.part'.format(info_path, uuid4().hex), {}, complete)
+
+    def tarball(self, name, tarball):
+        """ The Fetch of a tarball of name, None when it is in the cache already.
+
+        The packument is pulled first when needed, tarballs it doesn't list raise NotUpstreamError.
+        """
+        info_path = self.info_path(name)
+        if not exists(info_path):
+            fetch = self.packument(name)
+            if fetch is not None and not fetch.wait():
+                raise NotUpstreamError(name)
+
+        for version, version_info in load_slim_packument(info_path).get('versions', {}).items():
+            dist = version_info.get('dist', {})
+            if basename(dist.get('tarball', '')) == tarball:
+                break
+        else:
+            raise NotUpstreamError('{0}/-/{1}'.format(name, tarball))
+
+        tgz_path = self.tgz_path(name, tarball)
+        integrity = Integrity.from_dist(dist)
+        digest = integrity.digest
+        blobs = self.blobs if digest is not None else None
+
+        def complete(tmp_path, hashers):
+            mismatches = integrity.mismatches(hashers)
+            if mismatches:
+                raise ValueError('{0} does not match its integrity: {1}'.format(dist['tarball'], mismatches))
+            make_directory(dirname(tgz_path))
+            if blobs is not None:
+                blobs.add(tmp_path, digest)
+                blobs.link(digest, tgz_path)
+            else:
+                rename(tmp_path, tgz_path)
+            with self._index_lock:
+                index = CacheIndex(self.node_directory)
+                try:
+                    index.add_tarball(name, version, tgz_path, digest)
+                finally:
+                    index.close()
+
+        tmp_path = blobs.temporary_path() if blobs is not None else '{0}.{1}.part'.format(tgz_path, uuid4().hex)
+        url = registry_tarball_url(dist['tarball'], self.upstream_url)
+        return self._fetch(tgz_path, url, tmp_path, integrity.hashers(), complete)
@@ -0,0 +1,144 @@
+from email.utils import mktime_tz, parsedate_tz
+from logging import getLogger
+from random import random
+from requests import Session
+from requests.exceptions import ConnectionError, Timeout
+from threading import Lock
+from time import sleep, time
+
+
+logger = getLogger(__name__)
+
+DEFAULT_RATE = 50.0
+DEFAULT_MAX_RATE = 1000.0
+MIN_RATE = 0.5
+BURST = 10.0
+# requests per second added per second of successful requests, the rate is halved on a 429 or 5xx.
+ADDITIVE_INCREASE = 5.0
+MULTIPLICATIVE_DECREASE = 0.5
+# concurrent failures of one overload only count once.
+DECREASE_INTERVAL = 1.0
+DEFAULT_RETRIES = 4
+DEFAULT_TIMEOUT = 30.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (delay seconds or an http date), None when absent or invalid. """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    return max(0.0, mktime_tz(parsed) - time()) if parsed is not None else None
+
+
+def is_throttled(response):
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class RateController(object):
+    """ Request rate, retry and timeout policy for one upstream, shared by every thread talking to it.
+
+    A token bucket paces requests. Its rate grows additively while requests succeed and is cut multiplicatively on
+    429s and 5xxs (AIMD), a Retry-After pauses every request until it has passed.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.retries = retries
+        self.timeout = timeout
+        self.tokens = BURST
+        self.updated = time()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self._lock = Lock()
+
+    def configure(self, rate=None, max_rate=None, retries=None, timeout=None):
+        with self._lock:
+            self.rate = rate if rate is not None else self.rate
+            self.max_rate = max_rate if max_rate is not None else self.max_rate
+            self.retries = retries if retries is not None else self.retries
+            self.timeout = timeout if timeout is not None else self.timeout
+
+    def acquire(self):
+        """ Block until a request may be sent. """
+        while True:
+            with self._lock:
+                now = time()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    self.tokens = min(BURST, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE / self.rate)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            now = time()
+            if now - self.last_decrease >= DECREASE_INTERVAL:
+                self.rate = max(MIN_RATE, self.rate * MULTIPLICATIVE_DECREASE)
+                self.last_decrease = now
+                logger.info('Upstream is throttling, reduced the request rate to %.1f/s', self.rate)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def backoff(self, attempt):
+        """ Exponential backoff with jitter before retry attempt (0 based). """
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * (0.5 + random() / 2)
+
+    def send(self, send_request, url, **kwargs):
+        """ send_request(url, **kwargs) paced by the rate, retrying connection errors, timeouts, 429s and 5xxs.
+
+        The last response is returned once retries are exhausted, the last error raised.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = send_request(url, **kwargs)
+            except (ConnectionError, Timeout):
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning('Request to %s failed, retrying in %.1fs', url, delay, exc_info=True)
+            else:
+                if not is_throttled(response):
+                    self.success()
+                    return response
+
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                self.throttled(retry_after)
+                if attempt >= self.retries:
+                    return response
+                response.close()
+                # Retry-After already pauses every request through the rate.
+                delay = self.backoff(attempt) if retry_after is None else 0
+                logger.warning('Request to %s returned %d, retrying in %.1fs', url, response.status_code, delay)
+
+            attempt += 1
+            if delay:
+                sleep(delay)
+
+
+class RateControlledSession(Session):
+    """ Session whose requests are sent through a RateController. """
+
+    def __init__(self, rate):
+        super(RateControlledSession, self).__init__()
+        self.rate = rate
+
+    def request(self, method, url, **kwargs):
+        return self.rate.send(lambda url, **kwargs: super(RateControlledSession, self).request(method, url, **kwargs), url, **kwargs)
@@ -1,14 +1,69 @@
 from __future__ import print_function
 from argparse import ArgumentParser
-from flask import Flask, jsonify, request, send_from_directory
-from json import load
+from cProfile import Profile
+from collections import deque
+from flask import Flask, abort, g, jsonify, request, send_file, send_from_directory, stream_with_context
+from json import dumps, load, loads
 from logging.config import dictConfig
-from os.path import join
+from mimetypes import guess_type
+from os import getpid, kill, makedirs, stat
+from os.path import basename, exists, getmtime, join
+from signal import SIGTERM
 from socket import gethostname
+from tarfile import BLOCKSIZE, TarInfo
+from tempfile import gettempdir
+from time import time
 from urllib import unquote
+from werkzeug.wsgi import ClosingIterator, wrap_file
+import re
+
+from blobs import BlobStore, blob_directory
+from bundle import BundleSet, is_bundle
+from cache import DEFAULT_CACHE_BYTES, PackumentCache, SharedPackumentCache, default_shared_directory
+from compiler import cached_tarballs, compiled_path, filter_cached_versions, is_compiled_current, read_manifest, rewrite_tarball_urls, tgz_directory_for
+from index import IndexSnapshot, SharedIndex
+from lockfiles import UnsupportedLockfileError, read_npm_lockfile, read_yarn_lockfile
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Counter, Gauge, Histogram, Registry
+from packuments import iter_chunks, read_chunks, read_slim_packument, rewrite_tarball_url_stream
+from prefork import PreforkServer
+from pullthrough import NotUpstreamError, PullThrough
+from ratelimit import RateController
 
 app = Flask(__name__)
 
+PACKUMENT_MAX_AGE = 300
+TARBALL_MAX_AGE = 365 * 24 * 60 * 60
+BULK_MEDIA_TYPE = 'application/x-ndjson'
+DEFAULT_STREAM_BYTES = 32 * 1024 * 1024
+# name or @scope/name, url safe characters only (legacy names can have capitals), never a path outside the cache.
+PACKAGE_NAME = re.compile(r"^(?:@[A-Za-z0-9_~!*'()-][A-Za-z0-9._~!*'()-]*/)?[A-Za-z0-9_~!*'()-][A-Za-z0-9._~!*'()-]*$")
+BULK_BODY_ERROR = 'The body is not a JSON list of names, a package.json, a package-lock.json or a yarn.lock.'
+
+
+def packument_cache_stats():
+    cache = app.config.get('PACKUMENT_CACHE')
+    if cache is None:
+        return {}
+    return {
+        ('hit',): cache.hits,
+        ('miss',): cache.misses,
+    }
+
+
+def packument_cache_bytes():
+    cache = app.config.get('PACKUMENT_CACHE')
+    return {(): cache.current_bytes} if cache is not None else {}
+
+
+metrics = Registry()
+REQUESTS = metrics.register(Counter('snr_requests_total', 'Requests handled.', ('endpoint', 'method', 'status')))
+REQUEST_SECONDS = metrics.register(Histogram('snr_request_seconds', 'Time to produce a response.', ('endpoint',)))
+PACKUMENT_PHASE_SECONDS = metrics.register(Histogram('snr_packument_phase_seconds', 'Time spent building packument bodies.', ('phase',)))
+BYTES_SERVED = metrics.register(Counter('snr_bytes_served_total', 'Response body bytes served.', ('endpoint',)))
+NOT_FOUND = metrics.register(Counter('snr_not_found_total', 'Requests for packages that are not cached.', ('package',)))
+PACKUMENT_CACHE_LOOKUPS = metrics.register(Gauge('snr_packument_cache_lookups', 'Packument cache lookups since start.', packument_cache_stats, ('result',)))
+PACKUMENT_CACHE_BYTES = metrics.register(Gauge('snr_packument_cache_bytes', 'Bytes held by the packument cache.', packument_cache_bytes))
+
 # examples of non-scoped and scoped urls
 # https://registry.npmjs.org/vue
 # https://registry.npmjs.org/vue/-/vue-2.5.16.tgz
@@ -18,6 +73,7 @@ app = Flask(__name__)
 
 dictConfig({
     'version': 1,
+    'disable_existing_loggers': False,
     'formatters': {'default': {
         'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
     }},
@@ -33,34 +89,429 @@ dictConfig({
 })
 
 
+def open_cached(path):
+    """ Open a cached file, a member of the served bundles in bundle mode. """
+    bundles = app.config['BUNDLES']
+    return bundles.open(path) if bundles is not None else open(path, 'rb')
+
+
+def stat_cached(path):
+    bundles = app.config['BUNDLES']
+    return bundles.stat(path) if bundles is not None else stat(path)
+
+
+def is_cached(path):
+    bundles = app.config['BUNDLES']
+    return bundles.exists(path) if bundles is not None else exists(path)
+
+
+def read_cached_chunks(path):
+    with open_cached(path) as f:
+        for data in iter_chunks(f):
+            yield data
+
+
 def load_json_info(path_to_json):
     # Q&D
-    with open(path_to_json, 'r') as f:
-        content = load(f)
+    with PACKUMENT_PHASE_SECONDS.time(('load',)):
+        with open_cached(path_to_json) as f:
+            content = load(f)
+
+    if app.config['FILTER_VERSIONS']:
+        with PACKUMENT_PHASE_SECONDS.time(('filter',)):
+            filter_cached_versions(content, cached_versions(path_to_json, content.get('name')))
 
-    if u'versions' in content:
-        for version in content['versions'].values():
-            if u'dist' in version and u'tarball' in version['dist']:
-                version['dist']['tarball']= version['dist']['tarball'].replace('https://registry.npmjs.org/', app.config['NODE_URL'])
-                version['dist']['tarball']= version['dist']['tarball'].replace('http://registry.npmjs.org/', app.config['NODE_URL'])
-    return content
+    with PACKUMENT_PHASE_SECONDS.time(('rewrite',)):
+        return rewrite_tarball_urls(content, app.config['NODE_URL'])
+
+
+def cached_versions(path_to_json, name):
+    index = app.config['INDEX']
+    if index.available:
+        indexed_versions = index.packages.get(name, {})
+        return lambda version, tarball_name: version in indexed_versions
+    return cached_tarballs(path_to_json)
+
+
+def packument_token(path_to_json):
+    """ What the filtered packument depends on besides its own mtime, the mtime of the index or tarball directory. """
+    if not app.config['FILTER_VERSIONS']:
+        return None
+    if app.config['INDEX'].available:
+        return app.config['INDEX'].mtime
+
+    try:
+        return getmtime(tgz_directory_for(path_to_json))
+    except OSError:
+        return None
+
+
+def build_json_body(path_to_json):
+    content = load_json_info(path_to_json)
+    with PACKUMENT_PHASE_SECONDS.time(('serialize',)):
+        return dumps(content, separators=(',', ':')).encode('utf-8')
+
+
+def serves_compiled(path_to_json):
+    # compiled documents are always filtered against the tarballs on disk.
+    return app.config['SERVE_COMPILED'] and app.config['FILTER_VERSIONS'] and is_compiled_current(path_to_json)
+
+
+def compiled_response(path_to_json):
+    if not serves_compiled(path_to_json):
+        return None
+
+    path = compiled_path(path_to_json)
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accept_encoding and exists(path + suffix):
+            response = send_file(path + suffix, mimetype='application/json', cache_timeout=PACKUMENT_MAX_AGE, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype='application/json', cache_timeout=PACKUMENT_MAX_AGE, conditional=True)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def streamed_response(path_to_json, st):
+    """ Send a large packument with its tarball urls rewritten on the fly, it is never parsed or held in memory.
+
+    Versions aren't filtered, compile large packuments (usnr --compile) to serve them filtered.
+    """
+    response = app.response_class(rewrite_tarball_url_stream(read_cached_chunks(path_to_json), app.config['NODE_URL']), mimetype='application/json')
+    response.set_etag('{0:x}-{1:x}'.format(int(st.st_mtime * 1000000), st.st_size))
+    response.last_modified = st.st_mtime
+    response.cache_control.public = True
+    response.cache_control.max_age = PACKUMENT_MAX_AGE
+    return response.make_conditional(request)
+
+
+def packument_response(path_to_json):
+    response = compiled_response(path_to_json)
+    if response is not None:
+        return response
+
+    st = stat_cached(path_to_json)
+    if st.st_size > app.config['STREAM_BYTES']:
+        return streamed_response(path_to_json, st)
+
+    entry = app.config['PACKUMENT_CACHE'].get(path_to_json, build_json_body, packument_token(path_to_json), st.st_mtime)
+
+    if entry.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = app.response_class(entry.gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        # a strong etag has to differ between encodings of the same document.
+        response.set_etag(entry.etag + '-gzip')
+    else:
+        response = app.response_class(entry.body, mimetype='application/json')
+        response.set_etag(entry.etag)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    # the filtered body changes with the tarballs on disk (the token's mtime) as well.
+    response.last_modified = max(entry.mtime, entry.token or 0)
+    response.cache_control.public = True
+    response.cache_control.max_age = PACKUMENT_MAX_AGE
+    return response.make_conditional(request)
+
+
+def packument_chunks(path_to_json):
+    """ The (uncompressed) body a GET of the packument sends, in chunks. """
+    if serves_compiled(path_to_json):
+        return read_chunks(compiled_path(path_to_json))
+    st = stat_cached(path_to_json)
+    if st.st_size > app.config['STREAM_BYTES']:
+        return rewrite_tarball_url_stream(read_cached_chunks(path_to_json), app.config['NODE_URL'])
+    return [app.config['PACKUMENT_CACHE'].get(path_to_json, build_json_body, packument_token(path_to_json), st.st_mtime).body]
+
+
+def packument_path(name):
+    return join(app.config['NODE_CACHE_DIRECTORY'], name) + '.json'
+
+
+def is_package_name(name):
+    return isinstance(name, (type(u''), str)) and PACKAGE_NAME.match(name) is not None and '..' not in name
+
+
+def bulk_package_names(body):
+    """ Package names from a bulk request body: a JSON list of names, a package.json, a package-lock.json or a yarn.lock.
+
+    Anything else, or anything that isn't a valid package name, aborts with a 400.
+    """
+    try:
+        content = loads(body)
+    except ValueError:
+        try:
+            locked = read_yarn_lockfile(body.decode('utf-8').splitlines())
+        except UnsupportedLockfileError:
+            abort(400, 'Only yarn v1 lockfiles are supported, not the yarn berry (v2+) format.')
+        except ValueError:
+            locked = []
+        if not locked:
+            abort(400, BULK_BODY_ERROR)
+        names = sorted(set(package.name for package in locked))
+    else:
+        try:
+            if isinstance(content, list):
+                names = content
+            elif not isinstance(content, dict):
+                abort(400, BULK_BODY_ERROR)
+            elif 'lockfileVersion' in content:
+                names = sorted(set(package.name for package in read_npm_lockfile(content)))
+            else:
+                names = set()
+                for field in ('dependencies', 'devDependencies', 'optionalDependencies', 'peerDependencies'):
+                    names.update(content.get(field) or {})
+                names = sorted(names)
+        except (AttributeError, TypeError):
+            # a lockfile or package.json of the wrong shape.
+            abort(400, BULK_BODY_ERROR)
+
+    for name in names:
+        if not is_package_name(name):
+            abort(400, 'Not a package name: {0!r}'.format(name))
+    return names
+
+
+def dependency_names(path_to_json, name):
+    """ Names of the packages the served versions of a packument depend on. """
+    with open_cached(path_to_json) as f:
+        info = read_slim_packument(f)
+    is_cached = cached_versions(path_to_json, name) if app.config['FILTER_VERSIONS'] else lambda version, tarball_name: True
+
+    names = set()
+    for version, version_info in info.get('versions', {}).items():
+        if is_cached(version, basename(version_info.get('dist', {}).get('tarball', ''))):
+            names.update(version_info.get('dependencies', {}))
+            names.update(version_info.get('optionalDependencies', {}))
+    return names
+
+
+def iter_bulk_packuments(names, dependencies=False):
+    """ (name, path to json) of every cached package named, then (with dependencies) of what they depend on. """
+    index = node_index()
+    pending = deque(names)
+    seen = set(names)
+
+    while pending:
+        name = pending.popleft()
+        path_to_json = packument_path(name)
+        if not index.has_package(name) or not is_cached(path_to_json):
+            NOT_FOUND.inc((name,))
+            yield name, None
+            continue
+
+        yield name, path_to_json
+
+        if dependencies:
+            for dependency in sorted(dependency_names(path_to_json, name) - seen):
+                seen.add(dependency)
+                if is_package_name(dependency):
+                    pending.append(dependency)
+                else:
+                    app.logger.warning('Ignoring invalid dependency name %r of %s', dependency, name)
+
+
+def ndjson_bulk(packuments):
+    for name, path_to_json in packuments:
+        if path_to_json is None:
+            yield dumps({'name': name, 'error': 'not_found'}).encode('utf-8') + b'\n'
+            continue
+        for chunk in packument_chunks(path_to_json):
+            # JSON strings can't hold raw newlines, whitespace ones can go.
+            yield chunk.replace(b'\n', b'').replace(b'\r', b'')
+        yield b'\n'
+
+
+def tar_bulk(packuments):
+    for name, path_to_json in packuments:
+        if path_to_json is None:
+            continue
+        body = b''.join(packument_chunks(path_to_json))
+        info = TarInfo(name + '.json')
+        info.size = len(body)
+        info.mtime = int(stat_cached(path_to_json).st_mtime)
+        yield info.tobuf()
+        yield body
+        yield b'\0' * (-len(body) % BLOCKSIZE)
+    yield b'\0' * (2 * BLOCKSIZE)
+
+
+@app.route('/node/-/bulk', methods=['POST'])
+def get_bulk_package_infos():
+    """ The packuments of every package named in the body, in one streamed response.
+
+    The body is a JSON list of names, a package.json, a package-lock.json or a yarn.lock. Packuments are sent one
+    per line (NDJSON, packages that aren't cached get an error line) or, with ?format=tar, as <name>.json members
+    of a tar. ?dependencies=true adds the cached packages they depend on, transitively, to warm up everything an
+    install will ask for.
+    """
+    names = bulk_package_names(request.get_data())
+    dependencies = request.args.get('dependencies', 'false').lower() in ('1', 'true', 'yes', 'on')
+    packuments = iter_bulk_packuments(names, dependencies)
+
+    if request.args.get('format') == 'tar':
+        return app.response_class(stream_with_context(tar_bulk(packuments)), mimetype='application/x-tar')
+    return app.response_class(stream_with_context(ndjson_bulk(packuments)), mimetype=BULK_MEDIA_TYPE)
+
+
+def bundle_member_response(member, mimetype):
+    """ Send a member of the served bundles, uncompressed ones straight from their memory map. """
+    bundles = app.config['BUNDLES']
+    if not bundles.exists(member):
+        abort(404)
+
+    st = bundles.stat(member)
+    response = app.response_class(wrap_file(request.environ, bundles.open(member)), mimetype=mimetype, direct_passthrough=True)
+    response.content_length = st.st_size
+    response.last_modified = st.st_mtime
+    return response
+
+
+def tarball_response(directory, tarball, index_path):
+    """ Send a tarball with long lived caching headers, conditional and range request support. """
+    digest = node_index().tarball_digest(index_path)
+    blobs = app.config['BLOB_STORE']
+
+    if app.config['BUNDLES'] is not None:
+        response = bundle_member_response('node/' + index_path.replace('\\', '/'), guess_type(tarball)[0])
+    elif digest is not None and blobs.has(digest):
+        # the index maps the tarball to its blob, no lookup in a (possibly huge) tgz directory needed.
+        response = send_file(blobs.path(digest), mimetype=guess_type(tarball)[0], add_etags=False, cache_timeout=TARBALL_MAX_AGE, conditional=False)
+    else:
+        response = send_from_directory(directory, tarball, add_etags=digest is None, cache_timeout=TARBALL_MAX_AGE, conditional=False)
+    if digest is not None:
+        response.set_etag(digest)
+    # tarballs for a version never change.
+    response.headers['Cache-Control'] = 'public, max-age={0}, immutable'.format(TARBALL_MAX_AGE)
+
+    return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+
+
+def pulled_response(fetch, mimetype, rewrite=False):
+    """ Stream a file as it is pulled from upstream, 404 when upstream doesn't have it either. """
+    status = fetch.wait_started()
+    if status != 200:
+        abort(404 if status == 404 else 502)
+
+    chunks = fetch.chunks()
+    response = app.response_class(stream_with_context(rewrite_tarball_url_stream(chunks, app.config['NODE_URL']) if rewrite else chunks), mimetype=mimetype)
+    if not rewrite and 'Content-Length' in fetch.headers and 'Content-Encoding' not in fetch.headers:
+        response.content_length = int(fetch.headers['Content-Length'])
+    return response
+
+
+def package_info_response(name, path_to_json):
+    if not is_package_name(name):
+        abort(404)
+    pull = app.config['PULL_THROUGH']
+    if pull is not None and not exists(path_to_json):
+        try:
+            fetch = pull.packument(name)
+        except NotUpstreamError:
+            abort(404)
+        # concurrent requests for it stream the same fetch, None when it landed in the meantime.
+        if fetch is not None:
+            return pulled_response(fetch, 'application/json', rewrite=True)
+    elif not node_index().has_package(name) or not is_cached(path_to_json):
+        abort(404)
+    return packument_response(path_to_json)
+
+
+def package_tgz_response(name, directory, tarball, index_path):
+    if not is_package_name(name):
+        abort(404)
+    pull = app.config['PULL_THROUGH']
+    if pull is not None and not exists(join(directory, tarball)):
+        try:
+            fetch = pull.tarball(name, tarball)
+        except NotUpstreamError:
+            abort(404)
+        if fetch is not None:
+            return pulled_response(fetch, guess_type(tarball)[0])
+    elif not node_index().has_tarball(index_path):
+        abort(404)
+    return tarball_response(directory, tarball, index_path)
+
+
+@app.before_request
+def start_request():
+    g.request_start = time()
+    metrics.start_publishing()
+    if app.config.get('PROFILE', False):
+        g.profiler = Profile()
+        g.profiler.enable()
+
+
+def counted_chunks(chunks, endpoint):
+    for chunk in chunks:
+        BYTES_SERVED.inc((endpoint,), len(chunk))
+        yield chunk
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(join(app.config['PROFILE_DIRECTORY'], '{0}-{1:.6f}-{2}.prof'.format(endpoint, g.request_start, getpid())))
+
+    REQUESTS.inc((endpoint, request.method, str(response.status_code)))
+    REQUEST_SECONDS.observe((endpoint,), time() - g.request_start)
+    if response.content_length is not None:
+        # HEAD responses send no body.
+        BYTES_SERVED.inc((endpoint,), response.content_length if request.method != 'HEAD' else 0)
+    else:
+        # streamed bodies are counted as they are sent.
+        response.response = ClosingIterator(counted_chunks(response.response, endpoint), getattr(response.response, 'close', None))
+
+    if response.status_code == 404 and request.view_args and 'package' in request.view_args:
+        package = request.view_args['package']
+        NOT_FOUND.inc(('{0}/{1}'.format(request.view_args['scope'], package) if 'scope' in request.view_args else unquote(package),))
+
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype=METRICS_CONTENT_TYPE)
+
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def profile():
+    """ Turn per request profiling on or off (POST enabled=true|false), stats are written to PROFILE_DIRECTORY.
+
+    With --workers the setting only applies to the worker process that handled the POST.
+    """
+    if request.method == 'POST':
+        app.config['PROFILE'] = request.values.get('enabled', 'true').lower() in ('1', 'true', 'yes', 'on')
+        if app.config['PROFILE'] and not exists(app.config['PROFILE_DIRECTORY']):
+            makedirs(app.config['PROFILE_DIRECTORY'])
+        app.logger.info('Profiling %s, writing to %s', 'enabled' if app.config['PROFILE'] else 'disabled', app.config['PROFILE_DIRECTORY'])
+    return jsonify(enabled=app.config.get('PROFILE', False), directory=app.config['PROFILE_DIRECTORY'])
+
+
+def node_index():
+    index = app.config['INDEX']
+    index.refresh()
+    return index
 
 
 @app.route('/node/<string:package>')
 def get_package_info(package):
     package = unquote(package)
     app.logger.info("Getting: %s", package)
-    path_to_json = join(app.config['NODE_CACHE_DIRECTORY'], package) + '.json'
-    info = load_json_info(path_to_json)
-    return jsonify(info)
+    return package_info_response(package, join(app.config['NODE_CACHE_DIRECTORY'], package) + '.json')
 
 
 @app.route('/node/<string:scope>/<string:package>')
 def get_scoped_package_info(scope, package):
     app.logger.info("Getting: @%s/%s", scope, package)
-    path_to_json = join(app.config['NODE_CACHE_DIRECTORY'], scope, package) + '.json'
-    info = load_json_info(path_to_json)
-    return jsonify(info)
+    return package_info_response('{0}/{1}'.format(scope, package), join(app.config['NODE_CACHE_DIRECTORY'], scope, package) + '.json')
 
 
 @app.route('/node/<string:package>/-/<string:tarball>')
@@ -68,22 +519,45 @@ def get_package_tgz(package, tarball):
     package = unquote(package)
     path_to_tarballs = join(app.config['NODE_CACHE_DIRECTORY'], 'tgz')
     app.logger.info('getting package %s from %s', package, path_to_tarballs)
-    return send_from_directory(path_to_tarballs, tarball)
+    return package_tgz_response(package, path_to_tarballs, tarball, join('tgz', tarball))
 
 
 @app.route('/node/<string:scope>/<string:package>/-/<string:tarball>')
 def get_scoped_package_tgz(scope, package, tarball):
     path_to_tarballs = join(app.config['NODE_CACHE_DIRECTORY'], scope,  'tgz')
+    return package_tgz_response('{0}/{1}'.format(scope, package), path_to_tarballs, tarball, join(scope, 'tgz', tarball))
+
 
-    return send_from_directory(path_to_tarballs, tarball)
+@app.route('/index/node')
+def get_node_index():
+    index = node_index()
+    if not index.available:
+        abort(404)
+    return jsonify(dict((name, sorted(versions)) for name, versions in index.packages.items()))
+
+
+@app.route('/index/node/<path:package>')
+def get_node_package_index(package):
+    index = node_index()
+    package = unquote(package)
+    if not index.available or package not in index.packages:
+        abort(404)
+    return jsonify(index.packages[package])
 
 
 @app.route('/chromedriver/<path:path>')
 def get_chromedriver_file(path):
+    if app.config['BUNDLES'] is not None:
+        return bundle_member_response('chromedriver/' + path, guess_type(path)[0])
     return send_from_directory(app.config['CHROMEDRIVER_CACHE_DIRECTORY'], path)
 
 
 def shutdown_server():
+    if app.config.get('MASTER_PID') is not None:
+        # prefork mode, the master stops every worker gracefully.
+        kill(app.config['MASTER_PID'], SIGTERM)
+        return
+
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
         raise RuntimeError('Not running with the Werkzeug Server')
@@ -98,9 +572,20 @@ def shutdown():
 
 def get_args():
     parser = ArgumentParser(description='Offline Server (node, chromedriver, etc)')
-    parser.add_argument('cache_directory', help='Cache directory')
+    parser.add_argument('cache_directory', help='Cache directory, or a bundle (.zip) exported by "usnr --export" to serve directly')
+    parser.add_argument('--delta', help='Serve this delta bundle on top of the bundle (repeat them in the order they were exported)', default=[], action='append')
     parser.add_argument('--host', help='Host', default='0.0.0.0', type=str)
     parser.add_argument('--port', help='Port', default=16000, type=int)
+    parser.add_argument('--cache_size', help='Packument cache budget in megabytes', default=DEFAULT_CACHE_BYTES // (1024 * 1024), type=int)
+    parser.add_argument('--gzip', help='Keep gzipped copies of cached packuments', default=False, action='store_true')
+    parser.add_argument('-w', '--workers', help='Serve with this many worker processes (pre-forked, threaded) instead of the development server', default=1, type=int)
+    parser.add_argument('--shared_directory', help='Where worker processes share cached packuments, in shared memory (default: a directory in /dev/shm)', default=None, type=str)
+    parser.add_argument('--profile_directory', help='Where per request profiles are written when profiling is enabled', default=join(gettempdir(), 'snr-profiles'), type=str)
+    parser.add_argument('--all_versions', help='Serve every version in the packuments, not just the cached ones', default=False, action='store_true')
+    parser.add_argument('--stream_size', help='Packuments larger than this many megabytes are streamed (unfiltered) instead of parsed', default=DEFAULT_STREAM_BYTES // (1024 * 1024), type=int)
+    parser.add_argument('--blob_store', help='Content addressed tarball store used by usnr (default: <cache>/node/.blobs)', default=None, type=str)
+    parser.add_argument('--upstream', help='Pull packages that aren\'t cached from this registry into the cache as they are requested (implies --all_versions)', default=None, type=str)
+    parser.add_argument('--upstream_rate', help='Initial requests per second to the upstream registry, adapted to how it copes', default=RateController().rate, type=float)
     parser.add_argument('-v', '--verbose', help='Verbose log output', default=False, action='store_true')
     return parser.parse_args()
 
@@ -108,12 +593,49 @@ def get_args():
 def main():
     args = get_args()
     app.config['CACHE_DIRECTORY'] = args.cache_directory
-    app.config['NODE_CACHE_DIRECTORY'] = join(args.cache_directory, 'node')
-    app.config['CHROMEDRIVER_CACHE_DIRECTORY'] = join(args.cache_directory, 'chromedriver')
+    app.config['BUNDLES'] = BundleSet([args.cache_directory] + args.delta) if is_bundle(args.cache_directory) else None
+    # bundle members are named like the paths in a cache directory, relative to its root.
+    cache_root = args.cache_directory if app.config['BUNDLES'] is None else ''
+    app.config['NODE_CACHE_DIRECTORY'] = join(cache_root, 'node')
+    app.config['CHROMEDRIVER_CACHE_DIRECTORY'] = join(cache_root, 'chromedriver')
     app.config['HOST'] = args.host
     app.config['PORT'] = args.port
     app.config['NODE_URL'] = new_url = '{0}://{1}:{2}/node/'.format('http', app.config['HOST'], app.config['PORT'])
     app.config['CHROMEDRIVER_URL'] = new_url = '{0}://{1}:{2}/chromedriver/'.format('http', app.config['HOST'], app.config['PORT'])
+    if args.workers > 1:
+        # workers share one copy of packument bodies and the index instead of holding their own.
+        shared_directory = args.shared_directory if args.shared_directory is not None else default_shared_directory(args.cache_directory)
+        app.config['PACKUMENT_CACHE'] = SharedPackumentCache(shared_directory, args.cache_size * 1024 * 1024, args.gzip)
+        app.logger.info('Sharing packuments between workers in %s', shared_directory)
+        # /metrics sums the counts of every worker, whichever answers it.
+        metrics.share(join(shared_directory, 'metrics'))
+    else:
+        app.config['PACKUMENT_CACHE'] = PackumentCache(args.cache_size * 1024 * 1024, args.gzip)
+    # pulled packages can't be filtered, their tarballs are only fetched once asked for.
+    app.config['FILTER_VERSIONS'] = not args.all_versions and args.upstream is None
+    app.config['STREAM_BYTES'] = args.stream_size * 1024 * 1024
+    app.config['PROFILE_DIRECTORY'] = args.profile_directory
+    if app.config['BUNDLES'] is not None:
+        app.config['INDEX'] = app.config['BUNDLES']
+    elif args.workers > 1:
+        app.config['INDEX'] = SharedIndex(app.config['NODE_CACHE_DIRECTORY'])
+    else:
+        app.config['INDEX'] = IndexSnapshot(app.config['NODE_CACHE_DIRECTORY'])
+    app.config['BLOB_STORE'] = BlobStore(args.blob_store if args.blob_store is not None else blob_directory(app.config['NODE_CACHE_DIRECTORY']))
+    app.config['INDEX'].refresh()
+    app.config['PULL_THROUGH'] = None
+    if args.upstream is not None:
+        if app.config['BUNDLES'] is not None:
+            raise ValueError('Bundles are read only, they can\'t be served with --upstream.')
+        app.config['PULL_THROUGH'] = PullThrough(app.config['NODE_CACHE_DIRECTORY'], args.upstream.rstrip('/') + '/', app.config['BLOB_STORE'], RateController(args.upstream_rate))
+        app.logger.info('Pulling packages that aren\'t cached from %s', args.upstream)
+
+    # bundles don't carry compiled packuments.
+    manifest = read_manifest(app.config['NODE_CACHE_DIRECTORY']) if app.config['BUNDLES'] is None else None
+    app.config['SERVE_COMPILED'] = manifest is not None and manifest.get('url') == app.config['NODE_URL']
+    if manifest is not None and not app.config['SERVE_COMPILED']:
+        app.logger.warning('Compiled packuments target %s, not %s. Run "usnr --compile %s --url %s" to use them.',
+                           manifest.get('url'), app.config['NODE_URL'], args.cache_directory, app.config['NODE_URL'])
 
 
     app.logger.info('Serving directory: %s', app.config['CACHE_DIRECTORY'])
@@ -130,6 +652,11 @@ def main():
                     app.config['NODE_URL'],
                     app.config['CHROMEDRIVER_URL'])
 
+    if args.workers > 1:
+        app.config['MASTER_PID'] = getpid()
+        PreforkServer(app, args.host, args.port, args.workers).serve_forever()
+        return
+
     #app.run(ssl_context='adhoc')
     app.run(
         debug=args.verbose,
@@ -0,0 +1,63 @@
+from bisect import bisect_right
+from logging import getLogger
+from semver import full_key_function, make_range, make_semver
+
+
+logger = getLogger(__name__)
+
+
+class VersionIndex(object):
+    """ A package's versions, parsed once and sorted, with resolved ranges memoized.
+
+    Ranges resolve to the highest satisfying version up to latest, falling back to versions newer than latest.
+    """
+
+    def __init__(self, versions, latest):
+        parsed = []
+        for version in versions:
+            # the python node-semver package doesn't work well with unicode, convert arguments to strings.
+            try:
+                parsed.append(make_semver(str(version), False))
+            except ValueError:
+                logger.debug('Skipping invalid version: %s', version)
+
+        parsed.sort(key=full_key_function)
+        self.versions = parsed
+        self.keys = [full_key_function(version) for version in parsed]
+
+        try:
+            self.latest_end = bisect_right(self.keys, full_key_function(make_semver(str(latest), False)))
+        except ValueError:
+            self.latest_end = len(self.versions)
+
+        self._resolved = {}
+
+    def _highest_satisfying(self, version_range, start, end):
+        for i in range(end - 1, start - 1, -1):
+            if version_range.test(self.versions[i]):
+                return self.versions[i].raw
+        return None
+
+    def max_satisfying(self, version_spec):
+        version_spec = str(version_spec)
+        if version_spec in self._resolved:
+            return self._resolved[version_spec]
+
+        try:
+            version_range = make_range(version_spec, False)
+        except Exception:
+            version_range = None
+
+        resolved = None
+        if version_range is not None:
+            resolved = self._highest_satisfying(version_range, 0, self.latest_end)
+
+            if resolved is None:
+                logger.debug('Version (%s) not found up to latest, trying newer versions.', version_spec)
+                resolved = self._highest_satisfying(version_range, self.latest_end, len(self.versions))
+
+        self._resolved[version_spec] = resolved
+        return resolved
+
+    def __len__(self):
+        return len(self.versions)
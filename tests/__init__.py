@@ -0,0 +1,12 @@
+""" Tests, run from the repository root: python -m unittest discover -s tests -t . """
+from logging import NullHandler, getLogger
+from os.path import abspath, dirname, join
+import sys
+
+# the scripts import each other as top level modules.
+SCRIPTS_DIRECTORY = join(dirname(dirname(abspath(__file__))), 'scripts')
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIRECTORY)
+
+# python 2 complains about loggers without handlers (e.g. warnings the tests provoke).
+getLogger().addHandler(NullHandler())
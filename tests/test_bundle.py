@@ -0,0 +1,131 @@
+from base64 import b64encode
+from hashlib import sha512
+from json import dump, dumps, loads
+from os import makedirs
+from os.path import dirname, exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+from zipfile import ZipFile
+
+from bundle import BUNDLE_MANIFEST_NAME, BundleSequenceError, BundleSet, export_bundle, import_bundle, read_imported_id
+from index import CacheIndex, rebuild_index
+
+
+def write_file(path, data):
+    if not exists(dirname(path)):
+        makedirs(dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def add_package(cache_directory, name, versions):
+    """ Write name's packument and a tarball for each version to the cache. """
+    scope, _, base_name = name.rpartition('/')
+    node_directory = join(cache_directory, 'node')
+    packument = {'name': name, 'dist-tags': {'latest': versions[-1]}, 'versions': {}}
+    for version in versions:
+        tarball = '{0}-{1}.tgz'.format(base_name, version)
+        data = '{0}@{1}'.format(name, version).encode('utf-8')
+        write_file(join(node_directory, scope, 'tgz', tarball), data)
+        packument['versions'][version] = {'name': name, 'version': version, 'dist': {
+            'tarball': 'https://registry.npmjs.org/{0}/-/{1}'.format(name, tarball),
+            'integrity': 'sha512-' + b64encode(sha512(data).digest()).decode('ascii'),
+        }}
+    write_file(join(node_directory, name) + '.json', dumps(packument).encode('utf-8'))
+
+
+class BundleTests(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.source = join(self.directory, 'source')
+        add_package(self.source, 'a', ['1.0.0', '1.1.0'])
+        add_package(self.source, '@scope/b', ['2.0.0'])
+        write_file(join(self.source, 'chromedriver', '2.40', 'chromedriver_linux64.zip'), b'chromedriver')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def assert_same_files(self, destination, paths):
+        for path in paths:
+            self.assertEqual(read_file(join(destination, path)), read_file(join(self.source, path)), path)
+
+    def test_round_trip(self):
+        bundle_path = join(self.directory, 'full.zip')
+        manifest = export_bundle(self.source, bundle_path)
+        destination = join(self.directory, 'destination')
+        import_bundle(destination, bundle_path)
+
+        self.assert_same_files(destination, ['node/a.json', 'node/tgz/a-1.0.0.tgz', 'node/tgz/a-1.1.0.tgz',
+                                             'node/@scope/b.json', 'node/@scope/tgz/b-2.0.0.tgz',
+                                             'chromedriver/2.40/chromedriver_linux64.zip'])
+        self.assertEqual(read_imported_id(join(destination, 'node')), manifest['id'])
+
+        index = CacheIndex(join(destination, 'node'))
+        try:
+            self.assertEqual(sorted(index.packages()), ['@scope/b', 'a'])
+            self.assertEqual(sorted(index.versions('a')), ['1.0.0', '1.1.0'])
+            self.assertTrue(index.versions('@scope/b')['2.0.0']['digest'].startswith('sha512-'))
+        finally:
+            index.close()
+
+    def test_delta(self):
+        full_path = join(self.directory, 'full.zip')
+        export_bundle(self.source, full_path)
+        add_package(self.source, 'a', ['1.0.0', '1.1.0', '1.2.0'])
+        # as usnr does when it caches.
+        rebuild_index(join(self.source, 'node'))
+        delta_path = join(self.directory, 'delta.zip')
+        delta = export_bundle(self.source, delta_path, full_path)
+
+        with ZipFile(delta_path, 'r') as bundle:
+            self.assertEqual(sorted(bundle.namelist()), sorted([BUNDLE_MANIFEST_NAME, 'node/a.json', 'node/tgz/a-1.2.0.tgz']))
+
+        destination = join(self.directory, 'destination')
+        self.assertRaises(BundleSequenceError, import_bundle, destination, delta_path)
+        import_bundle(destination, full_path)
+        import_bundle(destination, delta_path)
+        self.assert_same_files(destination, ['node/a.json', 'node/tgz/a-1.2.0.tgz', 'node/@scope/tgz/b-2.0.0.tgz'])
+        self.assertEqual(read_imported_id(join(destination, 'node')), delta['id'])
+
+        # served straight from the bundles, newest first.
+        bundles = BundleSet([full_path, delta_path])
+        self.assertTrue(bundles.has_package('@scope/b'))
+        self.assertTrue(bundles.has_tarball('tgz/a-1.2.0.tgz'))
+        for member in ('node/a.json', 'node/tgz/a-1.2.0.tgz', 'node/@scope/tgz/b-2.0.0.tgz'):
+            with bundles.open(member) as f:
+                self.assertEqual(f.read(), read_file(join(self.source, member)), member)
+
+    def test_paths_outside_the_cache_are_rejected(self):
+        bundle_path = join(self.directory, 'full.zip')
+        manifest = export_bundle(self.source, bundle_path)
+        destination = join(self.directory, 'destination')
+
+        for member in ('node/../../escaped', 'chromedriver/../../../escaped', 'node/tgz/../../../escaped'):
+            evil_path = join(self.directory, 'evil.zip')
+            with ZipFile(evil_path, 'w') as bundle:
+                bundle.writestr(BUNDLE_MANIFEST_NAME, dumps(manifest))
+                bundle.writestr(member, b'x')
+            self.assertRaises(ValueError, import_bundle, destination, evil_path)
+
+        evil_manifest = loads(dumps(manifest))
+        evil_manifest['packages']['a']['versions']['1.0.0']['path'] = '../../escaped.tgz'
+        with ZipFile(evil_path, 'w') as bundle:
+            bundle.writestr(BUNDLE_MANIFEST_NAME, dumps(evil_manifest))
+        self.assertRaises(ValueError, import_bundle, destination, evil_path)
+
+        self.assertFalse(exists(join(self.directory, 'escaped')))
+        self.assertFalse(exists('/escaped'))
+
+    def test_members_outside_node_and_chromedriver_are_ignored(self):
+        bundle_path = join(self.directory, 'full.zip')
+        manifest = export_bundle(self.source, bundle_path)
+        with ZipFile(bundle_path, 'a') as bundle:
+            bundle.writestr('../escaped', b'x')
+        import_bundle(join(self.directory, 'destination'), bundle_path)
+        self.assertFalse(exists(join(self.directory, 'escaped')))
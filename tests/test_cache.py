@@ -0,0 +1,31 @@
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from cache import PackumentCache, SharedPackumentCache
+
+
+class PackumentCacheStatsTests(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = join(self.directory, 'pkg.json')
+        with open(self.path, 'wb') as f:
+            f.write(b'{"name":"pkg"}' + b' ' * 100)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def lookups(self, cache):
+        builder = lambda path: open(path, 'rb').read()
+        for _ in range(3):
+            self.assertEqual(cache.get(self.path, builder).body, builder(self.path))
+        return cache.hits, cache.misses
+
+    def test_cached(self):
+        self.assertEqual(self.lookups(PackumentCache(1024)), (2, 1))
+        self.assertEqual(self.lookups(SharedPackumentCache(join(self.directory, 'shared'), 1024)), (2, 1))
+
+    def test_over_budget_is_a_miss_every_time(self):
+        self.assertEqual(self.lookups(PackumentCache(10)), (0, 3))
+        self.assertEqual(self.lookups(SharedPackumentCache(join(self.directory, 'shared'), 10)), (0, 3))
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from compiler import filter_cached_versions
+
+
+def packument(versions, tags):
+    return {
+        'name': 'pkg',
+        'dist-tags': tags,
+        'versions': dict((version, {'version': version, 'dist': {'tarball': 'https://registry.npmjs.org/pkg/-/pkg-{0}.tgz'.format(version)}})
+                         for version in versions),
+        'time': dict([('created', 'c'), ('modified', 'm')] + [(version, 't') for version in versions]),
+    }
+
+
+def cached(*versions):
+    tarballs = set('pkg-{0}.tgz'.format(version) for version in versions)
+    return lambda version, tarball_name: tarball_name in tarballs
+
+
+class FilterCachedVersionsTests(TestCase):
+    def test_drops_uncached_versions_tags_and_times(self):
+        content = filter_cached_versions(packument(['1.0.0', '1.1.0', '2.0.0-beta'], {'latest': '1.1.0', 'next': '2.0.0-beta'}), cached('1.0.0', '1.1.0'))
+        self.assertEqual(sorted(content['versions']), ['1.0.0', '1.1.0'])
+        self.assertEqual(content['dist-tags'], {'latest': '1.1.0'})
+        self.assertEqual(sorted(content['time']), ['1.0.0', '1.1.0', 'created', 'modified'])
+
+    def test_latest_falls_back_to_newest_cached_not_newer(self):
+        content = filter_cached_versions(packument(['1.0.0', '1.1.0', '1.2.0', '2.0.0'], {'latest': '1.2.0'}), cached('1.0.0', '1.1.0', '2.0.0'))
+        self.assertEqual(content['dist-tags'], {'latest': '1.1.0'})
+
+    def test_latest_falls_back_to_newer_when_nothing_older_is_cached(self):
+        content = filter_cached_versions(packument(['1.0.0', '2.0.0'], {'latest': '1.0.0'}), cached('2.0.0'))
+        self.assertEqual(content['dist-tags'], {'latest': '2.0.0'})
+
+    def test_nothing_cached(self):
+        content = filter_cached_versions(packument(['1.0.0'], {'latest': '1.0.0'}), cached())
+        self.assertEqual(content['versions'], {})
+        self.assertEqual(content['dist-tags'], {})
+
+    def test_versions_without_tarballs_are_dropped(self):
+        content = packument(['1.0.0'], {'latest': '1.0.0'})
+        del content['versions']['1.0.0']['dist']
+        self.assertEqual(filter_cached_versions(content, lambda version, tarball_name: True)['versions'], {})
@@ -0,0 +1,55 @@
+from base64 import b64encode
+from hashlib import sha1, sha512
+from unittest import TestCase
+
+from integrity import Integrity, logger
+
+
+DATA = b'tarball content'
+SHA1 = sha1(DATA).hexdigest()
+SHA512 = sha512(DATA).hexdigest()
+SRI = 'sha512-' + b64encode(sha512(DATA).digest()).decode('ascii')
+
+
+class IntegrityTests(TestCase):
+    def test_shasum(self):
+        integrity = Integrity.from_dist({'shasum': SHA1.upper()})
+        self.assertEqual(integrity.digests, {'sha1': SHA1})
+        self.assertEqual(integrity.digest, 'sha1-' + SHA1)
+
+    def test_sri(self):
+        integrity = Integrity.from_dist({'integrity': SRI})
+        self.assertEqual(integrity.digests, {'sha512': SHA512})
+        self.assertEqual(integrity.digest, 'sha512-' + SHA512)
+
+    def test_strongest_digest_wins(self):
+        integrity = Integrity.from_dist({'shasum': SHA1, 'integrity': SRI})
+        self.assertEqual(integrity.digests, {'sha1': SHA1, 'sha512': SHA512})
+        self.assertEqual(integrity.algorithm, 'sha512')
+
+    def test_sri_options_and_unknown_algorithms(self):
+        integrity = Integrity.from_dist({'integrity': 'md5-AAAA {0}?foo sha256-'.format(SRI)})
+        self.assertEqual(integrity.digests, {'sha512': SHA512})
+
+    def test_malformed_sri_is_ignored(self):
+        logger.disabled = True
+        try:
+            self.assertEqual(Integrity.from_dist({'integrity': 'sha512-%%%'}).digests, {})
+        finally:
+            logger.disabled = False
+
+    def test_no_digests(self):
+        integrity = Integrity.from_dist({})
+        self.assertIsNone(integrity.digest)
+
+    def test_mismatches(self):
+        integrity = Integrity.from_dist({'shasum': SHA1, 'integrity': SRI})
+        hashers = integrity.hashers()
+        for hasher in hashers.values():
+            hasher.update(DATA)
+        self.assertEqual(integrity.mismatches(hashers), [])
+
+        hashers = integrity.hashers()
+        for hasher in hashers.values():
+            hasher.update(b'something else')
+        self.assertEqual(sorted(algorithm for algorithm, expected, actual in integrity.mismatches(hashers)), ['sha1', 'sha512'])
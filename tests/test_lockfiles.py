@@ -0,0 +1,79 @@
+from unittest import TestCase
+
+from lockfiles import UnsupportedLockfileError, read_npm_lockfile, read_yarn_lockfile
+
+
+def tarball(name, version):
+    return 'https://registry.npmjs.org/{0}/-/{1}-{2}.tgz'.format(name, name.rsplit('/', 1)[-1], version)
+
+
+def locked(packages):
+    return sorted((package.name, package.version, package.resolved, package.dist) for package in packages)
+
+
+class NpmLockfileTests(TestCase):
+    def test_v1(self):
+        content = {
+            'lockfileVersion': 1,
+            'dependencies': {
+                'a': {'version': '1.0.0', 'resolved': tarball('a', '1.0.0'), 'integrity': 'sha512-aaa',
+                      'dependencies': {'b': {'version': '2.0.0', 'resolved': tarball('b', '2.0.0')}}},
+                'bundled': {'version': '1.0.0', 'resolved': tarball('bundled', '1.0.0'), 'bundled': True},
+                'local': {'version': 'file:../local'},
+            },
+        }
+        self.assertEqual(locked(read_npm_lockfile(content)), [
+            ('a', '1.0.0', tarball('a', '1.0.0'), {'integrity': 'sha512-aaa'}),
+            ('b', '2.0.0', tarball('b', '2.0.0'), {}),
+        ])
+
+    def test_v2_and_v3(self):
+        packages = {
+            '': {'name': 'root', 'version': '0.0.0'},
+            'node_modules/a': {'version': '1.0.0', 'resolved': tarball('a', '1.0.0'), 'integrity': 'sha512-aaa'},
+            'node_modules/a/node_modules/@scope/b': {'version': '2.0.0', 'resolved': tarball('@scope/b', '2.0.0')},
+            'node_modules/linked': {'resolved': '../linked', 'link': True},
+            'node_modules/a/node_modules/inner': {'version': '1.0.0', 'resolved': tarball('inner', '1.0.0'), 'inBundle': True},
+        }
+        expected = [
+            ('@scope/b', '2.0.0', tarball('@scope/b', '2.0.0'), {}),
+            ('a', '1.0.0', tarball('a', '1.0.0'), {'integrity': 'sha512-aaa'}),
+        ]
+        # v2 carries the v1 dependencies too, the packages section wins.
+        self.assertEqual(locked(read_npm_lockfile({'lockfileVersion': 2, 'packages': packages, 'dependencies': {'ignored': {}}})), expected)
+        self.assertEqual(locked(read_npm_lockfile({'lockfileVersion': 3, 'packages': packages})), expected)
+
+
+class YarnLockfileTests(TestCase):
+    def test_v1(self):
+        lines = '''# THIS IS AN AUTOGENERATED FILE. DO NOT EDIT THIS FILE DIRECTLY.
+# yarn lockfile v1
+
+
+"@scope/b@^2.0.0":
+  version "2.0.0"
+  resolved "{0}#{1}"
+  integrity sha512-bbb
+
+a@^1.0.0, a@~1.0.0:
+  version "1.0.0"
+  resolved "{2}"
+  dependencies:
+    "@scope/b" "^2.0.0"
+
+git-dep@git+https://example.com/dep.git:
+  version "1.0.0"
+  resolved "git+https://example.com/dep.git#abc"
+'''.format(tarball('@scope/b', '2.0.0'), 'f' * 40, tarball('a', '1.0.0')).splitlines()
+
+        self.assertEqual(locked(read_yarn_lockfile(lines)), [
+            ('@scope/b', '2.0.0', tarball('@scope/b', '2.0.0'), {'integrity': 'sha512-bbb', 'shasum': 'f' * 40}),
+            ('a', '1.0.0', tarball('a', '1.0.0'), {}),
+        ])
+
+    def test_berry_is_rejected(self):
+        lines = ['# This file is generated by running "yarn install".', '', '__metadata:', '  version: 6', '']
+        self.assertRaises(UnsupportedLockfileError, read_yarn_lockfile, lines)
+
+    def test_not_a_lockfile(self):
+        self.assertEqual(read_yarn_lockfile(['a random sentence']), [])
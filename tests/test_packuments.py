@@ -0,0 +1,46 @@
+from json import dumps, loads
+from unittest import TestCase
+
+from compiler import rewrite_tarball_urls
+from packuments import rewrite_tarball_url_stream
+
+
+NODE_URL = 'http://127.0.0.1:16000/node/'
+
+
+def packument(name, versions):
+    return {
+        'name': name,
+        'readme': 'x' * 300,
+        'versions': dict((version, {'name': name, 'version': version, 'dist': {
+            'tarball': 'https://registry.npmjs.org/{0}/-/{1}-{2}.tgz'.format(name, name.rsplit('/', 1)[-1], version)}})
+            for version in versions),
+    }
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class RewriteTarballUrlStreamTests(TestCase):
+    def assert_rewritten(self, content, size):
+        body = dumps(content).encode('utf-8')
+        rewritten = b''.join(rewrite_tarball_url_stream(chunked(body, size), NODE_URL))
+        self.assertEqual(loads(rewritten.decode('utf-8')), rewrite_tarball_urls(loads(body.decode('utf-8')), NODE_URL))
+
+    def test_every_chunk_size(self):
+        # every split of the tarball fields, the key, the url and the name among them.
+        content = packument('@scope/pkg', ['1.0.0', '1.0.1', '2.0.0'])
+        for size in range(1, 200):
+            self.assert_rewritten(content, size)
+
+    def test_single_chunk(self):
+        self.assert_rewritten(packument('pkg', ['1.0.0']), 1 << 20)
+
+    def test_other_content_is_untouched(self):
+        body = b'{"description":"a \\"tarball\\" of things","tarball":"not/a/url"}'
+        for size in range(1, len(body) + 1):
+            self.assertEqual(b''.join(rewrite_tarball_url_stream(chunked(body, size), NODE_URL)), body)
+
+    def test_empty(self):
+        self.assertEqual(list(rewrite_tarball_url_stream([], NODE_URL)), [])
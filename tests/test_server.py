@@ -0,0 +1,60 @@
+from json import dumps
+from unittest import TestCase
+
+from werkzeug.exceptions import BadRequest
+
+from server import app, bulk_package_names
+
+
+def names(body):
+    with app.test_request_context():
+        return bulk_package_names(body)
+
+
+class BulkPackageNamesTests(TestCase):
+    def assert_bad_request(self, body):
+        with app.test_request_context():
+            self.assertRaises(BadRequest, bulk_package_names, body)
+
+    def test_list(self):
+        self.assertEqual(names(b'["a", "@scope/b"]'), ['a', '@scope/b'])
+
+    def test_package_json(self):
+        body = dumps({'name': 'app', 'dependencies': {'a': '^1.0.0'}, 'devDependencies': {'@scope/b': '*'}}).encode('utf-8')
+        self.assertEqual(names(body), ['@scope/b', 'a'])
+
+    def test_npm_lockfile(self):
+        body = dumps({'lockfileVersion': 3, 'packages': {
+            '': {'name': 'app'},
+            'node_modules/a': {'version': '1.0.0', 'resolved': 'https://registry.npmjs.org/a/-/a-1.0.0.tgz'},
+        }}).encode('utf-8')
+        self.assertEqual(names(body), ['a'])
+
+    def test_yarn_lockfile(self):
+        body = b'a@^1.0.0:\n  version "1.0.0"\n  resolved "https://registry.npmjs.org/a/-/a-1.0.0.tgz"\n'
+        self.assertEqual(names(body), ['a'])
+
+    def test_invalid_names(self):
+        for body in (b'["../../etc/passwd"]', b'["a/b/c"]', b'[1]', b'["@scope/.."]', b'["a", null]'):
+            self.assert_bad_request(body)
+
+    def test_not_a_list_or_object(self):
+        for body in (b'42', b'"a"', b'null'):
+            self.assert_bad_request(body)
+
+    def test_malformed_documents(self):
+        for body in (b'{"lockfileVersion": 2, "packages": [1]}', b'{"dependencies": 5}'):
+            self.assert_bad_request(body)
+
+    def test_not_json_or_a_lockfile(self):
+        for body in (b'a random sentence', b'', b'\xff\xfe'):
+            self.assert_bad_request(body)
+
+    def test_yarn_berry(self):
+        with app.test_request_context():
+            try:
+                bulk_package_names(b'__metadata:\n  version: 6\n')
+            except BadRequest as e:
+                self.assertIn('berry', e.description)
+            else:
+                self.fail('yarn berry lockfiles are not supported')
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from semver import lte, max_satisfying
+
+from versions import VersionIndex
+
+
+VERSIONS = ['0.1.0', '0.9.1', '1.0.0', '1.0.1', '1.2.0-beta.1', '1.2.0', '1.10.0', '2.0.0-rc.1', '2.0.0', '2.1.0', '3.0.0', 'not-a-version']
+SPECS = ['*', 'latest', '^1.0.0', '~1.0.0', '1.x', '>=1.2.0 <2.0.0', '^2.0.0', '>2.1.0', '^3.0.0', '0.9.1', '^4.0.0',
+         '1.0.0 - 2.0.0', '<1.0.0 || >=2.1.0', '']
+
+
+def old_max_satisfying(versions, latest, spec):
+    """ How versions were resolved before VersionIndex: up to latest first, then every version. """
+    versions = [version for version in versions if version != 'not-a-version']
+    filtered = [version for version in versions if lte(version, latest, False)]
+    return max_satisfying(filtered, spec, False) or max_satisfying(versions, spec, False)
+
+
+class VersionIndexTests(TestCase):
+    def test_matches_max_satisfying(self):
+        for latest in ('2.0.0', '1.0.1', '3.0.0'):
+            index = VersionIndex(VERSIONS, latest)
+            for spec in SPECS:
+                if spec == 'latest':
+                    continue
+                self.assertEqual(index.max_satisfying(spec), old_max_satisfying(VERSIONS, latest, spec), (latest, spec))
+
+    def test_prefers_versions_up_to_latest(self):
+        index = VersionIndex(VERSIONS, '2.0.0')
+        self.assertEqual(index.max_satisfying('>=2.0.0'), '2.0.0')
+        self.assertEqual(index.max_satisfying('>2.0.0'), '3.0.0')
+
+    def test_invalid_spec_resolves_to_none(self):
+        self.assertIsNone(VersionIndex(VERSIONS, '2.0.0').max_satisfying('not a range'))
+
+    def test_skips_invalid_versions(self):
+        self.assertEqual(len(VersionIndex(VERSIONS, '2.0.0')), len(VERSIONS) - 1)
+
+    def test_memoizes_resolved_specs(self):
+        index = VersionIndex(VERSIONS, '2.0.0')
+        self.assertEqual(index.max_satisfying('^1.0.0'), '1.10.0')
+        index.versions = []
+        self.assertEqual(index.max_satisfying('^1.0.0'), '1.10.0')